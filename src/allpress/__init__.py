@@ -2,8 +2,7 @@ from . import settings
 from . import util
 from . import exceptions
 from . import db
-from . import cli
 from . import types
 
-
-
+# `allpress.cli`, `allpress.core` and `allpress.services` are not imported here. They pull in torch, FAISS, spaCy
+# and the database drivers, and are imported by the commands that need them.
@@ -1,5 +1,19 @@
-from allpress import cli
 from allpress.util import logger
+from allpress.settings import (
+    FAISS_INDEX_TYPE,
+    FAISS_IVF_NLIST,
+    FAISS_PQ_M,
+    FAISS_HNSW_M,
+    FAISS_TRAIN_MAX_SAMPLES,
+    CRAWL_ITERATIONS,
+    CRAWL_MAX_SOURCES_IN_FLIGHT,
+    CRAWL_MAX_CONNECTIONS,
+    CRAWL_MAX_CONNECTIONS_PER_DOMAIN,
+    CRAWL_SOURCE_TIME_BUDGET,
+    CRAWL_INCREMENTAL,
+    SEARCH_SERVER_HOST,
+    SEARCH_SERVER_PORT,
+)
 
 import argparse
 
@@ -17,7 +31,7 @@ if __name__ == "__main__":
     parser_build_temp.add_argument(
         "--max-size",
         type=int,
-        help="Max desired size of tensor file. No more embeddings will be created\n " \
+        help="Max desired size of each tensor store in megabytes. No more embeddings will be created\n " \
         "once this size has been reached."
     )
 
@@ -33,6 +47,111 @@ if __name__ == "__main__":
         default=50
     )
 
+    parser_train_aes.add_argument(
+        "--streaming",
+        action="store_true",
+        help="Stream the training tensors from disk instead of loading them into memory."
+    )
+
+    parser_train_aes.add_argument(
+        "--batch-size",
+        type=int,
+        default=2048,
+        help="Mini-batch size."
+    )
+
+    parser_train_aes.add_argument(
+        "--val-fraction",
+        type=float,
+        default=0.05,
+        help="Fraction of the training tensors held out for validation."
+    )
+
+    parser_train_aes.add_argument(
+        "--patience",
+        type=int,
+        default=5,
+        help="Stop training once the validation loss has not improved for this many epochs."
+    )
+
+    subparsers.add_parser(
+        "migrate_autoencoders",
+        help="Rewrite autoencoders saved as pickled models as weights-only checkpoints."
+    )
+
+    parser_build_index = subparsers.add_parser(
+        "build_index",
+        help="Build new FAISS indexes of the given type, training them on the temporary tensors if needed."
+    )
+    parser_build_index.add_argument(
+        "-t",
+        "--index-type",
+        choices=["flat", "ivf_flat", "ivf_pq", "hnsw"],
+        default=FAISS_INDEX_TYPE,
+        help="Type of index to build."
+    )
+    parser_build_index.add_argument(
+        "--nlist",
+        type=int,
+        default=FAISS_IVF_NLIST,
+        help="Number of IVF cells (ivf_flat and ivf_pq)."
+    )
+    parser_build_index.add_argument(
+        "--pq-m",
+        type=int,
+        default=FAISS_PQ_M,
+        help="Number of PQ sub-quantizers (ivf_pq)."
+    )
+    parser_build_index.add_argument(
+        "--hnsw-m",
+        type=int,
+        default=FAISS_HNSW_M,
+        help="Number of neighbours per HNSW node (hnsw)."
+    )
+    parser_build_index.add_argument(
+        "--max-samples",
+        type=int,
+        default=FAISS_TRAIN_MAX_SAMPLES,
+        help="Max number of training vectors used to train the index."
+    )
+
+    parser_bench = subparsers.add_parser(
+        "bench",
+        help="Run a benchmark."
+    )
+    parser_bench.add_argument(
+        "target",
+        choices=["index", "detector", "startup", "embedders"],
+        help="What to benchmark. `index` reports recall@k and latency of the indexes against exact search. "
+             "`detector` times page parsing and article detection on a corpus of saved pages. "
+             "`startup` times the imports each CLI command makes before it starts its work. "
+             "`embedders` compares the throughput and embedding drift of the embedder inference variants."
+    )
+    parser_bench.add_argument(
+        "--space",
+        choices=["semantic", "rhetoric"],
+        nargs="+",
+        default=["semantic", "rhetoric"],
+        help="Vector spaces to benchmark."
+    )
+    parser_bench.add_argument(
+        "-k",
+        type=int,
+        default=10,
+        help="Number of neighbours to retrieve per query."
+    )
+    parser_bench.add_argument(
+        "--queries",
+        type=int,
+        default=1000,
+        help="Number of queries to run (index), or of sentences to embed (embedders)."
+    )
+    parser_bench.add_argument(
+        "--corpus",
+        type=str,
+        help="Directory of saved .html pages (detector, embedders)."
+    )
+
     parser_search = subparsers.add_parser(
         "search",
         help="Search VectorDB."
@@ -60,6 +179,49 @@ if __name__ == "__main__":
         help="Top k keys to return for second-order search."
     )
 
+    parser_search.add_argument(
+        "--nprobe",
+        type=int,
+        help="Number of IVF cells to visit per query. Higher is more accurate and slower."
+    )
+
+    parser_search.add_argument(
+        "--ef-search",
+        type=int,
+        help="Size of the HNSW candidate list per query. Higher is more accurate and slower."
+    )
+
+    parser_search.add_argument(
+        "--fast",
+        action="store_true",
+        help="Search the article-level indexes, with one lookup per space, instead of every entity and sentence."
+    )
+
+    parser_search.add_argument(
+        "--no-server",
+        action="store_true",
+        help="Run the search in this process even if a search server is running."
+    )
+
+    parser_serve = subparsers.add_parser(
+        "serve",
+        help="Run a search server which keeps the models and indexes loaded between searches."
+    )
+
+    parser_serve.add_argument(
+        "--host",
+        type=str,
+        default=SEARCH_SERVER_HOST,
+        help="Address to listen on."
+    )
+
+    parser_serve.add_argument(
+        "--port",
+        type=int,
+        default=SEARCH_SERVER_PORT,
+        help="Port to listen on."
+    )
+
     parser_scrape = subparsers.add_parser(
         "scrape",
         help="Scrape."
@@ -85,25 +247,91 @@ if __name__ == "__main__":
         "-i",
         "--iterations",
         type=int,
-        default=2,
+        default=CRAWL_ITERATIONS,
         help="Number of iterations over a website to make when scraping."
     )
 
+    parser_scrape.add_argument(
+        "--sources-in-flight",
+        type=int,
+        default=CRAWL_MAX_SOURCES_IN_FLIGHT,
+        help="Number of sources crawled at the same time."
+    )
+
+    parser_scrape.add_argument(
+        "--max-connections",
+        type=int,
+        default=CRAWL_MAX_CONNECTIONS,
+        help="Max number of requests in flight over all sources."
+    )
+
+    parser_scrape.add_argument(
+        "--per-domain",
+        type=int,
+        default=CRAWL_MAX_CONNECTIONS_PER_DOMAIN,
+        help="Max number of requests in flight to a single domain."
+    )
+
+    parser_scrape.add_argument(
+        "--time-budget",
+        type=float,
+        default=CRAWL_SOURCE_TIME_BUDGET,
+        help="Seconds after which the crawl of a single source is cut short."
+    )
+
+    parser_scrape.add_argument(
+        "--full",
+        action="store_true",
+        help="Ignore the saved crawl state, and fetch and parse every page again."
+    )
+
     args = parser.parse_args()
 
     logger.set_verbose(True)
 
+    # The command functions are imported only once the arguments have been parsed, so `--help` and argument errors
+    # return without loading any of their dependencies.
+    from allpress.cli import main
+
     if args.command == "build_temp":
-        cli.main._build_temp_embed_tensor()
+        main._build_temp_embed_tensor(args.max_size)
 
     if args.command == "train_autoencoders":
-        cli.main._train_autoencoders(args.epochs)
+        main._train_autoencoders(
+            args.epochs,
+            streaming=args.streaming,
+            val_fraction=args.val_fraction,
+            patience=args.patience,
+            batch_size=args.batch_size,
+        )
+
+    if args.command == "migrate_autoencoders":
+        main._migrate_autoencoders()
+
+    if args.command == "build_index":
+        main._build_index(args.index_type, args.nlist, args.pq_m, args.hnsw_m, args.max_samples)
+
+    if args.command == "bench":
+        main._bench(args.target, args.space, args.k, args.queries, args.corpus, list(subparsers.choices))
 
     if args.command == "scrape":
         shuffle_data = args.shuffle
         save_vectors = args.save_vectors
         iterations = args.iterations
-        cli.main._scrape_sources(shuffle_data, save_vectors, iterations)
+        main._scrape_sources(
+            shuffle_data,
+            save_vectors,
+            iterations,
+            sources_in_flight=args.sources_in_flight,
+            max_connections=args.max_connections,
+            per_domain=args.per_domain,
+            time_budget=args.time_budget,
+            incremental=CRAWL_INCREMENTAL and not args.full,
+        )
 
     if args.command == "search":
-        cli.main._search(args.query, args.top_k1, args.top_k2)
+        main._search(args.query, args.top_k1, args.top_k2, args.nprobe, args.ef_search,
+                     use_server=not args.no_server, fast=args.fast)
+
+    if args.command == "serve":
+        main._serve(args.host, args.port)
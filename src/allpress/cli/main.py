@@ -1,34 +1,67 @@
 from allpress.services.db import db_service
-from allpress.core.nn import VectorDB
-from allpress.services import scrape, nlp
-from allpress.services.search import Searcher
-from allpress.settings import TEMP_TRAINING_VECTOR_PATH, CLASSIFICATION_MODELS_PATH
-from allpress.util import check_redis_connection
-
-from urllib3 import exceptions as urllib3_exceptions
-from requests import exceptions as requests_exceptions
-
-import torch
+from allpress.settings import (
+    TEMP_TRAINING_VECTOR_PATH,
+    TEMP_TENSOR_SHARD_ROWS,
+    CLASSIFICATION_MODELS_PATH,
+    ID_MAP_BACKEND,
+    CRAWL_MAX_SOURCES_IN_FLIGHT,
+    CRAWL_MAX_CONNECTIONS,
+    CRAWL_MAX_CONNECTIONS_PER_DOMAIN,
+    CRAWL_SOURCE_TIME_BUDGET,
+    CRAWL_INCREMENTAL,
+    PIPELINE_QUEUE_SIZE,
+    PIPELINE_EMBED_WORKERS,
+    PIPELINE_SAVE_WORKERS,
+    EMBEDDING_BATCH_SIZE,
+)
+from allpress.util import check_redis_connection, logger
+
+import numpy as np
 
 from random import shuffle
 from os import path
 import argparse
+import threading
 
+# Torch, FAISS, spaCy and the crawler are imported inside the command functions below, so every command only
+# loads what it uses.
+
+# Legacy single-file training tensors, and the shard stores that replaced them.
 semantic_temp_path = path.join(TEMP_TRAINING_VECTOR_PATH, "semantic.pth")
 rhetoric_temp_path = path.join(TEMP_TRAINING_VECTOR_PATH, "rhetoric.pth")
+semantic_temp_store_path = path.join(TEMP_TRAINING_VECTOR_PATH, "semantic")
+rhetoric_temp_store_path = path.join(TEMP_TRAINING_VECTOR_PATH, "rhetoric")
 
 semantic_autoencoder_path = path.join(CLASSIFICATION_MODELS_PATH, "semantic_autoencoder.pth")
 rhetoric_autoencoder_path = path.join(CLASSIFICATION_MODELS_PATH, "rhetoric_autoencoder.pth")
 
-vector_db = VectorDB()
+def _print_embedding_cache_stats():
+    from allpress.services.bench import print_report
+    from allpress.services.nlp.cache import cache_stats
 
-def _build_temp_embed_tensor():
-    ## Responsible for executing the command `build_temp` from the CLI.
+    stats = cache_stats()
+    if stats:
+        print("Embedding cache:")
+        print_report(stats)
+
+
+def _open_temp_stores() -> tuple:
+    # The training tensors are kept in appendable shard stores. Tensors from the old single-file format are imported
+    # the first time the stores are opened.
+    from allpress.core.tensorstore import open_tensor_store
+
+    semantic_store = open_tensor_store(semantic_temp_store_path, semantic_temp_path, TEMP_TENSOR_SHARD_ROWS)
+    rhetoric_store = open_tensor_store(rhetoric_temp_store_path, rhetoric_temp_path, TEMP_TENSOR_SHARD_ROWS)
+    return semantic_store, rhetoric_store
 
 
+def _build_temp_embed_tensor(max_size: int = None):
+    ## Responsible for executing the command `build_temp` from the CLI.
+    ## max_size is the max size of each training tensor store in megabytes.
+    from allpress.services import scrape
+
     # First, all news sources are pulled from the DB for scraping.
-    db_service.db.cursor.execute("SELECT * FROM newssource;")
-    sources = db_service.db.cursor.fetchall()[1:]
+    sources = db_service.fetch_all("SELECT * FROM newssource;")[1:]
 
     # If we assume the table is quite large and has many sources, we want to avoid introducing bias into the autoencoder
     # by including too many articles from rows near the top of the table. For this reason, we shuffle the sources
@@ -36,122 +69,361 @@ def _build_temp_embed_tensor():
     shuffle(sources)
     scraper = scrape.Scraper()
 
-    # Location of temp tensors as defined in settings is saved to a string for later writing
+    # Each batch of embeddings is appended to the stores, which costs O(batch) regardless of how large they are.
+    semantic_store, rhetoric_store = _open_temp_stores()
+    max_bytes = max_size * 1024 * 1024 if max_size else None
+
+    def is_full() -> bool:
+        return max_bytes is not None and semantic_store.nbytes >= max_bytes and rhetoric_store.nbytes >= max_bytes
 
     tensors_saved = 0
-    for source, url in sources:
-        try:
-            scraped = scraper.scrape(url)
-            for batch in scraped:
-
-                # Inside this loop, the scraped articles have their embeddings generated (using LaBSE and paraphrase)
-                # then, newly scraped tensors (if any are found) are saved to disk for later retrieval.
-
-                embeds = batch.generate_embeddings()
-                semantic_embeds = embeds.semantic[0][0]
-                rhetoric_embeds = embeds.rhetoric[0][0]
-
-                if not path.exists(semantic_temp_path) and semantic_embeds.size > 0:
-                    write_tensor = torch.tensor(semantic_embeds)
-                    torch.save(write_tensor, semantic_temp_path)
-                elif path.exists(semantic_temp_path):
-                    saved_tensor = torch.load(semantic_temp_path)
-                    new_tensors = torch.tensor(semantic_embeds)
-                    write_tensor = torch.cat((saved_tensor, new_tensors))
-                    torch.save(write_tensor, semantic_temp_path)
-
-                if not path.exists(rhetoric_temp_path) and rhetoric_embeds.numel() > 0:
-                    write_tensor = torch.tensor(rhetoric_embeds)
-                    torch.save(write_tensor, rhetoric_temp_path)
-                elif path.exists(rhetoric_temp_path):
-                    saved_tensor = torch.load(rhetoric_temp_path)
-                    new_tensors = torch.tensor(rhetoric_embeds)
-                    write_tensor = torch.cat((saved_tensor, new_tensors))
-                    torch.save(write_tensor, rhetoric_temp_path)
-
-                tensors_saved += semantic_embeds.size + len(rhetoric_embeds)
-
-        except (urllib3_exceptions.MaxRetryError,
-                urllib3_exceptions.NameResolutionError,
-                requests_exceptions.ConnectionError) as e:
-            print(f"Scraping {url} failed: {e}")
-
-        except KeyboardInterrupt:
-            # Add exception handling here later?
-            print(f"{tensors_saved} tensors saved")
-            pass
-
-def _train_autoencoders(epochs):
-    semantic_training_tensor = torch.load(semantic_temp_path)
-    rhetoric_training_tensor = torch.load(rhetoric_temp_path)
-
-    semantic_model = nlp.encoders.train_autoencoder(
-        semantic_training_tensor,
+    try:
+        for source, url in sources:
+            if is_full():
+                print(f"Max size of {max_size} MB reached.")
+                break
+            try:
+                scraped = scraper.scrape(url)
+                for batch in scraped:
+
+                    # Inside this loop, the scraped articles have their embeddings generated (using LaBSE and
+                    # paraphrase), then newly scraped tensors (if any are found) are saved to disk for later retrieval.
+
+                    embeds = batch.generate_embeddings()
+                    semantic_embeds = np.asarray(embeds.semantic[0][0])
+                    rhetoric_embeds = np.asarray(embeds.rhetoric[0][0])
+
+                    # A store which has reached the max size stops growing, while the other one catches up.
+                    if max_bytes is None or semantic_store.nbytes < max_bytes:
+                        semantic_store.append(semantic_embeds)
+                        tensors_saved += len(semantic_embeds)
+                    if max_bytes is None or rhetoric_store.nbytes < max_bytes:
+                        rhetoric_store.append(rhetoric_embeds)
+                        tensors_saved += len(rhetoric_embeds)
+
+                    if is_full():
+                        break
+
+            except Exception as e:
+                print(f"Scraping {url} failed: {e}")
+
+    except KeyboardInterrupt:
+        pass
+    finally:
+        scraper.close()
+
+    print(f"{tensors_saved} tensors saved")
+    _print_embedding_cache_stats()
+
+def _train_autoencoders(epochs: int,
+                        streaming: bool = False,
+                        val_fraction: float = 0.0,
+                        patience: int = None,
+                        batch_size: int = 2048):
+    import torch
+    from allpress.services.nlp import encoders
+
+    semantic_store, rhetoric_store = _open_temp_stores()
+
+    # In streaming mode, the stores are read shard by shard during training. Otherwise they are loaded into memory.
+    if streaming:
+        semantic_training_data = semantic_store
+        rhetoric_training_data = rhetoric_store
+    else:
+        semantic_training_data = torch.from_numpy(semantic_store.to_array())
+        rhetoric_training_data = torch.from_numpy(rhetoric_store.to_array())
+
+    semantic_model = encoders.train_autoencoder(
+        semantic_training_data,
         epochs=epochs,
-        latent_dim=128)
+        latent_dim=128,
+        batch_size=batch_size,
+        val_fraction=val_fraction,
+        patience=patience)
 
-    rhetoric_model = nlp.encoders.train_autoencoder(
-        rhetoric_training_tensor,
+    rhetoric_model = encoders.train_autoencoder(
+        rhetoric_training_data,
         epochs=epochs,
-        latent_dim=256
+        latent_dim=256,
+        batch_size=batch_size,
+        val_fraction=val_fraction,
+        patience=patience
     )
 
-    torch.save(semantic_model, semantic_autoencoder_path)
-    torch.save(rhetoric_model, rhetoric_autoencoder_path)
-
-def _scrape_sources(shuffle_data: bool, save_vectors: bool, iterations: int):
-    check_redis_connection(db_service)
-    db_service.db.cursor.execute("SELECT * FROM newssource;")
-    sources = db_service.db.cursor.fetchall()[1:] # Start from 2nd element to exclude label row
+    # Only the dimensions and weights are saved, so the models can be loaded without unpickling arbitrary objects.
+    encoders.save_checkpoint(semantic_model, semantic_autoencoder_path)
+    encoders.save_checkpoint(rhetoric_model, rhetoric_autoencoder_path)
+
+def _migrate_autoencoders():
+    from allpress.services.nlp import encoders
+
+    # Autoencoders saved as whole pickled models are rewritten once as weights-only checkpoints.
+    for autoencoder_path in (semantic_autoencoder_path, rhetoric_autoencoder_path):
+        if not path.exists(autoencoder_path):
+            print(f"{autoencoder_path} not found.")
+        elif encoders.migrate_checkpoint(autoencoder_path):
+            print(f"Converted {autoencoder_path}, the old file is kept as {autoencoder_path}.legacy")
+        else:
+            print(f"{autoencoder_path} is already a checkpoint.")
+
+def _scrape_sources(shuffle_data: bool,
+                    save_vectors: bool,
+                    iterations: int,
+                    sources_in_flight: int = CRAWL_MAX_SOURCES_IN_FLIGHT,
+                    max_connections: int = CRAWL_MAX_CONNECTIONS,
+                    per_domain: int = CRAWL_MAX_CONNECTIONS_PER_DOMAIN,
+                    time_budget: float = CRAWL_SOURCE_TIME_BUDGET,
+                    incremental: bool = CRAWL_INCREMENTAL):
+    from allpress.core.models import text_uid
+    from allpress.core.nn import get_vector_db
+    from allpress.core.uidset import load_known_uids
+    from allpress.services import crawl, pipeline
+    from allpress.services.bench import print_report
+    from allpress.services.nlp.processors import ArticleBatch
+    from allpress.services.nn import model_manager
+    from allpress.services.scrape import get_parse_pool
+
+    # Redis is only needed when the vector id maps are kept there.
+    if ID_MAP_BACKEND == 'redis':
+        check_redis_connection(db_service)
+    sources = db_service.fetch_all("SELECT * FROM newssource;")[1:] # Start from 2nd element to exclude label row
     if shuffle_data: shuffle(sources)
-
-    scraper = scrape.Scraper()
-    semantic_autoencoder = torch.load(semantic_autoencoder_path, weights_only=False)
-    rhetoric_autoencoder = torch.load(rhetoric_autoencoder_path, weights_only=False)
-    for source, url in sources:
+    if incremental:
+        from allpress.config import DBSetup
+        DBSetup.setup_crawl_state_table()
+
+    # The page parsing pool is created before any model is loaded or any crawl or pipeline thread is started.
+    get_parse_pool()
+
+    # Many sources are crawled concurrently in the background. The article pages of each crawled round are handed
+    # over to the ingest pipeline as soon as they arrive.
+    scheduler = crawl.CrawlScheduler(
+        iterations=iterations,
+        max_sources=sources_in_flight,
+        max_connections=max_connections,
+        per_domain=per_domain,
+        time_budget=time_budget,
+        incremental=incremental,
+    )
+    vector_db = get_vector_db()
+    # Taken before crawling, so a second scrape fails at once instead of after its first batch.
+    vector_db.acquire_writer()
+    with model_manager.get_autoencoders() as autoencoders:
+        semantic_autoencoder, rhetoric_autoencoder = autoencoders
+
+    # Pages already in the database, or already taken up earlier in this run, are dropped as soon as their text is
+    # known, before any NLP or embedding work is spent on them. Pages still going through the pipeline are kept
+    # apart, and only become known once they are saved. If a batch fails, its pages can be taken up again.
+    known_uids = load_known_uids()
+    in_flight = set()
+    uids_lock = threading.Lock()
+    skipped = [0]
+
+    def release(uids, saved: bool):
+        with uids_lock:
+            if saved:
+                known_uids.add(uids)
+            in_flight.difference_update(uids)
+
+    # The rounds of crawled article pages go through the stages below, which all run at the same time: while one
+    # batch is embedded, the next one goes through spaCy and the previous one is inserted, and the crawl goes on in
+    # the background. Every stage takes and returns a tuple starting with the source and url the batch came from,
+    # and the uids of its pages.
+
+    def nlp_stage(item):
+        source, url, articles = item
+        uids = [text_uid(page.text.strip()) for page in articles]
+        new_articles = {}
+        with uids_lock:
+            is_known = known_uids.contains(uids)
+            for page, uid, known in zip(articles, uids, is_known):
+                if not known and uid not in in_flight:
+                    new_articles.setdefault(uid, page)
+            # The pages are taken up right away, so a page crawled again while its batch is still in the pipeline is
+            # not indexed twice.
+            in_flight.update(new_articles)
+        skipped[0] += len(articles) - len(new_articles)
+        new_uids = list(new_articles)
+
+        # The text of every page in the round goes through spaCy in a single batched pass.
         try:
-            scraped = scraper.scrape(url, iterations=iterations)
-            for batch in scraped:
-                # generate_embeddings() returns a tuple containing the semantic, and rhetorical embedddings, as tuples.
-                # The semantic and rhetorical embedding tuples contain the embedding itself, and the article id of
-                # the embeddings.
-
-                # Skips embedding and serialization process if batch of articles is empty.
-                if not batch:
-                    continue
-
-                # Gather up embeddings and serialize pages.
-                embeds = batch.generate_embeddings()
-                pages = batch.serialize()
-                semantic_vecs = embeds.semantic[0][0]
-                semantic_ids = embeds.semantic[0][1]
-                rhetoric_vecs = embeds.rhetoric[0][0]
-                rhetoric_ids = embeds.rhetoric[0][1]
-
-                # Autoencode embeddings
-
-                if save_vectors:
-
-                    with torch.no_grad():
-
-                        sem_autoencoded = semantic_autoencoder.encode(torch.Tensor(semantic_vecs))
-                        rhet_autoencoded = rhetoric_autoencoder.encode(torch.Tensor(rhetoric_vecs))
-
-                    vector_db.insert_vectors(sem_autoencoded, semantic_ids, write_to='semantic')
-                    vector_db.insert_vectors(rhet_autoencoded, rhetoric_ids, write_to='rhetoric')
-
-                for page in pages:
-                    try:
-                        page.save()
-                    except Exception as e:
-                        print(f"Error saving article from {page.page_url}: {e}")
+            batch = ArticleBatch.build((page.url, page.text) for page in new_articles.values())
+        except Exception:
+            release(new_uids, saved=False)
+            raise
+        # Skips embedding and serialization process if batch of articles is empty.
+        if not batch:
+            release(new_uids, saved=False)
+            return None
+        return source, url, new_uids, batch
+
+    def embed_stage(item):
+        # generate_embeddings() returns a tuple containing the semantic, and rhetorical embedddings, as tuples.
+        # The semantic and rhetorical embedding tuples contain the embedding itself, and the article id of
+        # the embeddings.
+        source, url, uids, batch = item
+        try:
+            return source, url, uids, batch, batch.generate_embeddings()
+        except Exception:
+            release(uids, saved=False)
+            raise
+
+    def index_stage(item):
+        # Autoencodes the embeddings and inserts them. This stage has a single worker, since the indexes and their
+        # write-ahead logs take one writer at a time.
+        source, url, uids, batch, embeds = item
+        try:
+            if save_vectors:
+                sem_autoencoded = semantic_autoencoder.encode(embeds.semantic[0][0])
+                rhet_autoencoded = rhetoric_autoencoder.encode(embeds.rhetoric[0][0])
+
+                vector_db.insert_vectors(sem_autoencoded, embeds.semantic[0][1], write_to='semantic')
+                vector_db.insert_vectors(rhet_autoencoded, embeds.rhetoric[0][1], write_to='rhetoric')
+            return source, url, uids, batch.serialize()
+        except Exception:
+            release(uids, saved=False)
+            raise
+
+    def save_stage(item):
+        # All pages of the batch are saved in a single transaction. Pages which are already in the database
+        # are skipped.
+        source, url, uids, pages = item
+        try:
+            db_service.save_models(pages)
         except Exception as e:
-            print(f"Failed to scrape {source}: {e}")
+            logger.log(f"Error saving {len(pages)} articles from {url}: {e}", level="error")
+            release(uids, saved=False)
+            return None
+        release(uids, saved=True)
+        return None
+
+    ingest = pipeline.Pipeline([
+        pipeline.Stage('nlp', nlp_stage, workers=1, queue_size=PIPELINE_QUEUE_SIZE),
+        pipeline.Stage('embed', embed_stage, workers=PIPELINE_EMBED_WORKERS, queue_size=PIPELINE_QUEUE_SIZE),
+        pipeline.Stage('index', index_stage, workers=1, queue_size=PIPELINE_QUEUE_SIZE),
+        pipeline.Stage('save', save_stage, workers=PIPELINE_SAVE_WORKERS, queue_size=PIPELINE_QUEUE_SIZE),
+    ])
+    stats = ingest.run(scheduler.run(sources))
+
+    # Snapshot the indexes, so the vectors logged during this run don't have to be replayed on the next start.
+    vector_db.checkpoint()
+    print(f"Skipped {skipped[0]} already indexed articles.")
+    print_report(stats)
+    _print_embedding_cache_stats()
     if not sources:
         print("No sources found.")
         return
 
 
-def _search(query: str, top_k1: int, top_k2: int):
-    searcher = Searcher(top_k1, top_k2)
-    searcher.search(query)
\ No newline at end of file
+def _encode_training_sample(store, autoencoder, max_samples: int) -> np.ndarray:
+    # Encodes a random sample of the temporary training tensors with the autoencoder, giving latents distributed
+    # like the ones stored in the index.
+    training_sample = store.sample(max_samples)
+    chunks = np.array_split(training_sample, max(1, len(training_sample) // 65536))
+    return np.concatenate([autoencoder.encode(chunk) for chunk in chunks])
+
+
+def _build_index(index_type: str, nlist: int, pq_m: int, hnsw_m: int, max_samples: int):
+    ## Responsible for executing the command `build_index` from the CLI.
+
+    # A new index of the requested type is created for each space. Indexes that need training (the IVF variants)
+    # are trained on the temp tensors produced by `build_temp`. The vectors already in the old index are then moved
+    # over in their original order.
+    from allpress.core.indexes import build_index, train_index
+    from allpress.core.nn import get_vector_db
+    from allpress.services.nn import model_manager
+
+    vector_db = get_vector_db()
+    # Every shard is rewritten, so no other process may be inserting meanwhile.
+    vector_db.acquire_writer()
+    semantic_store, rhetoric_store = _open_temp_stores()
+    with model_manager.get_autoencoders() as autoencoders:
+        sem_autoencoder, rhet_autoencoder = autoencoders
+        for space, store, autoencoder in (
+                (vector_db.semantic, semantic_store, sem_autoencoder),
+                (vector_db.rhetoric, rhetoric_store, rhet_autoencoder)):
+            index = build_index(index_type, space.dim, nlist=nlist, pq_m=pq_m, hnsw_m=hnsw_m)
+            if not index.is_trained:
+                samples = _encode_training_sample(store, autoencoder, max_samples)
+                print(f"Training {space.name} {index_type} index on {len(samples)} vectors.")
+                train_index(index, samples)
+            space.rebuild(index)
+            print(f"Built {space.name} {index_type} index with {space.ntotal} vectors in {len(space.shards)} shards.")
+
+
+def _load_bench_texts(corpus: str, count: int) -> list[str]:
+    # Sentences to benchmark the embedders on. They are taken from the saved pages in `corpus` if given, and from
+    # the pages in the database otherwise.
+    import re
+    if corpus:
+        from bs4 import BeautifulSoup as Soup
+        from glob import glob
+        documents = []
+        for file_path in sorted(glob(path.join(corpus, '*.htm*'))):
+            with open(file_path, 'r', encoding='utf-8', errors='replace') as html_file:
+                soup = Soup(html_file.read(), 'lxml')
+            documents.append(' '.join(p.get_text() for p in soup.find_all('p')))
+    else:
+        documents = [row[0] for row in db_service.fetch_all("SELECT text FROM page LIMIT %s;", (count,))]
+
+    sentences = []
+    for document in documents:
+        sentences += [sentence for sentence in re.split(r'(?<=[.!?])\s+', document) if sentence.strip()]
+        if len(sentences) >= count:
+            break
+    return sentences[:count]
+
+
+def _bench(target: str, space_names: list[str], k: int, queries: int, corpus: str = None, commands: list = None):
+    from allpress.services import bench
+
+    if target == 'index':
+        from allpress.core.nn import get_vector_db
+        vector_db = get_vector_db()
+        report = []
+        for name in space_names:
+            # Every shard is benchmarked on its own.
+            for shard in vector_db.spaces[name].shards:
+                report += bench.bench_index(shard, k=k, n_queries=queries)
+        bench.print_report(report)
+
+    if target == 'detector':
+        if not corpus:
+            print("The detector benchmark needs a directory of saved .html pages, given with --corpus.")
+            return
+        bench.print_report(bench.bench_detector(corpus))
+
+    if target == 'startup':
+        bench.print_report(bench.bench_startup(commands or []))
+
+    if target == 'embedders':
+        texts = _load_bench_texts(corpus, queries)
+        if not texts:
+            print("No texts to embed. Give a directory of saved .html pages with --corpus, or save some pages first.")
+            return
+        bench.print_report(bench.bench_embedders(texts, batch_size=EMBEDDING_BATCH_SIZE))
+
+
+def _search(query: str, top_k1: int, top_k2: int, nprobe: int = None, ef_search: int = None,
+            use_server: bool = True, fast: bool = False):
+    # The query is sent to the search server if one is running, which answers with its models and indexes already
+    # loaded. Otherwise everything is loaded in this process.
+    from allpress.services.server import SearchClient
+
+    client = SearchClient()
+    if use_server and client.is_running():
+        results = client.search(query, top_k1, top_k2, nprobe=nprobe, ef_search=ef_search, fast=fast)
+    else:
+        from allpress.services.search import Searcher
+
+        searcher = Searcher(top_k1, top_k2, nprobe=nprobe, ef_search=ef_search, fast=fast)
+        results = searcher.search(query)
+    for result in results:
+        print(f"{result.article_id}\t{result.distance:.4f}\t{result.semantic:.4f}\t{result.rhetoric:.4f}")
+
+
+def _serve(host: str, port: int):
+    ## Responsible for executing the command `serve` from the CLI.
+    from allpress.services.server import SearchServer
+
+    SearchServer(host, port).serve_forever()
@@ -8,7 +8,7 @@ from allpress.settings import (
 )
 
 from allpress.services.db import db_service
-from allpress.core.models import PageModel, NewsSourceModel
+from allpress.core.models import PageModel, NewsSourceModel, CrawlStateModel
 
 import os
 
@@ -57,15 +57,13 @@ class DBSetup:
         :param db_name: Name of the database to check in.
         :return: True if the table exists, False otherwise.
         """
-        db_service.db.cursor.execute(f"""
+        result = db_service.fetch_one("""
         SELECT EXISTS (
             SELECT 1 
             FROM information_schema.tables 
-            WHERE table_schema = '{db_name}' AND table_name = '{table_name}'
+            WHERE table_schema = %s AND table_name = %s
         ) AS table_exists
-        """)
-
-        result = db_service.db.cursor.fetchone()[0]
+        """, (db_name, table_name))[0]
         return result == 1
     @staticmethod
     def setup_application_tables():
@@ -76,22 +74,32 @@ class DBSetup:
                 table_name=PageModel.model_name,
                 column_names_and_types=PageModel.column_name_type_store,
             )
-            db_service.db.cursor.execute(query)
-
-            db_service.db.connection.commit()
+            db_service.execute(query)
 
         if not DBSetup._check_table_exists('newssource'):
             query = db_service.generate_create_table_query(
                 table_name=NewsSourceModel.model_name,
                 column_names_and_types=NewsSourceModel.column_name_type_store,
             )
-            db_service.db.cursor.execute(query)
-
-            db_service.db.connection.commit()
+            db_service.execute(query)
 
             print('Loading sources from CSV file if available.')
             load_sources_from_csv()
 
+        DBSetup.setup_crawl_state_table()
+
+    @staticmethod
+    def setup_crawl_state_table():
+        # Creates the table holding the crawl state of every source, if it doesn't exist yet. It is also called
+        # before incremental crawls, since it was added after the other tables.
+        if not DBSetup._check_table_exists(CrawlStateModel.model_name):
+            query = db_service.generate_create_table_query(
+                table_name=CrawlStateModel.model_name,
+                column_names_and_types=CrawlStateModel.column_name_type_store,
+            )
+            db_service.execute(query)
+            db_service.execute(f'CREATE INDEX crawlstate_source ON {CrawlStateModel.model_name} (source);')
+
 
 def check_config():
 
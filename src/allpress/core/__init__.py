@@ -1,2 +1,3 @@
 from . import database
-from . import models
\ No newline at end of file
+
+# `models` imports `allpress.services.db`, which imports this package, so it is imported by its users instead.
@@ -0,0 +1,162 @@
+from os import path, makedirs, replace
+
+import faiss
+import numpy as np
+
+from allpress.core.idmap import UID_DTYPE
+from allpress.util import logger
+
+# Ways of pooling the vectors of an article into the single vector of the article index.
+POOLINGS = ('mean', 'max')
+
+
+def pool_vectors(vectors: np.ndarray, pooling: str) -> np.ndarray:
+    """Returns the (dim,) mean or element-wise max of the (n, dim) matrix `vectors`."""
+    if pooling == 'max':
+        return vectors.max(axis=0)
+    return vectors.mean(axis=0)
+
+
+class ArticleIndex:
+    """
+    ArticleIndex: one pooled vector per article, for the articles of a VectorSpace. \n
+    It holds a vector per article rather than per entity or sentence, so a whole query can be answered with a
+    single lookup. The index is derived from the vectors of its space: it is updated as vectors are added, and on
+    startup, the rows added to the space since the last snapshot are pooled in again. \n
+    name: str (Name of the space.) \n
+    dim: int \n
+    directory: str (Where the space is stored.) \n
+    pooling: str ('mean' or 'max'.)
+    """
+
+    def __init__(self, name: str, dim: int, directory: str, pooling: str = 'mean'):
+        if pooling not in POOLINGS:
+            raise ValueError(f"Unknown pooling '{pooling}', expected one of {POOLINGS}")
+        self.name = name
+        self.dim = dim
+        self.pooling = pooling
+        self.directory = directory
+        self.index_path = path.join(directory, f'index_{name}.articles.faiss')
+        self.state_path = path.join(directory, f'index_{name}.articles.npz')
+        self.dirty = False
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self.uids)
+
+    def _reset(self):
+        # Faiss ids are positions in `uids`. The vector count of each article is needed to update its mean.
+        self.index = faiss.IndexIDMap2(faiss.IndexFlatL2(self.dim))
+        self.uids = []
+        self.ids = {}
+        self.counts = np.empty(0, dtype=np.int64)
+        # Number of rows of the space pooled into the index so far.
+        self.rows = 0
+
+    def _load(self):
+        self._reset()
+        if not path.exists(self.index_path) or not path.exists(self.state_path):
+            return
+        index = faiss.read_index(self.index_path)
+        with np.load(self.state_path) as state:
+            uids = np.char.decode(state['uids'], 'ascii').tolist()
+            counts = state['counts']
+            rows = int(state['rows'])
+            pooling = str(state['pooling'])
+
+        # The index and its state are written one after the other. If they don't match, or the pooling has changed,
+        # the index is rebuilt from the space.
+        if pooling != self.pooling or index.ntotal != len(uids) or len(counts) != len(uids):
+            logger.log(f"'{self.name}' article index doesn't match its state, rebuilding it", level="warning")
+            return
+        self.index = index
+        self.uids = uids
+        self.ids = {uid: article_id for article_id, uid in enumerate(uids)}
+        self.counts = counts
+        self.rows = rows
+
+    def add(self, vectors: np.ndarray, uids: list):
+        """Pools `vectors` into the vectors of their articles. `uids` holds the article of every vector."""
+        if len(vectors) == 0:
+            return
+        uids = np.asarray(uids, dtype=str)
+        unique_uids, inverse = np.unique(uids, return_inverse=True)
+        batch_counts = np.bincount(inverse, minlength=len(unique_uids))
+
+        if self.pooling == 'max':
+            pooled = np.full((len(unique_uids), self.dim), -np.inf, dtype=np.float32)
+            np.maximum.at(pooled, inverse, vectors)
+        else:
+            pooled = np.zeros((len(unique_uids), self.dim), dtype=np.float64)
+            np.add.at(pooled, inverse, vectors)
+
+        # Articles already in the index have their stored vector merged with the new ones, and are re-added.
+        article_ids = np.array([self.ids.get(uid, -1) for uid in unique_uids.tolist()], dtype=np.int64)
+        known = article_ids >= 0
+        if known.any():
+            known_ids = article_ids[known]
+            stored = np.vstack([self.index.reconstruct(int(article_id)) for article_id in known_ids])
+            if self.pooling == 'max':
+                pooled[known] = np.maximum(pooled[known], stored)
+            else:
+                pooled[known] += stored * self.counts[known_ids][:, None]
+            self.index.remove_ids(known_ids)
+
+        new = ~known
+        article_ids[new] = np.arange(len(self.uids), len(self.uids) + new.sum())
+        self.uids += unique_uids[new].tolist()
+        self.ids.update(zip(unique_uids[new].tolist(), article_ids[new].tolist()))
+        self.counts = np.concatenate([self.counts, np.zeros(new.sum(), dtype=np.int64)])
+        self.counts[article_ids] += batch_counts
+
+        if self.pooling == 'mean':
+            pooled /= self.counts[article_ids][:, None]
+        self.index.add_with_ids(np.ascontiguousarray(pooled, dtype=np.float32), article_ids)
+        self.rows += len(vectors)
+        self.dirty = True
+
+    def catch_up(self, space, chunk_size: int = 65536):
+        """Pools the rows of `space` added since the index was last written, up to the last row its id map covers.
+        Rows without an article are skipped. Only pools in memory, the writer of the space checkpoints the index."""
+        if self.rows > space.index.ntotal:
+            logger.log(f"'{self.name}' article index is ahead of its space, rebuilding it", level="warning")
+            self._reset()
+        # Rows whose mapping another process has not written yet are left for a later catch up.
+        end = min(space.index.ntotal, len(space.id_map))
+        if self.rows >= end:
+            return
+
+        logger.log(f"Pooling {end - self.rows} '{self.name}' vectors into the article index")
+        for start in range(self.rows, end, chunk_size):
+            rows = np.arange(start, min(start + chunk_size, end))
+            vectors = space.reconstruct(rows)
+            uids = space.id_map.lookup(rows)
+            mapped = np.not_equal(uids, None)
+            self.add(vectors[mapped], uids[mapped].astype(str).tolist())
+            # Unmapped rows are still counted as pooled.
+            self.rows = rows[-1] + 1
+
+    def checkpoint(self):
+        # Writes the index and its state to temporary files first, then swaps both in.
+        if not self.dirty:
+            return
+        makedirs(self.directory, exist_ok=True)
+        faiss.write_index(self.index, f'{self.index_path}.tmp')
+        with open(f'{self.state_path}.tmp', 'wb') as state_file:
+            np.savez(
+                state_file,
+                uids=np.asarray(self.uids, dtype=UID_DTYPE),
+                counts=self.counts,
+                rows=np.int64(self.rows),
+                pooling=np.str_(self.pooling),
+            )
+        replace(f'{self.index_path}.tmp', self.index_path)
+        replace(f'{self.state_path}.tmp', self.state_path)
+        self.dirty = False
+
+    def search(self, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        """Returns the distances and uids of the `k` closest articles to each query. Padding hits have a uid of None."""
+        distances, article_ids = self.index.search(np.ascontiguousarray(queries, dtype=np.float32), k)
+        uids = np.array([[self.uids[article_id] if article_id >= 0 else None for article_id in row]
+                         for row in article_ids.tolist()], dtype=object).reshape(article_ids.shape)
+        return distances, uids
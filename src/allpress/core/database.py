@@ -1,14 +1,40 @@
-import mariadb
-import redis
+from contextlib import contextmanager
+import threading
+import time
+from typing import TYPE_CHECKING
 
-from allpress.settings import DATABASE_USERNAME, DATABASE_PASSWORD, DATABASE_HOST, DATABASE_NAME
+from allpress.settings import (
+    DATABASE_USERNAME,
+    DATABASE_PASSWORD,
+    DATABASE_HOST,
+    DATABASE_NAME,
+    DATABASE_POOL_NAME,
+    DATABASE_POOL_SIZE,
+    DATABASE_POOL_TIMEOUT,
+    REDIS_HOST,
+    REDIS_PORT,
+    REDIS_POOL_SIZE,
+    REDIS_HEALTH_CHECK_INTERVAL,
+)
+
+# The database drivers are imported when the first connection is made, so commands which never touch the database
+# don't pay for them.
+if TYPE_CHECKING:
+    import mariadb
+    import redis
 
 
 class DatabaseManager:
+    """
+    DatabaseManager: process-wide access to the MariaDB and redis connection pools. \n
+    Every operation borrows its own connection and cursor from the pool through `get_connection()` or
+    `get_cursor()`, and returns them when done, so database work can safely run from several threads.
+    """
     _instance = None
-    _connection = None
-    _cursor = None
+    _pool = None
+    _redis_pool = None
     _redis = None
+    _lock = threading.Lock()
 
     def __new__(cls):
         if cls._instance is None:
@@ -16,29 +42,92 @@ class DatabaseManager:
         return cls._instance
 
     @property
-    def connection(self):
-        if self._connection is None:
-            conn_params = {
-                'user': DATABASE_USERNAME,
-                'password': DATABASE_PASSWORD,
-                'host': DATABASE_HOST,
-                'database': DATABASE_NAME
-            }
-            self._connection = mariadb.connect(**conn_params)
-        return self._connection
+    def pool(self) -> 'mariadb.ConnectionPool':
+        # The pool is created on first use. The lock keeps two threads from creating it at the same time.
+        if DatabaseManager._pool is None:
+            with DatabaseManager._lock:
+                if DatabaseManager._pool is None:
+                    import mariadb
+                    conn_params = {
+                        'user': DATABASE_USERNAME,
+                        'password': DATABASE_PASSWORD,
+                        'host': DATABASE_HOST,
+                        'database': DATABASE_NAME
+                    }
+                    DatabaseManager._pool = mariadb.ConnectionPool(
+                        pool_name=DATABASE_POOL_NAME,
+                        pool_size=DATABASE_POOL_SIZE,
+                        **conn_params
+                    )
+        return DatabaseManager._pool
 
-    @property
-    def cursor(self):
-        if self._cursor is None:
-            self._cursor = self.connection.cursor()
-        return self._cursor
+    def _acquire(self) -> 'mariadb.Connection':
+        # Waits up to DATABASE_POOL_TIMEOUT seconds for a free connection. Connections that have gone stale while
+        # sitting in the pool (server restarts, wait_timeout) are reconnected before being handed out.
+        import mariadb
+
+        deadline = time.monotonic() + DATABASE_POOL_TIMEOUT
+        while True:
+            try:
+                connection = self.pool.get_connection()
+                if connection is not None:
+                    break
+            except mariadb.PoolError:
+                pass
+            if time.monotonic() >= deadline:
+                raise mariadb.PoolError(f"No free connection in pool '{DATABASE_POOL_NAME}' "
+                                        f"after {DATABASE_POOL_TIMEOUT} seconds")
+            time.sleep(0.05)
+
+        try:
+            connection.ping()
+        except mariadb.Error:
+            connection.reconnect()
+        return connection
+
+    @contextmanager
+    def get_connection(self):
+        """Borrows a connection from the pool for the duration of the `with` block."""
+        connection = self._acquire()
+        try:
+            yield connection
+        finally:
+            # Closing a pooled connection returns it to the pool.
+            connection.close()
+
+    @contextmanager
+    def get_cursor(self, commit: bool = False):
+        """Borrows a connection and opens a cursor on it for the duration of the `with` block. With `commit`, the
+        transaction is committed when the block exits normally, and rolled back if it raises."""
+        with self.get_connection() as connection:
+            cursor = connection.cursor()
+            try:
+                yield cursor
+                if commit:
+                    connection.commit()
+            except Exception:
+                if commit:
+                    connection.rollback()
+                raise
+            finally:
+                cursor.close()
 
     @property
-    def redis_cursor(self):
-        if self._redis is None:
-            self._redis = redis.Redis(
-                host='localhost',
-                port=6379,
-                decode_responses=True
-            )
-        return self._redis
+    def redis_cursor(self) -> 'redis.Redis':
+        # Redis clients are thread-safe, and take a connection from the pool for each command.
+        if DatabaseManager._redis is None:
+            with DatabaseManager._lock:
+                if DatabaseManager._redis is None:
+                    import redis
+                    # A blocking pool makes commands wait for a free connection instead of failing when all
+                    # REDIS_POOL_SIZE connections are in use.
+                    DatabaseManager._redis_pool = redis.BlockingConnectionPool(
+                        host=REDIS_HOST,
+                        port=REDIS_PORT,
+                        max_connections=REDIS_POOL_SIZE,
+                        timeout=DATABASE_POOL_TIMEOUT,
+                        health_check_interval=REDIS_HEALTH_CHECK_INTERVAL,
+                        decode_responses=True
+                    )
+                    DatabaseManager._redis = redis.Redis(connection_pool=DatabaseManager._redis_pool)
+        return DatabaseManager._redis
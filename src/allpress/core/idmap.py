@@ -0,0 +1,359 @@
+from abc import ABC, abstractmethod
+from os import path, truncate, replace
+import threading
+
+import numpy as np
+
+from allpress.util import logger
+
+# Article uids are md5 hex digests, so every slot of the memory-mapped id map is exactly 32 bytes wide.
+UID_WIDTH = 32
+UID_DTYPE = np.dtype(f'S{UID_WIDTH}')
+
+# Records of the reverse index of a memory-mapped id map: `count` consecutive rows from `start` belong to `uid`.
+RUN_DTYPE = np.dtype([('uid', UID_DTYPE), ('start', '<i8'), ('count', '<i8')])
+
+
+def _batch_runs(uids: list, start: int) -> list[list]:
+    # Splits the rows `start`, `start + 1`, ... mapped to `uids` into runs of consecutive rows of the same article.
+    # Returns [uid, first row, row count] for every run. Unmapped rows are skipped.
+    runs = []
+    for row, uid in enumerate(uids, start=start):
+        if not uid:
+            continue
+        if runs and runs[-1][0] == uid and runs[-1][1] + runs[-1][2] == row:
+            runs[-1][2] += 1
+        else:
+            runs.append([uid, row, 1])
+    return runs
+
+
+def _add_runs(index: dict, runs: list[list]):
+    for uid, start, count in runs:
+        index.setdefault(uid, []).append((start, count))
+
+
+class IdMap(ABC):
+    """
+    IdMap: maps the rows of a FAISS index to the uids of the articles the vectors came from. \n
+    Rows are only ever appended, in the same order as the vectors are added to the index, so the n-th
+    uid in the map always belongs to the n-th vector of the index. \n
+    Rows can also be looked up by uid. Each map keeps a reverse index of the runs of consecutive rows of every
+    article, which is updated as rows are appended, and only read for the uids looked up.
+    """
+
+    def __init__(self):
+        self._runs_lock = threading.Lock()
+
+    @abstractmethod
+    def __len__(self) -> int:
+        """Returns the number of mapped rows."""
+
+    @abstractmethod
+    def append(self, uids: list[str]):
+        """Appends the uids of newly added vectors to the end of the map."""
+
+    @abstractmethod
+    def lookup(self, rows: np.ndarray) -> np.ndarray:
+        """Returns an object array with the uid of each row, or None for rows that are not mapped."""
+
+    @abstractmethod
+    def truncate(self, size: int):
+        """Drops every mapping from row `size` onward."""
+
+    def repair(self):
+        """Fixes what an interrupted append left behind. Only called by the process writing to the map."""
+
+    @abstractmethod
+    def _runs_for(self, uids: list[str]) -> list[list[tuple[int, int]]]:
+        """
+        Returns the (first row, row count) runs of every uid in `uids`, in row order. They may extend past the rows
+        this map holds, when another process has appended to it since.
+        """
+
+    def rows_for(self, uids: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        """
+        Returns the rows of every vector of the articles in `uids`, and for each row, the position in `uids` of the
+        article it belongs to. Rows are grouped by article, in the order of `uids`.
+        """
+        size = len(self)
+        rows = [np.empty(0, dtype=np.int64)]
+        owners = [np.empty(0, dtype=np.int64)]
+        with self._runs_lock:
+            runs = self._runs_for(uids)
+        for position, uid_runs in enumerate(runs):
+            for start, count in uid_runs:
+                end = min(start + count, size)
+                if start < end:
+                    rows.append(np.arange(start, end, dtype=np.int64))
+                    owners.append(np.full(end - start, position, dtype=np.int64))
+        return np.concatenate(rows), np.concatenate(owners)
+
+
+class MemmapIdMap(IdMap):
+    """
+    MemmapIdMap: append-only file of fixed-width uid slots stored next to the FAISS index. \n
+    The file is memory-mapped for lookups, so resolving a row is a single array index with no network hop. The runs
+    of rows of every article are appended to a second file, `<file_path>.runs`, as the map grows.
+    """
+
+    def __init__(self, file_path: str):
+        super().__init__()
+        self.file_path = file_path
+        self.runs_path = f'{file_path}.runs'
+        self._slots = None
+        self._size = 0
+
+        # Runs by uid, read from the runs file as it grows. `_runs_read` records of it have been read, and every row
+        # before `_covered` is indexed.
+        self._runs = {}
+        self._runs_read = 0
+        self._covered = 0
+
+        # A partially written slot, being appended by another process or left by an interrupted append, is ignored.
+        if path.exists(file_path):
+            self._size = path.getsize(file_path) // UID_WIDTH
+
+    def __len__(self) -> int:
+        return self._size
+
+    def repair(self):
+        # A partially written slot can only be the result of an interrupted append, so it is dropped, and so is a
+        # partially written runs record.
+        if path.exists(self.file_path) and path.getsize(self.file_path) % UID_WIDTH:
+            logger.log(f"Dropping partial slot at the end of {self.file_path}", level="warning")
+            truncate(self.file_path, self._size * UID_WIDTH)
+        self._runs_file_end()
+
+    def _map(self) -> np.ndarray:
+        # The memory map is reopened lazily whenever the file has grown since it was last mapped.
+        if self._slots is None or len(self._slots) != self._size:
+            if self._size == 0:
+                self._slots = np.empty(0, dtype=UID_DTYPE)
+            else:
+                self._slots = np.memmap(self.file_path, dtype=UID_DTYPE, mode='r', shape=(self._size,))
+        return self._slots
+
+    def append(self, uids: list[str]):
+        slots = np.asarray(uids, dtype=UID_DTYPE)
+        start = self._size
+        with open(self.file_path, 'ab') as id_file:
+            id_file.write(slots.tobytes())
+        self._size += len(slots)
+
+        # The runs of the new rows are written after the rows. Rows left out of the runs file, by a map written
+        # before it existed or by an append interrupted in between, are indexed first.
+        indexed = self._runs_file_end()
+        runs = _batch_runs(self._map()[indexed:start].tolist(), indexed) if indexed < start else []
+        runs += _batch_runs(slots.tolist(), start)
+        records = np.array([tuple(run) for run in runs], dtype=RUN_DTYPE)
+        with open(self.runs_path, 'ab') as runs_file:
+            runs_file.write(records.tobytes())
+
+    def _runs_file_end(self) -> int:
+        # Returns the row after the last one in the runs file. A partially written record is dropped.
+        if not path.exists(self.runs_path):
+            return 0
+        file_size = path.getsize(self.runs_path)
+        if file_size % RUN_DTYPE.itemsize:
+            logger.log(f"Dropping partial record at the end of {self.runs_path}", level="warning")
+            file_size -= file_size % RUN_DTYPE.itemsize
+            truncate(self.runs_path, file_size)
+        if file_size == 0:
+            return 0
+        last = np.fromfile(self.runs_path, dtype=RUN_DTYPE, count=1, offset=file_size - RUN_DTYPE.itemsize)[0]
+        return int(last['start'] + last['count'])
+
+    def _runs_for(self, uids: list[str]) -> list[list[tuple[int, int]]]:
+        # Reads the records appended since the last call. Rows past the end of the runs file are indexed from the
+        # slots, in memory only.
+        if path.exists(self.runs_path):
+            records = path.getsize(self.runs_path) // RUN_DTYPE.itemsize
+            if records > self._runs_read:
+                new = np.fromfile(self.runs_path, dtype=RUN_DTYPE, count=records - self._runs_read,
+                                  offset=self._runs_read * RUN_DTYPE.itemsize)
+                self._runs_read = records
+                for uid, start, count in new.tolist():
+                    end = start + count
+                    start = max(start, self._covered)
+                    if start < end:
+                        _add_runs(self._runs, [[uid, start, end - start]])
+                        self._covered = end
+        if self._covered < self._size:
+            _add_runs(self._runs, _batch_runs(self._map()[self._covered:self._size].tolist(), self._covered))
+            self._covered = self._size
+
+        keys = np.asarray(uids, dtype=UID_DTYPE).tolist()
+        return [self._runs.get(key, []) for key in keys]
+
+    def lookup(self, rows: np.ndarray) -> np.ndarray:
+        rows = np.asarray(rows, dtype=np.int64)
+        uids = np.full(len(rows), None, dtype=object)
+        valid = (rows >= 0) & (rows < self._size)
+        if valid.any():
+            uids[valid] = np.char.decode(self._map()[rows[valid]], 'ascii')
+        return uids
+
+    def truncate(self, size: int):
+        if size >= self._size:
+            return
+        self._slots = None
+        truncate(self.file_path, size * UID_WIDTH)
+        self._size = size
+
+        # Runs of the dropped rows are cut from the runs file, which is then read again from the start.
+        if path.exists(self.runs_path):
+            records = np.fromfile(self.runs_path, dtype=RUN_DTYPE)
+            records = records[records['start'] < size]
+            records['count'] = np.minimum(records['count'], size - records['start'])
+            with open(f'{self.runs_path}.tmp', 'wb') as runs_file:
+                runs_file.write(records.tobytes())
+            replace(f'{self.runs_path}.tmp', self.runs_path)
+        with self._runs_lock:
+            self._runs = {}
+            self._runs_read = 0
+            self._covered = 0
+
+
+class RedisIdMap(IdMap):
+    """
+    RedisIdMap: stores the row to uid mappings in a redis hash, keyed by the row number. This was the
+    only backend before the memory-mapped id map was added, and is kept for deployments that share
+    one redis instance between several hosts. The runs of rows of every article are kept in a second hash,
+    `<hash_name>:runs`, as "first:count" pairs separated by ";", and the number of rows they cover in
+    `<hash_name>:runs:rows`.
+    """
+
+    def __init__(self, hash_name: str):
+        super().__init__()
+        self.hash_name = hash_name
+        self.runs_name = f'{hash_name}:runs'
+        self.runs_rows_name = f'{hash_name}:runs:rows'
+        # Runs of the rows missing from the runs hash, indexed in memory, and the row count they were indexed at.
+        self._tail = (0, {})
+
+    @property
+    def _redis(self):
+        from allpress.services.db import db_service
+        return db_service.db.redis_cursor
+
+    def __len__(self) -> int:
+        return self._redis.hlen(self.hash_name)
+
+    def append(self, uids: list[str]):
+        if not uids:
+            return
+        start = len(self)
+        self._redis.hset(
+            name=self.hash_name,
+            mapping={str(start + i): uid for i, uid in enumerate(uids)}
+        )
+        # Rows left out of the runs hash, by a map written before it existed, are indexed first.
+        indexed = int(self._redis.get(self.runs_rows_name) or 0)
+        if indexed < start:
+            self._store_runs(self._tail_runs(indexed, start), start)
+        self._store_runs(_batch_runs(list(uids), start), start + len(uids))
+
+    def _tail_runs(self, start: int, end: int, chunk_size: int = 65536) -> list[list]:
+        runs = []
+        for chunk_start in range(start, end, chunk_size):
+            rows = np.arange(chunk_start, min(chunk_start + chunk_size, end))
+            runs += _batch_runs(self.lookup(rows).tolist(), chunk_start)
+        return runs
+
+    def _store_runs(self, runs: list[list], rows: int):
+        # Appends `runs` to the runs of their uids, and records that the first `rows` rows are indexed.
+        by_uid = {}
+        for uid, start, count in runs:
+            by_uid.setdefault(uid, []).append(f'{start}:{count}')
+        pipeline = self._redis.pipeline()
+        if by_uid:
+            stored = self._redis.hmget(self.runs_name, list(by_uid))
+            pipeline.hset(self.runs_name, mapping={
+                uid: ';'.join(([old] if old else []) + new) for (uid, new), old in zip(by_uid.items(), stored)
+            })
+        pipeline.set(self.runs_rows_name, rows)
+        pipeline.execute()
+
+    def _runs_for(self, uids: list[str]) -> list[list[tuple[int, int]]]:
+        # Rows past those of the runs hash are indexed from the map, in memory only, until a writer stores them.
+        if not uids:
+            return []
+        indexed = int(self._redis.get(self.runs_rows_name) or 0)
+        size = len(self)
+        if indexed < size:
+            if self._tail[0] != size:
+                tail = {}
+                _add_runs(tail, self._tail_runs(indexed, size))
+                self._tail = (size, tail)
+        else:
+            self._tail = (0, {})
+
+        runs = []
+        for uid, stored in zip(uids, self._redis.hmget(self.runs_name, list(uids))):
+            uid_runs = [tuple(int(part) for part in run.split(':')) for run in stored.split(';')] if stored else []
+            runs.append(uid_runs + [run for run in self._tail[1].get(uid, []) if run[0] >= indexed])
+        return runs
+
+    def lookup(self, rows: np.ndarray) -> np.ndarray:
+        rows = np.asarray(rows, dtype=np.int64)
+        if len(rows) == 0:
+            return np.array([], dtype=object)
+        return np.array(self._redis.hmget(self.hash_name, [str(row) for row in rows.tolist()]), dtype=object)
+
+    def truncate(self, size: int):
+        current_size = len(self)
+        if size < current_size:
+            # Runs of the dropped rows are cut from the runs of their articles.
+            dropped = list({uid for uid in self.lookup(np.arange(size, current_size)).tolist() if uid})
+            if dropped:
+                kept = {}
+                for uid, uid_runs in zip(dropped, self._runs_for(list(dropped))):
+                    kept[uid] = ';'.join(f'{start}:{min(count, size - start)}' for start, count in uid_runs
+                                         if start < size)
+                pipeline = self._redis.pipeline()
+                for uid, stored in kept.items():
+                    if stored:
+                        pipeline.hset(self.runs_name, uid, stored)
+                    else:
+                        pipeline.hdel(self.runs_name, uid)
+                pipeline.execute()
+            indexed = int(self._redis.get(self.runs_rows_name) or 0)
+            self._redis.set(self.runs_rows_name, min(indexed, size))
+            self._redis.hdel(self.hash_name, *[str(row) for row in range(size, current_size)])
+            self._tail = (0, {})
+
+
+def open_id_map(backend: str, name: str, file_path: str) -> IdMap:
+    # Returns the id map for the vector space `name`. Memory-mapped maps are migrated from the legacy redis hash
+    # the first time they are opened, if one exists.
+    if backend == 'redis':
+        return RedisIdMap(name)
+    elif backend == 'memmap':
+        id_map = MemmapIdMap(file_path)
+        if len(id_map) == 0:
+            _migrate_from_redis(name, id_map)
+        return id_map
+    else:
+        raise ValueError(f"Unknown id map backend '{backend}'")
+
+
+def _migrate_from_redis(name: str, id_map: MemmapIdMap, chunk_size: int = 65536):
+    try:
+        legacy = RedisIdMap(name)
+        legacy_size = len(legacy)
+    except Exception as e:
+        logger.log(f"Could not check redis for a legacy '{name}' id map: {e}", level="debug")
+        return
+
+    if legacy_size == 0:
+        return
+
+    logger.log(f"Migrating {legacy_size} '{name}' id mappings from redis to {id_map.file_path}")
+    for start in range(0, legacy_size, chunk_size):
+        rows = np.arange(start, min(start + chunk_size, legacy_size))
+        uids = legacy.lookup(rows)
+        if any(uid is None for uid in uids):
+            logger.log(f"Legacy '{name}' id map has gaps, migration stopped at row {start}", level="warning")
+            return
+        id_map.append(uids.tolist())
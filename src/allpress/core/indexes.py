@@ -0,0 +1,71 @@
+import faiss
+import numpy as np
+
+# Index types that can be built by `build_index`. 'flat' is an exact brute-force index, the others are approximate.
+# The IVF variants have to be trained on a sample of vectors before anything can be added to them.
+INDEX_TYPES = ('flat', 'ivf_flat', 'ivf_pq', 'hnsw')
+
+
+def build_index(index_type: str, dim: int, nlist: int = 4096, pq_m: int = 16, hnsw_m: int = 32) -> faiss.Index:
+    """
+    Creates a new, empty FAISS index. \n
+    index_type: str (One of INDEX_TYPES.) \n
+    dim: int (Dimension of the vectors stored in the index.) \n
+    nlist: int (Number of IVF cells. Used by 'ivf_flat' and 'ivf_pq'.) \n
+    pq_m: int (Number of PQ sub-quantizers, must divide `dim`. Used by 'ivf_pq'.) \n
+    hnsw_m: int (Number of neighbours per HNSW node. Used by 'hnsw'.)
+    """
+    if index_type == 'flat':
+        return faiss.IndexFlatL2(dim)
+    elif index_type == 'ivf_flat':
+        return faiss.index_factory(dim, f'IVF{nlist},Flat')
+    elif index_type == 'ivf_pq':
+        if dim % pq_m:
+            raise ValueError(f"PQ sub-quantizer count {pq_m} does not divide dimension {dim}")
+        return faiss.index_factory(dim, f'IVF{nlist},PQ{pq_m}')
+    elif index_type == 'hnsw':
+        return faiss.index_factory(dim, f'HNSW{hnsw_m},Flat')
+    else:
+        raise ValueError(f"Unknown index type '{index_type}', expected one of {INDEX_TYPES}")
+
+
+def train_index(index: faiss.Index, samples: np.ndarray):
+    # Trains the coarse quantizer (and PQ codebooks) of an IVF index. Indexes which need no training are left as is.
+    if index.is_trained:
+        return
+    samples = np.ascontiguousarray(samples, dtype=np.float32)
+    ivf = faiss.extract_index_ivf(index)
+    if len(samples) < ivf.nlist:
+        raise ValueError(f"{len(samples)} training vectors are not enough for {ivf.nlist} IVF cells")
+    index.train(samples)
+
+
+def search_parameters(index: faiss.Index, nprobe: int = None, ef_search: int = None):
+    # Returns the FAISS search parameters for a single query, or None if the index has nothing to tune. Passing the
+    # parameters with each search, instead of setting them on the index, keeps concurrent searches independent.
+    try:
+        faiss.extract_index_ivf(index)
+        return faiss.SearchParametersIVF(nprobe=nprobe) if nprobe else None
+    except RuntimeError:
+        pass
+    if isinstance(index, faiss.IndexHNSW):
+        return faiss.SearchParametersHNSW(efSearch=ef_search) if ef_search else None
+    return None
+
+
+def enable_reconstruction(index: faiss.Index):
+    # IVF indexes can only reconstruct vectors by row once their direct map has been built.
+    try:
+        ivf = faiss.extract_index_ivf(index)
+    except RuntimeError:
+        return
+    ivf.make_direct_map()
+
+
+def describe_index(index: faiss.Index) -> str:
+    # Short human readable description of an index, for logs and benchmark reports.
+    try:
+        ivf = faiss.extract_index_ivf(index)
+        return f'{type(index).__name__}(nlist={ivf.nlist}, ntotal={index.ntotal})'
+    except RuntimeError:
+        return f'{type(index).__name__}(ntotal={index.ntotal})'
@@ -4,6 +4,11 @@ from allpress.services.db import db_service
 from allpress.util import logger
 
 
+def text_uid(text: str) -> str:
+    """Returns the uid of a page with the text `text`: the md5 hex digest of the text."""
+    return md5(text.encode('utf-8')).hexdigest()
+
+
 class BaseModel:
 
     def __init__(self, **columns):
@@ -21,14 +26,11 @@ class BaseModel:
                 for k in self.__class__.column_names}
 
     def verify_primary_key(self, pk_column_name, pk):
+        # Returns True if no row with the primary key `pk` exists yet.
         table_name = self.__class__.__name__.lower().replace("model", "")
-        primary_key_select = f'SELECT {pk_column_name} FROM {table_name} WHERE {pk_column_name} = "{pk}"'
-        db_service.db.cursor.execute(primary_key_select)
-        primary_key = db_service.db.cursor.fetchone()
-        if primary_key == pk:
-            return False
-        else:
-            return True
+        primary_key_select = f'SELECT {pk_column_name} FROM {table_name} WHERE {pk_column_name} = %s'
+        primary_key = db_service.fetch_one(primary_key_select, (pk,))
+        return primary_key is None
 
 
     def save(self):
@@ -71,12 +73,9 @@ class PageModel(BaseModel):
     def __init__(self, **columns):
         super().__init__(**columns)
 
-        # Creates MD5 hash object to generate a unique UUID for the Page object.
+        # The uid of a page is the MD5 hash of its text.
         # MD5 has a low chance of collisions. Perhaps use a different algorithm in the future?
-        hashobj = md5()
-        hashobj.update(bytes(str(self.page_text).encode('utf-8')))
-        uid = hashobj.hexdigest()
-        self.page_uid = uid
+        self.page_uid = text_uid(str(self.page_text))
 
     def __str__(self):
         return f'<{self.url}...>'
@@ -128,3 +127,42 @@ class NewsSourceModel(BaseModel):
         NewsSourceModel class. A dictionary generator is used to find all attributes"""
         return {k: getattr(self, f'{self.__class__.__name__.lower().replace("model", "")}_{k}')
                 for k in self.__class__.column_names}
+
+
+class CrawlStateModel(BaseModel):
+    """
+    CrawlStateModel: is the class which models the `crawlstate` table in the MariaDB database. \n
+    Each row holds what the crawler knows of one url of a news source: the validators (ETag and \n
+    Last-Modified) its server sent, the hash of its content, when it was last fetched, and whether \n
+    it is pending, i.e. found but not fetched yet. Pending urls make up the crawl frontier, which \n
+    the next crawl of the source starts from.
+    """
+    model_name = 'crawlstate'
+
+    column_name_type_store = {
+        'urlhash': 'VARCHAR(32) PRIMARY KEY',  # MD5 hash of the url, which can be too long for a key
+        'source': 'VARCHAR(768)',  # Url of the news source the page belongs to
+        'url': 'VARCHAR(2048)',
+        'etag': 'VARCHAR(512)',
+        'lastmodified': 'VARCHAR(64)',
+        'contenthash': 'VARCHAR(32)',
+        'lastseen': 'DOUBLE',  # Unix time of the last response
+        'pending': 'BOOLEAN',
+    }
+    column_names = [
+        'urlhash',
+        'source',
+        'url',
+        'etag',
+        'lastmodified',
+        'contenthash',
+        'lastseen',
+        'pending',
+    ]
+
+    def __init__(self, **columns):
+        super().__init__(**columns)
+        self.crawlstate_urlhash = text_uid(self.crawlstate_url)
+
+    def __str__(self):
+        return f'<{self.crawlstate_url}...>'
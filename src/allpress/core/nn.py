@@ -1,55 +1,594 @@
-from os import path
+from concurrent.futures import ThreadPoolExecutor
+from os import path, makedirs, replace, stat
+import atexit
+from hashlib import blake2b
+import json
+import threading
+import time
+from typing import TYPE_CHECKING
 
 import faiss
 import numpy as np
-from torch import Tensor
 
+from allpress.core.articleindex import ArticleIndex
+from allpress.core.idmap import open_id_map
+from allpress.core.indexes import build_index, enable_reconstruction, search_parameters, describe_index
+from allpress.core.wal import VectorLog
+from allpress.settings import (
+    FAISS_INDEX_PATH,
+    ID_MAP_BACKEND,
+    FAISS_INDEX_TYPE,
+    FAISS_IVF_NLIST,
+    FAISS_PQ_M,
+    FAISS_HNSW_M,
+    FAISS_NPROBE,
+    FAISS_EF_SEARCH,
+    VECTORDB_WAL,
+    VECTORDB_WAL_FSYNC,
+    VECTORDB_CHECKPOINT_VECTORS,
+    VECTORDB_CHECKPOINT_SECONDS,
+    VECTORDB_ARTICLE_INDEX,
+    ARTICLE_INDEX_POOLING,
+    VECTORDB_SHARD_SIZE,
+    VECTORDB_SEARCH_THREADS,
+)
+from allpress.util import logger, try_file_lock, release_file_lock, is_file_locked
 
-from allpress.services.db import db_service
-from allpress.settings import FAISS_INDEX_PATH
+if TYPE_CHECKING:
+    from torch import Tensor
+
+
+def _as_faiss_array(embeddings) -> np.ndarray:
+    # FAISS only accepts contiguous float32 matrices.
+    # Tensors are recognized without importing torch, which this module otherwise doesn't need.
+    if hasattr(embeddings, 'detach'):
+        embeddings = embeddings.detach().cpu().numpy()
+    return np.ascontiguousarray(embeddings, dtype=np.float32)
+
+
+def _disk_state(name: str) -> tuple:
+    # Size and modification time of the snapshot and of the log of the space `name`. Vectors are only ever appended
+    # to the log, and it is only emptied after a new snapshot has been written, so any change to the contents of the
+    # space on disk changes them.
+    state = []
+    for suffix in ('faiss', 'wal'):
+        file_path = path.join(FAISS_INDEX_PATH, f'index_{name}.{suffix}')
+        if path.exists(file_path):
+            file_stat = stat(file_path)
+            state += [file_stat.st_size, file_stat.st_mtime_ns]
+        else:
+            state += [0, 0]
+    return tuple(state)
+
+
+class VectorSpace:
+
+    def __init__(self, name: str, dim: int, template: faiss.Index = None, sealed: bool = False):
+        # A VectorSpace is one FAISS index, together with the id map that links every row of the index to the
+        # article it came from, and the write-ahead log of vectors added since the index was last snapshotted.
+        # All of them are stored side by side in FAISS_INDEX_PATH. Every shard of a ShardedSpace is a VectorSpace.
+        # Opening a space only reads its files, since another process may be writing them. A space is only written
+        # to once `open_for_writing` has been called, by the process holding the writer lock of the VectorDB. A space
+        # opened `sealed` was snapshotted when it was sealed, and is never written to again.
+        self.name = name
+        self.dim = dim
+        self.index_path = path.join(FAISS_INDEX_PATH, f'index_{name}.faiss')
+        self.id_map_path = path.join(FAISS_INDEX_PATH, f'index_{name}.ids')
+        self.wal_path = path.join(FAISS_INDEX_PATH, f'index_{name}.wal')
+
+        # Loads the faiss index from disk if it exists. Else, it makes a new empty one, like `template` (an empty,
+        # trained index) if given, and of the configured type otherwise.
+        if path.exists(self.index_path):
+            self.index = faiss.read_index(self.index_path)
+        elif template is not None:
+            self.index = faiss.clone_index(template)
+        else:
+            self.index = build_index(FAISS_INDEX_TYPE, dim, FAISS_IVF_NLIST, FAISS_PQ_M, FAISS_HNSW_M)
+        self.id_map = open_id_map(ID_MAP_BACKEND, name, self.id_map_path)
+
+        # On-disk state of the files the index in memory matches, see `_disk_state`. Set once the space is loaded,
+        # and after every change made by this process.
+        self.state = None
+        # A sealed space is read-only. Only the last shard of a ShardedSpace takes new vectors.
+        self.sealed = False
+        self.writable = False
+        # Whether stored vectors can be read back by row. IVF indexes need a direct map for that, built on demand.
+        self._reconstructable = False
+        self._reconstruct_lock = threading.Lock()
+
+        # Vectors added since the last snapshot, and when that snapshot was taken.
+        self.pending = 0
+        self.last_checkpoint = time.monotonic()
+
+        self.wal = VectorLog(self.wal_path, dim, sync=VECTORDB_WAL_FSYNC)
+        self._replay()
+
+        # The article-level index of pooled vectors is brought up to date with the rows replayed above.
+        self.articles = None
+        if VECTORDB_ARTICLE_INDEX:
+            self.articles = ArticleIndex(name, dim, FAISS_INDEX_PATH, pooling=ARTICLE_INDEX_POOLING)
+            self.articles.catch_up(self)
+
+        if sealed:
+            self.sealed = True
+            self.wal = None
+        self.state = self.disk_state()
+
+    def open_for_writing(self):
+        # Called by the process holding the writer lock, before it adds to the space. Repairs what an interrupted
+        # writer may have left behind: the incomplete record at the end of the log, partial id map slots, rows of
+        # the index missing from the id map, and id map rows missing from the index.
+        if self.writable or self.sealed:
+            return
+        makedirs(FAISS_INDEX_PATH, exist_ok=True)
+        self.wal.repair()
+        self.id_map.repair()
+        # The id map is appended right after the log, so it may be missing the tail of the last record.
+        for start_row, vectors, uids in self.wal.replay():
+            mapped = len(self.id_map)
+            end_row = start_row + len(vectors)
+            if start_row <= mapped < end_row <= self.index.ntotal:
+                self.id_map.append(uids[mapped - start_row:])
+        self._reconcile()
+        if self.articles is not None:
+            self.articles.catch_up(self)
+            self.articles.checkpoint()
+        self.writable = True
+
+        if not VECTORDB_WAL:
+            # A log left behind by a run with the WAL enabled is folded into the snapshot, and no longer written to.
+            self.checkpoint()
+            self.wal = None
+        self.state = self.disk_state()
+
+    def _replay(self) -> int:
+        # Adds the vectors logged since the last snapshot back into the index. Records that were already part of the
+        # snapshot (the log is only reset after the snapshot has been written) are skipped.
+        replayed = 0
+        if not self.index.is_trained:
+            return replayed
+        for start_row, vectors, uids in self.wal.replay():
+            end_row = start_row + len(vectors)
+            if end_row <= self.index.ntotal:
+                continue
+            if start_row != self.index.ntotal:
+                logger.log(f"'{self.name}' log starts at row {start_row}, index has {self.index.ntotal} rows. "
+                           f"Replay stopped.", level="error")
+                break
+
+            self.index.add(vectors)
+            replayed += len(vectors)
+
+        if replayed:
+            logger.log(f"Replayed {replayed} '{self.name}' vectors from {self.wal_path}")
+            self.pending += replayed
+        return replayed
+
+    def _reconcile(self):
+        # An insert interrupted before its vectors were logged or snapshotted can leave the id map with more rows
+        # than the index. Those rows never made it into the index and are dropped.
+        mapped = len(self.id_map)
+        if mapped > self.index.ntotal:
+            logger.log(f"Dropping {mapped - self.index.ntotal} unindexed '{self.name}' id mappings", level="warning")
+            self.id_map.truncate(self.index.ntotal)
+        elif mapped < self.index.ntotal:
+            logger.log(f"'{self.name}' index has {self.index.ntotal - mapped} vectors without an article id",
+                       level="warning")
+
+    def add(self, embeddings, ids: list):
+        # Logs the new vectors, maps the new rows to their articles, and adds the embeddings to the index. With the
+        # write-ahead log enabled, a full snapshot of the index is only written every VECTORDB_CHECKPOINT_VECTORS
+        # vectors or VECTORDB_CHECKPOINT_SECONDS seconds. Without it, the index is written on every insert.
+        embeddings = _as_faiss_array(embeddings)
+        if len(embeddings) == 0:
+            return
+        if self.sealed:
+            raise RuntimeError(f"'{self.name}' is sealed and takes no new vectors.")
+        if not self.writable:
+            raise RuntimeError(f"'{self.name}' is open read-only. Only the writer of the VectorDB adds vectors.")
+        if not self.index.is_trained:
+            raise RuntimeError(f"'{self.name}' index is untrained. Run the `build_index` command first.")
+        makedirs(FAISS_INDEX_PATH, exist_ok=True)
+
+        ids = list(ids)
+        if self.wal:
+            self.wal.append(self.index.ntotal, embeddings, ids)
+        self.id_map.append(ids)
+        self.index.add(embeddings)
+        if self.articles is not None:
+            self.articles.add(embeddings, ids)
+        self.pending += len(embeddings)
+
+        if not self.wal \
+                or self.pending >= VECTORDB_CHECKPOINT_VECTORS \
+                or time.monotonic() - self.last_checkpoint >= VECTORDB_CHECKPOINT_SECONDS:
+            self.checkpoint()
+        self.state = self.disk_state()
+
+    @property
+    def ntotal(self) -> int:
+        return self.index.ntotal
+
+    def disk_state(self) -> tuple:
+        return _disk_state(self.name)
+
+    def seal(self):
+        # Snapshots the index, so nothing is left to replay, and makes the space read-only.
+        self.checkpoint(force=True)
+        self.sealed = True
+        self.wal = None
+
+    def checkpoint(self, force: bool = False):
+        # Writes a full snapshot of the index, then empties the log. The snapshot is written to a temporary file
+        # first, so a crash while writing never leaves a corrupted index behind.
+        if self.pending or force:
+            makedirs(FAISS_INDEX_PATH, exist_ok=True)
+            temp_path = f'{self.index_path}.tmp'
+            faiss.write_index(self.index, temp_path)
+            replace(temp_path, self.index_path)
+            # The article index is written before the log is emptied, so it never covers rows the log can't replay.
+            if self.articles is not None:
+                self.articles.checkpoint()
+            if self.wal:
+                self.wal.reset()
+            logger.log(f"Checkpointed '{self.name}' index with {self.index.ntotal} vectors", level="debug")
+            self.state = self.disk_state()
+        self.pending = 0
+        self.last_checkpoint = time.monotonic()
+
+    def rebuild(self, index: faiss.Index, chunk_size: int = 65536):
+        # Replaces the index of this space with `index`, which must be trained and empty, and copies every vector
+        # over in the same row order, so the id map stays valid. Vectors of a PQ index are only approximations of
+        # the originals, so rebuilding from one loses precision.
+        enable_reconstruction(self.index)
+        for start in range(0, self.index.ntotal, chunk_size):
+            count = min(chunk_size, self.index.ntotal - start)
+            index.add(self.index.reconstruct_n(start, count))
+        logger.log(f"Rebuilt '{self.name}' index as {describe_index(index)}")
+        self.index = index
+        self._reconstructable = False
+        self.checkpoint(force=True)
+
+    def search(self,
+               queries: np.ndarray,
+               k: int,
+               nprobe: int = FAISS_NPROBE,
+               ef_search: int = FAISS_EF_SEARCH) -> tuple[np.ndarray, np.ndarray]:
+        # Searches the index with every query at once. Returns the distances and the article uids of the hits, both
+        # shaped (len(queries), k). Padding hits and unmapped rows have a uid of None. `nprobe` (IVF indexes) and
+        # `ef_search` (HNSW indexes) trade recall for speed, and are ignored by the flat index.
+        params = search_parameters(self.index, nprobe=nprobe, ef_search=ef_search)
+        distances, rows = self.index.search(_as_faiss_array(queries), k, params=params)
+        unique_rows, inverse = np.unique(rows, return_inverse=True)
+        uids = self.id_map.lookup(unique_rows)[inverse].reshape(rows.shape)
+        return distances, uids
+
+
+    def rows_for(self, uids: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        # Rows of every vector of the articles in `uids`. See IdMap.rows_for. Rows mapped by another process but not
+        # part of this index yet are left out.
+        rows, owners = self.id_map.rows_for(uids)
+        in_index = rows < self.index.ntotal
+        return rows[in_index], owners[in_index]
+
+    def reconstruct(self, rows: np.ndarray) -> np.ndarray:
+        # Returns the stored vectors of `rows`, as a (len(rows), dim) matrix. Vectors of a PQ index are only the
+        # approximations kept in its codes.
+        with self._reconstruct_lock:
+            if not self._reconstructable:
+                enable_reconstruction(self.index)
+                self._reconstructable = True
+        if len(rows) == 0:
+            return np.empty((0, self.dim), dtype=np.float32)
+        return self.index.reconstruct_batch(np.asarray(rows, dtype=np.int64))
+
+
+_search_pool = None
+_search_pool_lock = threading.Lock()
+
+
+def _get_search_pool() -> ThreadPoolExecutor:
+    # Threads searching the shards of a space in parallel. FAISS releases the GIL while it searches.
+    global _search_pool
+    with _search_pool_lock:
+        if _search_pool is None:
+            _search_pool = ThreadPoolExecutor(max_workers=VECTORDB_SEARCH_THREADS, thread_name_prefix='shard-search')
+        return _search_pool
+
+
+def _merge_top_k(results: list[tuple[np.ndarray, np.ndarray]], k: int) -> tuple[np.ndarray, np.ndarray]:
+    # Merges the (distances, uids) of every shard, each shaped (n_queries, k), into the k closest hits per query.
+    # Padding hits have an infinite distance, so they sort last.
+    if len(results) == 1:
+        return results[0]
+    distances = np.concatenate([shard_distances for shard_distances, _ in results], axis=1)
+    uids = np.concatenate([shard_uids for _, shard_uids in results], axis=1)
+    distances = np.where(np.equal(uids, None), np.inf, distances)
+    order = np.argsort(distances, axis=1, kind='stable')[:, :k]
+    return np.take_along_axis(distances, order, axis=1), np.take_along_axis(uids, order, axis=1)
+
+
+class ShardedSpace:
+    """
+    ShardedSpace: a vector space split over several VectorSpaces, its shards. \n
+    New vectors go to the last shard. Once it holds `shard_size` vectors, it is sealed and a new shard is started.
+    Searches fan out over every shard on a thread pool, and the hits of the shards are merged. Rows are numbered
+    across the shards, in shard order. \n
+    The first shard is stored under the name of the space, so an index written before sharding becomes shard 0.
+    The names of the shards are kept in `index_<name>.shards.json`. \n
+    name: str \n
+    dim: int \n
+    shard_size: int (Number of vectors after which a shard is sealed.)
+    """
+
+    def __init__(self, name: str, dim: int, shard_size: int = VECTORDB_SHARD_SIZE):
+        self.name = name
+        self.dim = dim
+        self.shard_size = shard_size
+        self.manifest_path = path.join(FAISS_INDEX_PATH, f'index_{name}.shards.json')
+        # An empty, trained copy of the indexes, which new shards start from. Saved when the indexes are rebuilt.
+        self.template_path = path.join(FAISS_INDEX_PATH, f'index_{name}.template.faiss')
+
+        # Every shard but the last was sealed when the next one was started, so they are opened read-only.
+        shard_names = self._shard_names()
+        self.shards = [VectorSpace(shard_name, dim, sealed=i < len(shard_names) - 1)
+                       for i, shard_name in enumerate(shard_names)]
+
+    @property
+    def active(self) -> VectorSpace:
+        return self.shards[-1]
+
+    @property
+    def ntotal(self) -> int:
+        return sum(shard.ntotal for shard in self.shards)
+
+    @property
+    def state(self) -> tuple:
+        # On-disk state of every shard, as loaded or last written by this process.
+        return tuple((shard.name, shard.state) for shard in self.shards)
+
+    def disk_state(self) -> tuple:
+        # Current on-disk state of every shard listed in the manifest, which may have been changed by other processes.
+        return tuple((shard_name, _disk_state(shard_name)) for shard_name in self._shard_names())
+
+    def _shard_names(self) -> list[str]:
+        if not path.exists(self.manifest_path):
+            return [self.name]
+        with open(self.manifest_path, 'r') as manifest_file:
+            return json.load(manifest_file)['shards']
+
+    def _template(self) -> faiss.Index:
+        if path.exists(self.template_path):
+            return faiss.read_index(self.template_path)
+        # Without a saved template, the new shard starts from an emptied copy of the active shard's index, which
+        # keeps its training.
+        template = faiss.clone_index(self.active.index)
+        template.reset()
+        faiss.write_index(template, self.template_path)
+        return template
+
+    def _write_manifest(self):
+        makedirs(FAISS_INDEX_PATH, exist_ok=True)
+        temp_path = f'{self.manifest_path}.tmp'
+        with open(temp_path, 'w') as manifest_file:
+            json.dump({'shards': [shard.name for shard in self.shards]}, manifest_file)
+        replace(temp_path, self.manifest_path)
+
+    def open_for_writing(self):
+        # Only the active shard is ever written to. See VectorSpace.open_for_writing.
+        self.active.open_for_writing()
+
+    def _start_shard(self):
+        # Seals the full active shard and starts a new, empty one.
+        template = self._template()
+        self.active.seal()
+        shard_name = f'{self.name}.{len(self.shards):04d}'
+        self.shards.append(VectorSpace(shard_name, self.dim, template=template))
+        self.active.open_for_writing()
+        self._write_manifest()
+        logger.log(f"Sealed '{self.shards[-2].name}' with {self.shards[-2].ntotal} vectors, started '{shard_name}'")
+
+    def add(self, embeddings, ids: list):
+        # A batch always goes to a single shard, so the vectors of an article are never split between shards.
+        if self.active.ntotal >= self.shard_size:
+            self._start_shard()
+        self.active.add(embeddings, ids)
+
+    def checkpoint(self, force: bool = False):
+        for shard in self.shards:
+            shard.checkpoint(force=force)
+
+    def rebuild(self, index: faiss.Index, chunk_size: int = 65536):
+        # Rebuilds every shard as a copy of `index`, which must be trained and empty. It is also kept as the
+        # template of the shards started later.
+        makedirs(FAISS_INDEX_PATH, exist_ok=True)
+        faiss.write_index(index, self.template_path)
+        for shard in self.shards:
+            shard.rebuild(faiss.clone_index(index), chunk_size=chunk_size)
+
+    def _fan_out(self, fn, shards: list[VectorSpace] = None) -> list:
+        # Calls `fn(shard)` for every shard, on the search threads when there are several.
+        shards = self.shards if shards is None else shards
+        if len(shards) == 1:
+            return [fn(shards[0])]
+        return list(_get_search_pool().map(fn, shards))
+
+    def search(self,
+               queries: np.ndarray,
+               k: int,
+               nprobe: int = FAISS_NPROBE,
+               ef_search: int = FAISS_EF_SEARCH) -> tuple[np.ndarray, np.ndarray]:
+        # Same as VectorSpace.search, over every shard holding vectors.
+        queries = _as_faiss_array(queries)
+        shards = [shard for shard in self.shards if shard.ntotal] or [self.active]
+        results = self._fan_out(lambda shard: shard.search(queries, k, nprobe=nprobe, ef_search=ef_search), shards)
+        return _merge_top_k(results, k)
+
+    def search_articles(self, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+        # Searches the article index of every shard. Returns the distances and uids of the k closest articles to
+        # each query.
+        if any(shard.articles is None for shard in self.shards):
+            raise RuntimeError(f"'{self.name}' has no article index. Enable VECTORDB_ARTICLE_INDEX to use it.")
+        queries = _as_faiss_array(queries)
+        return _merge_top_k(self._fan_out(lambda shard: shard.articles.search(queries, k)), k)
+
+    @property
+    def article_count(self) -> int:
+        return sum(len(shard.articles) for shard in self.shards if shard.articles is not None)
+
+    def _offsets(self) -> np.ndarray:
+        # First row of every shard, and the total row count.
+        return np.cumsum([0] + [shard.ntotal for shard in self.shards])
+
+    def rows_for(self, uids: list[str]) -> tuple[np.ndarray, np.ndarray]:
+        # Rows of every vector of the articles in `uids`, across every shard. See IdMap.rows_for.
+        offsets = self._offsets()
+        found = self._fan_out(lambda shard: shard.rows_for(uids))
+        rows = np.concatenate([shard_rows + offsets[i] for i, (shard_rows, _) in enumerate(found)])
+        owners = np.concatenate([shard_owners for _, shard_owners in found])
+        order = np.argsort(owners, kind='stable')
+        return rows[order], owners[order]
+
+    def reconstruct(self, rows: np.ndarray) -> np.ndarray:
+        # Returns the stored vectors of `rows`, numbered across every shard.
+        rows = np.asarray(rows, dtype=np.int64)
+        offsets = self._offsets()
+        shard_of_row = np.searchsorted(offsets, rows, side='right') - 1
+        vectors = np.empty((len(rows), self.dim), dtype=np.float32)
+        for i in np.unique(shard_of_row).tolist():
+            in_shard = shard_of_row == i
+            vectors[in_shard] = self.shards[i].reconstruct(rows[in_shard] - offsets[i])
+        return vectors
 
 
 class VectorDB:
 
     def __init__(self):
         # VectorDB is an interface to write autoencoded vectors to disk for later retrieval.
-        # The file paths to the semantic and rhetorical db, as well as the faiss databases themselves
-        # (read from disk or created on the spot if it does not exist) are instance attributes.
-        self.semantic_vectordb_path = path.join(FAISS_INDEX_PATH, 'index_semantic.faiss')
-        self.rhetoric_vectordb_path = path.join(FAISS_INDEX_PATH, 'index_rhetoric.faiss')
+        # Each space holds its faiss index (read from disk or created on the spot if it does not exist) and the
+        # map from index rows to article ids.
+        # Any number of processes may read the indexes, but only one writes them: the one holding the writer lock,
+        # taken on its first insert (see `acquire_writer`). Only the writer repairs, truncates or snapshots the files,
+        # and it snapshots them on shutdown, so the next start has nothing to replay.
+        self.lock_path = path.join(FAISS_INDEX_PATH, 'vectordb.lock')
+        self._writer = None
+        self._writer_lock = threading.Lock()
+        self._open_spaces()
+
+    def _open_spaces(self):
+        self.semantic = ShardedSpace('semantic', 128)
+        self.rhetoric = ShardedSpace('rhetoric', 256)
+        self.spaces = {
+            'semantic': self.semantic,
+            'rhetoric': self.rhetoric,
+        }
+
+        self.semantic_vectordb_path = self.semantic.shards[0].index_path
+        self.rhetoric_vectordb_path = self.rhetoric.shards[0].index_path
+
+    # Indexes of the shards currently written to.
+    @property
+    def sem_index(self):
+        return self.semantic.active.index
+
+    @property
+    def rhet_index(self):
+        return self.rhetoric.active.index
+
+    @property
+    def generation(self) -> str:
+        # Identifies the contents of the indexes held by this process, by the on-disk state of their files when they
+        # were loaded or last written here. Processes which loaded the same files share it, and a process whose
+        # indexes are behind the files on disk has an older one. See `stale`.
+        states = json.dumps([space.state for space in self.spaces.values()])
+        return blake2b(states.encode('utf-8'), digest_size=8).hexdigest()
+
+    @property
+    def stale(self) -> bool:
+        # Whether another process has changed the indexes on disk since this one loaded or wrote them.
+        return any(space.disk_state() != space.state for space in self.spaces.values())
 
-        # Loads the faiss vectordb from disk if it exists. Else, it makes a new empty one.
-        self.sem_index = faiss.read_index(self.semantic_vectordb_path) if path.exists(self.semantic_vectordb_path) else faiss.IndexFlatL2(128)
-        self.rhet_index = faiss.read_index(self.rhetoric_vectordb_path) if path.exists(self.rhetoric_vectordb_path) else faiss.IndexFlatL2(256)
+    @property
+    def writer_active(self) -> bool:
+        # Whether another process holds the writer lock, and may be changing the indexes on disk.
+        return self._writer is None and is_file_locked(self.lock_path)
 
+    def acquire_writer(self, timeout: float = 5.0):
+        # Takes the writer lock, making this process the only one allowed to write the indexes. The lock is retried
+        # for up to `timeout` seconds, since readers take it for an instant to check for a writer. Indexes changed on
+        # disk since they were loaded are read again first, then the files an interrupted writer left behind are
+        # repaired. The lock is held until `close`, which runs on exit.
+        with self._writer_lock:
+            if self._writer is not None:
+                return
+            makedirs(FAISS_INDEX_PATH, exist_ok=True)
+            deadline = time.monotonic() + timeout
+            lock_file = try_file_lock(self.lock_path)
+            while lock_file is None and time.monotonic() < deadline:
+                time.sleep(0.05)
+                lock_file = try_file_lock(self.lock_path)
+            if lock_file is None:
+                raise RuntimeError("Another process is writing the vector indexes.")
 
-    def insert_vectors(self, embeddings: Tensor, ids: list, write_to=None):
+            if self.stale:
+                self._open_spaces()
+            for space in self.spaces.values():
+                space.open_for_writing()
+            self._writer = lock_file
+            atexit.register(self.close)
+
+    def insert_vectors(self, embeddings: 'Tensor', ids: list, write_to=None):
 
         # write_to specifies whether the function is to serialize to the vector db holding the semantic vectors or
         # rhetorical vectors.
+        if write_to not in self.spaces:
+            raise ValueError(f"Unknown vector space '{write_to}', expected one of {list(self.spaces)}")
+        self.acquire_writer()
+        self.spaces[write_to].add(embeddings, ids)
+
+    def checkpoint(self):
+        # Only the writer snapshots the indexes. A reader would overwrite the vectors the writer added since.
+        if self._writer is None:
+            return
+        for space in self.spaces.values():
+            space.checkpoint()
+
+    def close(self):
+        # Snapshots the indexes and gives up the writer lock.
+        with self._writer_lock:
+            if self._writer is None:
+                return
+            self.checkpoint()
+            release_file_lock(self._writer)
+            self._writer = None
+
+_vector_db = None
+_vector_db_lock = threading.Lock()
+
+
+def get_vector_db() -> VectorDB:
+    """Returns the process-wide VectorDB. Its indexes are read from disk on first use, not when this module is
+    imported."""
+    global _vector_db
+    if _vector_db is None:
+        with _vector_db_lock:
+            if _vector_db is None:
+                _vector_db = VectorDB()
+    return _vector_db
+
+
+def reload_vector_db() -> VectorDB:
+    """Reads the indexes from disk again, and makes them the process-wide VectorDB. Searches already running finish
+    on the old one."""
+    global _vector_db
+    vector_db = VectorDB()
+    with _vector_db_lock:
+        _vector_db = vector_db
+    return vector_db
 
-        # Size of the current faiss db, so the writer knows where to begin counting for mapping vector db indexes
-        # to individual article IDs in redis.
-        current_index_size = self.sem_index.ntotal \
-            if write_to == 'semantic' \
-            else self.rhet_index.ntotal \
-            if write_to == 'rhetoric' \
-            else None
-        new_vec_ids = [i + current_index_size for i in range(len(embeddings))]
-
-        # Map the vector ids to articles in redis, add new embeddings, and write updated faiss db to disk.
-        if write_to == 'semantic':
-            for i in range(len(new_vec_ids)):
-                db_service.db.redis_cursor.hset(name='semantic', key=str(new_vec_ids[i]), value=ids[i])
-            self.sem_index.add(embeddings)
-            faiss.write_index(self.sem_index, self.semantic_vectordb_path)
-        elif write_to == 'rhetoric':
-            for i in range(len(new_vec_ids)):
-                db_service.db.redis_cursor.hset(name='rhetoric', key=str(new_vec_ids[i]), value=ids[i])
-            self.rhet_index.add(embeddings)
-            faiss.write_index(self.rhet_index, self.rhetoric_vectordb_path)
-        else:
-            # Add code for error handling here later
-            pass
 
-vector_db = VectorDB()
+def __getattr__(name):
+    # `vector_db` is still importable from this module, and is created when first looked up.
+    if name == 'vector_db':
+        return get_vector_db()
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
@@ -0,0 +1,118 @@
+from os import path, makedirs, replace
+import json
+
+import numpy as np
+
+from allpress.util import logger
+
+
+class TensorStore:
+    """
+    TensorStore: appendable on-disk store for the float32 embedding matrices used to train the autoencoders. \n
+    Rows are written into preallocated, fixed-size `.npy` shards which are memory-mapped, so appending a batch
+    costs O(batch) no matter how large the store already is. The number of valid rows is kept in `store.json`,
+    which is only updated once the rows of a batch have been written.
+    """
+
+    def __init__(self, root: str, shard_rows: int = 16384):
+        self.root = root
+        self.meta_path = path.join(root, 'store.json')
+        self.dim = None
+        self.rows = 0
+        self.shard_rows = shard_rows
+
+        if path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as meta_file:
+                meta = json.load(meta_file)
+            self.dim = meta['dim']
+            self.rows = meta['rows']
+            self.shard_rows = meta['shard_rows']
+
+    def __len__(self) -> int:
+        return self.rows
+
+    @property
+    def nbytes(self) -> int:
+        return self.rows * (self.dim or 0) * 4
+
+    @property
+    def num_shards(self) -> int:
+        return -(-self.rows // self.shard_rows)
+
+    def _shard_path(self, shard: int) -> str:
+        return path.join(self.root, f'shard_{shard:05d}.npy')
+
+    def _write_meta(self):
+        temp_path = f'{self.meta_path}.tmp'
+        with open(temp_path, 'w') as meta_file:
+            json.dump({'dim': self.dim, 'rows': self.rows, 'shard_rows': self.shard_rows}, meta_file)
+        replace(temp_path, self.meta_path)
+
+    def append(self, embeddings: np.ndarray):
+        """Appends a (n, dim) matrix of embeddings to the store."""
+        embeddings = np.asarray(embeddings, dtype=np.float32)
+        if embeddings.size == 0:
+            return
+        if self.dim is None:
+            self.dim = embeddings.shape[1]
+            makedirs(self.root, exist_ok=True)
+        elif embeddings.shape[1] != self.dim:
+            raise ValueError(f"Cannot append {embeddings.shape[1]}-dim embeddings to a {self.dim}-dim store")
+
+        written = 0
+        while written < len(embeddings):
+            shard, offset = divmod(self.rows + written, self.shard_rows)
+            shard_path = self._shard_path(shard)
+
+            # A shard is allocated at full size the first time a row is written into it.
+            if offset == 0 or not path.exists(shard_path):
+                shard_array = np.lib.format.open_memmap(
+                    shard_path, mode='w+', dtype=np.float32, shape=(self.shard_rows, self.dim))
+            else:
+                shard_array = np.load(shard_path, mmap_mode='r+')
+
+            count = min(self.shard_rows - offset, len(embeddings) - written)
+            shard_array[offset:offset + count] = embeddings[written:written + count]
+            shard_array.flush()
+            del shard_array
+            written += count
+
+        self.rows += written
+        self._write_meta()
+
+    def shards(self):
+        """Yields a read-only memory map of the valid rows of each shard, in order."""
+        for shard in range(self.num_shards):
+            valid = min(self.shard_rows, self.rows - shard * self.shard_rows)
+            yield np.load(self._shard_path(shard), mmap_mode='r')[:valid]
+
+    def to_array(self) -> np.ndarray:
+        """Loads the whole store into memory as a single matrix."""
+        if self.rows == 0:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return np.concatenate(list(self.shards()))
+
+    def sample(self, n: int, seed: int = None) -> np.ndarray:
+        """Returns `n` rows drawn at random without replacement (or every row, if the store holds fewer)."""
+        rng = np.random.default_rng(seed)
+        if n >= self.rows:
+            return self.to_array()
+        rows = np.sort(rng.choice(self.rows, size=n, replace=False))
+        shard_of_row = rows // self.shard_rows
+        samples = []
+        for shard, shard_array in enumerate(self.shards()):
+            in_shard = rows[shard_of_row == shard] - shard * self.shard_rows
+            if len(in_shard):
+                samples.append(np.asarray(shard_array[in_shard]))
+        return np.concatenate(samples)
+
+
+def open_tensor_store(root: str, legacy_path: str = None, shard_rows: int = 16384) -> TensorStore:
+    # Opens the store at `root`. The first time a store is opened, a legacy single-file `.pth` tensor at
+    # `legacy_path` is imported into it, so previously built training sets are kept.
+    store = TensorStore(root, shard_rows=shard_rows)
+    if len(store) == 0 and legacy_path and path.exists(legacy_path):
+        import torch
+        logger.log(f"Importing legacy training tensor {legacy_path} into {root}")
+        store.append(torch.load(legacy_path).float().numpy())
+    return store
@@ -0,0 +1,62 @@
+import numpy as np
+
+# Page uids are md5 hex digests. The set keeps the 16 raw bytes of each digest rather than its 32 hex characters.
+DIGEST_DTYPE = np.dtype('S16')
+
+# Number of uids added one by one before they are merged into the sorted array.
+MERGE_THRESHOLD = 65536
+
+
+def _digests(uids) -> np.ndarray:
+    return np.array([bytes.fromhex(uid) for uid in uids], dtype=DIGEST_DTYPE)
+
+
+class UidSet:
+    """
+    UidSet: set of page uids, used to skip the articles which are already indexed. \n
+    The uids are kept in a sorted array and looked up by binary search, which takes a fraction of the memory of a
+    python set. Newly added uids go into a small python set, which is merged into the array once it grows large.
+    """
+
+    def __init__(self, digests: np.ndarray = None):
+        self._sorted = np.unique(digests) if digests is not None else np.empty(0, dtype=DIGEST_DTYPE)
+        self._recent = set()
+
+    def __len__(self) -> int:
+        return len(self._sorted) + len(self._recent)
+
+    def __contains__(self, uid: str) -> bool:
+        return bool(self.contains([uid])[0])
+
+    def contains(self, uids: list[str]) -> np.ndarray:
+        """Returns a boolean array telling, for each uid in `uids`, whether it is in the set."""
+        digests = _digests(uids)
+        found = np.zeros(len(digests), dtype=bool)
+        if len(self._sorted) and len(digests):
+            positions = np.minimum(np.searchsorted(self._sorted, digests), len(self._sorted) - 1)
+            found = self._sorted[positions] == digests
+        if self._recent:
+            found |= np.fromiter((digest in self._recent for digest in digests.tolist()), dtype=bool,
+                                 count=len(digests))
+        return found
+
+    def add(self, uids: list[str]):
+        self._recent.update(_digests(uids).tolist())
+        if len(self._recent) >= MERGE_THRESHOLD:
+            recent = np.array(list(self._recent), dtype=DIGEST_DTYPE)
+            self._sorted = np.union1d(self._sorted, recent)
+            self._recent.clear()
+
+
+def load_known_uids(chunk_size: int = 100000) -> UidSet:
+    """Returns the set of the uids of every page in the `page` table. The uids are read `chunk_size` rows at a time."""
+    from allpress.services.db import db_service
+
+    chunks = []
+    with db_service.db.get_cursor() as cursor:
+        cursor.execute('SELECT uid FROM page;')
+        rows = cursor.fetchmany(chunk_size)
+        while rows:
+            chunks.append(_digests([row[0] for row in rows]))
+            rows = cursor.fetchmany(chunk_size)
+    return UidSet(np.concatenate(chunks) if chunks else None)
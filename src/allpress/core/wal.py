@@ -0,0 +1,89 @@
+from os import path, truncate, fsync
+import struct
+
+import numpy as np
+
+from allpress.core.idmap import UID_DTYPE, UID_WIDTH
+from allpress.util import logger
+
+# Every record starts with the index row its first vector was written to, the number of vectors in the record,
+# and their dimension. The vectors (float32) and the article uids (fixed-width slots) follow the header.
+RECORD_HEADER = struct.Struct('<QII')
+
+
+class VectorLog:
+    """
+    VectorLog: append-only write-ahead log of the vectors added to a FAISS index since its last snapshot. \n
+    Inserting only appends a record to the log, which costs O(batch) instead of re-serializing the whole
+    index. On startup, the records are replayed on top of the last snapshot. Any process may replay the log, but
+    only the one writing to it repairs it.
+    """
+
+    def __init__(self, file_path: str, dim: int, sync: bool = False):
+        self.file_path = file_path
+        self.dim = dim
+        self.sync = sync
+        self.valid_size = 0
+
+    def append(self, start_row: int, vectors: np.ndarray, uids: list[str]):
+        """Appends a record for `vectors`, which are about to be added to the index starting at `start_row`."""
+        vectors = np.ascontiguousarray(vectors, dtype=np.float32)
+        slots = np.asarray(uids, dtype=UID_DTYPE)
+        with open(self.file_path, 'ab') as log_file:
+            log_file.write(RECORD_HEADER.pack(start_row, len(vectors), self.dim))
+            log_file.write(vectors.tobytes())
+            log_file.write(slots.tobytes())
+            log_file.flush()
+            if self.sync:
+                fsync(log_file.fileno())
+
+    def replay(self):
+        """
+        Yields `(start_row, vectors, uids)` for every complete record in the log. Replay stops at the first
+        incomplete record, which is either being written by another process, or was cut short by a crash. The size
+        of the complete records is kept in `valid_size`.
+        """
+        self.valid_size = 0
+        if not path.exists(self.file_path):
+            return
+
+        with open(self.file_path, 'rb') as log_file:
+            valid_size = 0
+            while True:
+                header = log_file.read(RECORD_HEADER.size)
+                if not header:
+                    break
+                if len(header) < RECORD_HEADER.size:
+                    break
+
+                start_row, count, dim = RECORD_HEADER.unpack(header)
+                if dim != self.dim:
+                    logger.log(f"Record with dimension {dim} in {self.file_path}, expected {self.dim}", level="error")
+                    break
+
+                vector_bytes = log_file.read(count * dim * 4)
+                uid_bytes = log_file.read(count * UID_WIDTH)
+                if len(vector_bytes) < count * dim * 4 or len(uid_bytes) < count * UID_WIDTH:
+                    break
+
+                vectors = np.frombuffer(vector_bytes, dtype=np.float32).reshape(count, dim)
+                uids = np.char.decode(np.frombuffer(uid_bytes, dtype=UID_DTYPE), 'ascii').tolist()
+                valid_size = log_file.tell()
+                self.valid_size = valid_size
+                yield start_row, vectors, uids
+
+    def repair(self):
+        """
+        Truncates an incomplete record left at the end of the log by a crash, so new records are appended right after
+        the complete ones. Only called by the process writing to the log.
+        """
+        for _ in self.replay():
+            pass
+        if path.exists(self.file_path) and self.valid_size < path.getsize(self.file_path):
+            logger.log(f"Dropping incomplete record at the end of {self.file_path}", level="warning")
+            truncate(self.file_path, self.valid_size)
+
+    def reset(self):
+        """Empties the log. Called once its records are part of a snapshot."""
+        if path.exists(self.file_path):
+            truncate(self.file_path, 0)
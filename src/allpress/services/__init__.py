@@ -1,3 +1,2 @@
-from . import nlp
-from . import scrape
-from . import search
\ No newline at end of file
+# The service modules are imported where they are used (`from allpress.services import scrape`), so importing one
+# of them doesn't load the models and drivers the others depend on.
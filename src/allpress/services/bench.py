@@ -0,0 +1,289 @@
+import ast
+import glob
+import statistics
+import subprocess
+import sys
+import time
+from os import path, environ, pathsep
+
+import numpy as np
+
+# This module contains benchmarks for the performance-sensitive parts of allpress. Every benchmark returns a list of
+# report rows (dicts), which `print_report` formats as a table for the CLI.
+
+
+def print_report(rows: list[dict]):
+    if not rows:
+        print("Nothing to report.")
+        return
+    columns = list(rows[0].keys())
+    cells = [[_format_cell(row[column]) for column in columns] for row in rows]
+    widths = [max(len(column), *(len(line[i]) for line in cells)) for i, column in enumerate(columns)]
+    print('  '.join(column.ljust(width) for column, width in zip(columns, widths)))
+    for line in cells:
+        print('  '.join(cell.ljust(width) for cell, width in zip(line, widths)))
+
+
+def _format_cell(value) -> str:
+    if isinstance(value, float):
+        return f'{value:.4f}'
+    return str(value)
+
+
+def _timed(fn, *args, **kwargs):
+    start = time.perf_counter()
+    result = fn(*args, **kwargs)
+    return time.perf_counter() - start, result
+
+
+def _recall_at_k(truth: np.ndarray, found: np.ndarray) -> float:
+    # Fraction of the exact top-k neighbours that the approximate search also returned, averaged over all queries.
+    hits = sum(len(np.intersect1d(t[t >= 0], f[f >= 0])) for t, f in zip(truth, found))
+    return hits / max(1, int((truth >= 0).sum()))
+
+
+def bench_index(space,
+                k: int = 10,
+                n_queries: int = 1000,
+                nprobe_values: tuple = (1, 4, 16, 64, 256),
+                ef_search_values: tuple = (16, 32, 64, 128, 256)) -> list[dict]:
+    """
+    Measures recall@k and latency of a vector space's index against an exact flat index over the same vectors. \n
+    Queries are sampled from the indexed vectors. For PQ indexes, the ground truth is computed on the reconstructed
+    (quantized) vectors, so the report shows the loss of the IVF search, not of the compression.
+    """
+    import faiss
+    from allpress.core.indexes import enable_reconstruction, search_parameters, describe_index
+
+    index = space.index
+    if index.ntotal == 0:
+        return []
+
+    enable_reconstruction(index)
+    vectors = index.reconstruct_n(0, index.ntotal)
+    flat = faiss.IndexFlatL2(space.dim)
+    flat.add(vectors)
+
+    rng = np.random.default_rng(0)
+    queries = vectors[rng.choice(index.ntotal, size=min(n_queries, index.ntotal), replace=False)]
+
+    flat_seconds, (_, truth) = _timed(flat.search, queries, k)
+    report = [{
+        'space': space.name,
+        'index': 'IndexFlatL2',
+        'setting': '-',
+        f'recall@{k}': 1.0,
+        'ms/query': flat_seconds * 1000 / len(queries),
+    }]
+
+    if isinstance(index, faiss.IndexFlat):
+        return report
+
+    # Every setting of the index's search-time knob is measured, so the recall/latency tradeoff can be read off
+    # the report.
+    if isinstance(index, faiss.IndexHNSW):
+        settings = [('efSearch', {'ef_search': value}) for value in ef_search_values]
+    else:
+        settings = [('nprobe', {'nprobe': value}) for value in nprobe_values]
+
+    for name, kwargs in settings:
+        params = search_parameters(index, **kwargs)
+        seconds, (_, found) = _timed(index.search, queries, k, params=params)
+        report.append({
+            'space': space.name,
+            'index': describe_index(index),
+            'setting': f'{name}={next(iter(kwargs.values()))}',
+            f'recall@{k}': _recall_at_k(truth, found),
+            'ms/query': seconds * 1000 / len(queries),
+        })
+    return report
+
+
+def _multi_pass_features(soup):
+    # The DOM lookups the article detector made before it was reduced to a single traversal. Kept as the baseline
+    # of `bench_detector`.
+    soup.find('h1') or soup.find('h2')
+    soup.find_all('meta')
+    soup.find_all('article')
+    soup.find_all(['main', 'section'])
+    [p.get_text() for p in soup.find_all('p')]
+    soup.find_all('a', href=True)
+
+
+def bench_detector(corpus_dir: str, repeat: int = 3) -> list[dict]:
+    """
+    Measures the article detector on a corpus of saved `.html` pages in `corpus_dir`. Reports the time spent
+    parsing, extracting the DOM features in a single traversal, and making the equivalent multi-pass lookups, as
+    well as the share of the corpus' links which the url pre-score drops before fetching.
+    """
+    from bs4 import BeautifulSoup as Soup
+    from allpress.services.scrape import ArticleDetector
+
+    files = sorted(glob.glob(path.join(corpus_dir, '*.html')) + glob.glob(path.join(corpus_dir, '*.htm')))
+    if not files:
+        return []
+    pages = []
+    for file_path in files:
+        with open(file_path, 'r', encoding='utf-8', errors='replace') as html_file:
+            pages.append((path.basename(file_path), html_file.read()))
+
+    detector = ArticleDetector()
+    parse_seconds = single_seconds = multi_seconds = 0.0
+    links = []
+    articles = 0
+    for _ in range(repeat):
+        links = []
+        articles = 0
+        for name, html in pages:
+            seconds, soup = _timed(Soup, html, 'lxml')
+            parse_seconds += seconds
+
+            seconds, features = _timed(detector.extract_features, soup)
+            single_seconds += seconds
+            articles += detector.score_features(name, features)[0]
+            links += features.links
+
+            multi_seconds += _timed(_multi_pass_features, soup)[0]
+
+    runs = len(pages) * repeat
+    rejected = sum(not detector.should_fetch(link) for link in links)
+    return [
+        {'stage': 'parse (lxml)', 'pages': len(pages), 'ms/page': parse_seconds * 1000 / runs,
+         'pages/s': runs / max(parse_seconds, 1e-9)},
+        {'stage': 'features, single pass', 'pages': len(pages), 'ms/page': single_seconds * 1000 / runs,
+         'pages/s': runs / max(single_seconds, 1e-9)},
+        {'stage': 'features, multi pass', 'pages': len(pages), 'ms/page': multi_seconds * 1000 / runs,
+         'pages/s': runs / max(multi_seconds, 1e-9)},
+        {'stage': f'articles detected: {articles}', 'pages': len(pages), 'ms/page': '-', 'pages/s': '-'},
+        {'stage': f'links dropped by url pre-score: {rejected}/{len(links)}', 'pages': len(pages),
+         'ms/page': '-', 'pages/s': '-'},
+    ]
+
+
+def _time_command(argv: list[str], env: dict) -> float:
+    start = time.perf_counter()
+    subprocess.run(argv, env=env, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL, check=False)
+    return time.perf_counter() - start
+
+
+def _command_imports(package_dir: str) -> dict[str, str]:
+    # Returns, for every CLI command, the import statements it runs before starting its work: those of the function
+    # of `allpress.cli.main` that `allpress.__main__` dispatches it to, including the ones nested in branches.
+    # Imports made by the functions it calls in turn are not followed.
+    with open(path.join(package_dir, '__main__.py'), 'r', encoding='utf-8') as main_file:
+        dispatch = ast.parse(main_file.read())
+    with open(path.join(package_dir, 'cli', 'main.py'), 'r', encoding='utf-8') as cli_file:
+        functions = {node.name: node for node in ast.parse(cli_file.read()).body if isinstance(node, ast.FunctionDef)}
+
+    imports = {}
+    for node in ast.walk(dispatch):
+        # if args.command == "<command>": main.<function>(...)
+        if not (isinstance(node, ast.If) and isinstance(node.test, ast.Compare)
+                and isinstance(node.test.left, ast.Attribute) and node.test.left.attr == 'command'
+                and isinstance(node.test.comparators[0], ast.Constant)):
+            continue
+        command = node.test.comparators[0].value
+        for call in ast.walk(ast.Module(body=node.body, type_ignores=[])):
+            if isinstance(call, ast.Call) and isinstance(call.func, ast.Attribute) \
+                    and isinstance(call.func.value, ast.Name) and call.func.value.id == 'main' \
+                    and call.func.attr in functions:
+                imports[command] = '\n'.join(
+                    ast.unparse(statement) for statement in ast.walk(functions[call.func.attr])
+                    if isinstance(statement, (ast.Import, ast.ImportFrom))
+                )
+                break
+    return imports
+
+
+def bench_startup(commands: list[str], repeat: int = 5) -> list[dict]:
+    """
+    Measures how long the CLI takes to start. Each command is timed in a fresh interpreter, importing
+    `allpress.cli.main` and then everything the command imports before it starts its work. Also measures a bare
+    interpreter, importing the package, and parsing the arguments (`--help`), which imports none of the commands.
+    Reports the median and the slowest of `repeat` runs.
+    """
+    import allpress
+
+    # The child interpreters import allpress from the same place as this one.
+    env = dict(environ)
+    package_dir = path.dirname(path.abspath(allpress.__file__))
+    env['PYTHONPATH'] = pathsep.join(filter(None, [path.dirname(package_dir), env.get('PYTHONPATH')]))
+
+    runs = [
+        ('python (no imports)', [sys.executable, '-c', 'pass']),
+        ('import allpress', [sys.executable, '-c', 'import allpress']),
+        ('allpress --help', [sys.executable, '-m', 'allpress', '--help']),
+        ('import allpress.cli.main', [sys.executable, '-c', 'import allpress.cli.main']),
+    ]
+    command_imports = _command_imports(package_dir)
+    runs += [
+        (f'{command} imports', [sys.executable, '-c', 'import allpress.cli.main\n' + command_imports[command]])
+        for command in commands if command in command_imports
+    ]
+
+    report = []
+    for name, argv in runs:
+        seconds = [_time_command(argv, env) for _ in range(repeat)]
+        report.append({
+            'command': name,
+            'median ms': statistics.median(seconds) * 1000,
+            'max ms': max(seconds) * 1000,
+        })
+    return report
+
+
+def _cosine_drift(baseline: np.ndarray, embeddings: np.ndarray) -> tuple[float, float]:
+    # Cosine similarity between each embedding and its fp32 baseline. Returns the mean and the worst one.
+    baseline = baseline / np.maximum(np.linalg.norm(baseline, axis=1, keepdims=True), 1e-12)
+    embeddings = embeddings / np.maximum(np.linalg.norm(embeddings, axis=1, keepdims=True), 1e-12)
+    similarity = (baseline * embeddings).sum(axis=1)
+    return float(similarity.mean()), float(similarity.min())
+
+
+def bench_embedders(texts: list[str],
+                    embedders: tuple = ('semantic', 'rhetoric'),
+                    batch_size: int = 64) -> list[dict]:
+    """
+    Measures the throughput of every inference variant of the embedders on `texts`, and how far their embeddings
+    drift from the fp32 torch model on the CPU. Variants which can't be loaded here (no ONNX Runtime, no GPU) are
+    reported with their error.
+    """
+    from allpress.services.nn import load_embedder, resolve_device
+    from allpress.settings import INFERENCE_DEVICE
+
+    variants = [
+        ('torch fp32 cpu', {'device': 'cpu', 'backend': 'torch', 'quantize': False}),
+        ('torch int8 cpu', {'device': 'cpu', 'backend': 'torch', 'quantize': True}),
+        ('onnx cpu', {'device': 'cpu', 'backend': 'onnx', 'quantize': False}),
+    ]
+    device = resolve_device(INFERENCE_DEVICE)
+    if device.type != 'cpu':
+        variants.append((f'torch fp32 {device}', {'device': INFERENCE_DEVICE, 'backend': 'torch', 'quantize': False}))
+
+    report = []
+    for embedder in embedders:
+        baseline = None
+        baseline_seconds = None
+        for name, kwargs in variants:
+            row = {'embedder': embedder, 'variant': name, 'texts/s': '-', 'speedup': '-',
+                   'mean cos': '-', 'min cos': '-', 'error': ''}
+            report.append(row)
+            try:
+                model = load_embedder(embedder, **kwargs)
+                # The first batch is encoded once before timing, so lazy initialization isn't measured.
+                model.encode(texts[:batch_size], batch_size=batch_size, show_progress_bar=False)
+                seconds, embeddings = _timed(model.encode, texts, batch_size=batch_size, show_progress_bar=False,
+                                             convert_to_numpy=True)
+            except Exception as e:
+                row['error'] = f'{type(e).__name__}: {e}'[:80]
+                continue
+            finally:
+                model = None
+
+            embeddings = np.asarray(embeddings, dtype=np.float32)
+            if baseline is None:
+                baseline, baseline_seconds = embeddings, seconds
+            row['texts/s'] = len(texts) / max(seconds, 1e-9)
+            row['speedup'] = baseline_seconds / max(seconds, 1e-9)
+            row['mean cos'], row['min cos'] = _cosine_drift(baseline, embeddings)
+    return report
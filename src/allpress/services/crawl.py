@@ -0,0 +1,120 @@
+import asyncio
+import queue
+import threading
+
+from allpress.services.scrape import Scraper, create_session
+from allpress.settings import (
+    CRAWL_MAX_SOURCES_IN_FLIGHT,
+    CRAWL_MAX_CONNECTIONS,
+    CRAWL_MAX_CONNECTIONS_PER_DOMAIN,
+    CRAWL_SOURCE_TIME_BUDGET,
+    CRAWL_RESULT_QUEUE_SIZE,
+    CRAWL_INCREMENTAL,
+)
+from allpress.util import logger
+
+# This module schedules the crawling of many news sources at once. Every source gets its own Scraper, and all of
+# them share one event loop, running in a background thread, and one HTTP session. The connector of the session
+# caps the number of requests in flight overall and per domain, and reuses connections across sources.
+
+# Marks the end of the results queue.
+_DONE = object()
+
+
+class CrawlScheduler:
+    """
+    CrawlScheduler: crawls many sources concurrently, and hands the article pages found to the caller as soon as
+    they arrive. \n
+    max_sources: int (Number of sources crawled at the same time.) \n
+    max_connections: int (Number of requests in flight over all sources.) \n
+    per_domain: int (Number of requests in flight to a single domain.) \n
+    time_budget: float (Seconds after which the crawl of a source is cut short.) \n
+    queue_size: int (Number of results buffered for the caller. Crawling pauses while the buffer is full.) \n
+    incremental: bool (Resume from the saved crawl state of each source, and skip the pages which haven't changed.)
+    """
+
+    def __init__(self,
+                 iterations: int = 2,
+                 max_sources: int = CRAWL_MAX_SOURCES_IN_FLIGHT,
+                 max_connections: int = CRAWL_MAX_CONNECTIONS,
+                 per_domain: int = CRAWL_MAX_CONNECTIONS_PER_DOMAIN,
+                 time_budget: float = CRAWL_SOURCE_TIME_BUDGET,
+                 queue_size: int = CRAWL_RESULT_QUEUE_SIZE,
+                 incremental: bool = CRAWL_INCREMENTAL):
+        self.iterations = iterations
+        self.max_sources = max_sources
+        self.max_connections = max_connections
+        self.per_domain = per_domain
+        self.time_budget = time_budget
+        self.queue_size = queue_size
+        self.incremental = incremental
+        self._stop = threading.Event()
+
+    def run(self, sources: list[tuple]):
+        """
+        Crawls every `(source, url)` pair in `sources`, and yields `(source, url, pages)` for each round of each
+        source, where `pages` is a list of ParsedPage article pages. Closing the generator early (or interrupting
+        it) stops the crawl.
+        """
+        results = queue.Queue(maxsize=self.queue_size)
+        self._stop.clear()
+        thread = threading.Thread(target=asyncio.run, args=(self._crawl_all(sources, results),), daemon=True)
+        thread.start()
+        try:
+            while True:
+                item = results.get()
+                if item is _DONE:
+                    break
+                yield item
+        finally:
+            self._stop.set()
+            # Unblock the crawler if it is waiting on a full queue, so it can notice the stop.
+            while thread.is_alive():
+                try:
+                    results.get(timeout=0.1)
+                except queue.Empty:
+                    pass
+            thread.join()
+
+    async def _put(self, results: queue.Queue, item):
+        # Puts an item on the results queue without blocking the event loop. Waits while the queue is full, which
+        # pauses the crawl of this source until the caller catches up.
+        while not self._stop.is_set():
+            try:
+                results.put_nowait(item)
+                return
+            except queue.Full:
+                await asyncio.sleep(0.05)
+
+    async def _crawl_source(self, source, url, session, in_flight: asyncio.Semaphore, results):
+        async with in_flight:
+            if self._stop.is_set():
+                return
+            scraper = Scraper(session=session, incremental=self.incremental)
+            deadline = asyncio.get_running_loop().time() + self.time_budget
+            try:
+                async for pages in scraper.crawl(url, self.iterations, deadline):
+                    await self._put(results, (source, url, pages))
+                    if self._stop.is_set():
+                        return
+            except Exception as e:
+                logger.log(f"Failed to scrape {source}: {e}", level="error")
+
+    async def _crawl_all(self, sources: list[tuple], results: queue.Queue):
+        session = create_session(self.max_connections, self.per_domain)
+        in_flight = asyncio.Semaphore(self.max_sources)
+        crawls = asyncio.gather(*(
+            self._crawl_source(source, url, session, in_flight, results)
+            for source, url in sources
+        ))
+        try:
+            # Crawls still running when the caller stops are cancelled instead of being run to the end.
+            while not crawls.done():
+                if self._stop.is_set():
+                    crawls.cancel()
+                    break
+                await asyncio.wait([crawls], timeout=0.1)
+            await asyncio.gather(crawls, return_exceptions=True)
+        finally:
+            await session.close()
+            await self._put(results, _DONE)
@@ -33,8 +33,25 @@ class DatabaseService:
         values = list(data.values())
 
         query = self._generate_insert_query(model.model_name, columns)
-        self.db.cursor.execute(query, values)
-        self.db.connection.commit()
+        with self.db.get_cursor(commit=True) as cursor:
+            cursor.execute(query, values)
+
+    def fetch_all(self, query: str, params: tuple = ()) -> list:
+        """Runs a parameterized SELECT query and returns every row."""
+        with self.db.get_cursor() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchall()
+
+    def fetch_one(self, query: str, params: tuple = ()):
+        """Runs a parameterized SELECT query and returns the first row, or None."""
+        with self.db.get_cursor() as cursor:
+            cursor.execute(query, params)
+            return cursor.fetchone()
+
+    def execute(self, query: str, params: tuple = ()):
+        """Runs a parameterized query in its own transaction."""
+        with self.db.get_cursor(commit=True) as cursor:
+            cursor.execute(query, params)
 
     def _generate_insert_query(self, table_name: str, column_names: list) -> str:
         """Generates a safe, parameterized SQL insertion query."""
@@ -44,8 +61,37 @@ class DatabaseService:
 
     def insert_row(self, table: str, column_names: list, values: list):
         insert_query = self._generate_insert_query(table, column_names)
-        self.db.cursor.execute(insert_query, values)
-        self.db.connection.commit()
+        with self.db.get_cursor(commit=True) as cursor:
+            cursor.execute(insert_query, values)
+
+    def _generate_upsert_query(self, table_name: str, column_names: list, update_columns: list = None) -> str:
+        """Generates a parameterized insertion query which doesn't fail on duplicate keys. Rows with an existing key
+        have their `update_columns` overwritten, or are skipped if no update columns are given."""
+        placeholders = ', '.join(['%s'] * len(column_names))
+        columns = ', '.join(column_names)
+        if update_columns:
+            updates = ', '.join(f'{column} = VALUES({column})' for column in update_columns)
+            return f'INSERT INTO {table_name} ({columns}) VALUES ({placeholders}) ON DUPLICATE KEY UPDATE {updates};'
+        return f'INSERT IGNORE INTO {table_name} ({columns}) VALUES ({placeholders});'
+
+    def upsert_rows(self, table: str, column_names: list, rows: list[list], update_columns: list = None) -> int:
+        """Inserts all `rows` with a single executemany, in one transaction. Either every row is written, or the
+        transaction is rolled back and the error is raised. Returns the number of affected rows."""
+        if not rows:
+            return 0
+        upsert_query = self._generate_upsert_query(table, column_names, update_columns)
+        with self.db.get_cursor(commit=True) as cursor:
+            cursor.executemany(upsert_query, rows)
+            return cursor.rowcount
+
+    def save_models(self, models: list, update_columns: list = None) -> int:
+        """Bulk version of `save_model`, for a list of models of the same class. Models whose primary key already
+        exists are skipped, unless `update_columns` are given."""
+        if not models:
+            return 0
+        model_class = type(models[0])
+        rows = [[model.to_dict()[column] for column in model_class.column_names] for model in models]
+        return self.upsert_rows(model_class.model_name, model_class.column_names, rows, update_columns)
 
     @classmethod
     def generate_create_table_query(self,
@@ -0,0 +1,109 @@
+import time
+
+from allpress.core.models import CrawlStateModel, text_uid
+
+# This module keeps the crawl state of a news source between runs. For every url of the source, it remembers the
+# validators sent by the server, the hash of the content, and whether the url is still waiting to be fetched.
+
+# Columns overwritten when the state of a url already in the `crawlstate` table is saved again.
+_UPDATE_COLUMNS = [column for column in CrawlStateModel.column_names if column != 'urlhash']
+
+
+class CrawlState:
+    """
+    CrawlState: what the crawler knows of the urls of one source. \n
+    It is loaded from the `crawlstate` table when the crawl of the source starts, updated as pages are fetched, and
+    the changes are written back after every crawl iteration. \n
+    source: str (Url of the news source.)
+    """
+
+    def __init__(self, source: str):
+        self.source = source
+        self.entries = {}
+        self._changed = set()
+
+    def load(self):
+        """Reads the state of the source from the database. Blocking."""
+        from allpress.services.db import db_service
+
+        rows = db_service.fetch_all(
+            'SELECT url, etag, lastmodified, contenthash, lastseen, pending FROM crawlstate WHERE source = %s;',
+            (self.source,)
+        )
+        for url, etag, last_modified, content_hash, last_seen, pending in rows:
+            self.entries[url] = {
+                'etag': etag,
+                'lastmodified': last_modified,
+                'contenthash': content_hash,
+                'lastseen': last_seen,
+                'pending': bool(pending),
+            }
+
+    def _update(self, url: str, **values):
+        entry = self.entries.setdefault(url, {
+            'etag': None,
+            'lastmodified': None,
+            'contenthash': None,
+            'lastseen': None,
+            'pending': False,
+        })
+        entry.update(values)
+        self._changed.add(url)
+
+    def request_headers(self, url: str) -> dict:
+        """Returns the headers making the request for `url` conditional on the page having changed."""
+        entry = self.entries.get(url)
+        if not entry:
+            return {}
+        headers = {}
+        if entry['etag']:
+            headers['If-None-Match'] = entry['etag']
+        if entry['lastmodified']:
+            headers['If-Modified-Since'] = entry['lastmodified']
+        return headers
+
+    def content_hash(self, html: str) -> str:
+        return text_uid(html)
+
+    def is_unchanged(self, url: str, content_hash: str) -> bool:
+        """Returns True if `content_hash` is the hash of the content fetched from `url` last time."""
+        entry = self.entries.get(url)
+        return entry is not None and entry['contenthash'] == content_hash
+
+    def fetched(self, url: str, etag: str = None, last_modified: str = None, content_hash: str = None):
+        """Records a response for `url`. The url leaves the frontier."""
+        values = {'lastseen': time.time(), 'pending': False}
+        if etag is not None:
+            values['etag'] = etag
+        if last_modified is not None:
+            values['lastmodified'] = last_modified
+        if content_hash is not None:
+            values['contenthash'] = content_hash
+        self._update(url, **values)
+
+    def add_pending(self, urls):
+        """Puts the urls which have never been fetched on the frontier."""
+        for url in urls:
+            entry = self.entries.get(url)
+            if entry is None or (entry['lastseen'] is None and not entry['pending']):
+                self._update(url, pending=True)
+
+    def frontier(self) -> list[str]:
+        """Returns the urls found on earlier crawls which haven't been fetched yet."""
+        return [url for url, entry in self.entries.items() if entry['pending']]
+
+    def pop_changes(self) -> list[CrawlStateModel]:
+        """Returns the rows of every url whose state changed since the last call."""
+        changes = [
+            CrawlStateModel(source=self.source, url=url, **self.entries[url])
+            for url in self._changed
+        ]
+        self._changed.clear()
+        return changes
+
+    @staticmethod
+    def save(changes: list[CrawlStateModel]):
+        """Writes rows returned by `pop_changes` to the database, in a single transaction. Blocking."""
+        from allpress.services.db import db_service
+
+        db_service.save_models(changes, update_columns=_UPDATE_COLUMNS)
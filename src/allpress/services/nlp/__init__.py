@@ -1,2 +1 @@
-from . import encoders
-from . import processors
\ No newline at end of file
+# `encoders` needs torch and `processors` needs spaCy. Both are imported where they are used.
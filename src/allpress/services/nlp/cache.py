@@ -0,0 +1,226 @@
+from collections import OrderedDict
+from hashlib import blake2b
+from os import path, makedirs, truncate
+import json
+import re
+import threading
+
+import numpy as np
+
+from allpress.settings import EMBEDDING_CACHE_PATH, EMBEDDING_CACHE_LRU_SIZE
+from allpress.util import logger, file_lock
+
+# Texts are identified by a 16 byte blake2b digest. The digests of the persistent tier are stored as fixed-width
+# slots, next to a file holding the embedding of each digest at the same row, and a json file with the dimension
+# of the embeddings. Several processes may share the files: appends are made under a lock file, and every process
+# reads the keys appended by the others when the keys file has grown.
+KEY_WIDTH = 16
+# Raw slots rather than 'S16', which drops the trailing NUL bytes of a digest when it is read back.
+KEY_DTYPE = np.dtype(f'V{KEY_WIDTH}')
+
+
+def text_key(text: str) -> bytes:
+    """Returns the cache key of `text`."""
+    return blake2b(text.encode('utf-8'), digest_size=KEY_WIDTH).digest()
+
+
+class EmbeddingCache:
+    """
+    EmbeddingCache: embeddings of one model, keyed by the hash of the embedded text. \n
+    Recently used embeddings are kept in an in-memory LRU tier. Every embedding ever computed is appended to a
+    persistent tier of two files, which is memory-mapped for reads. \n
+    model_name: str (Name of the embedding model. Each model has its own files.) \n
+    root: str (Directory of the persistent tier.) \n
+    lru_size: int (Number of embeddings kept in memory.)
+    """
+
+    def __init__(self, model_name: str, root: str = EMBEDDING_CACHE_PATH, lru_size: int = EMBEDDING_CACHE_LRU_SIZE):
+        self.model_name = model_name
+        self.lru_size = lru_size
+        slug = re.sub(r'[^\w.-]', '_', model_name)
+        self.keys_path = path.join(root, f'{slug}.keys')
+        self.vectors_path = path.join(root, f'{slug}.f32')
+        self.meta_path = path.join(root, f'{slug}.json')
+        self.lock_path = path.join(root, f'{slug}.lock')
+        makedirs(root, exist_ok=True)
+
+        self.dim = None
+        self._lru = OrderedDict()
+        self._rows = {}
+        # Number of rows of the files read so far. It can be more than len(self._rows), when processes appended
+        # the same text at the same time.
+        self._size = 0
+        self._vectors = None
+        self._lock = threading.Lock()
+
+        self.requests = 0
+        self.unique = 0
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+
+        self._load()
+
+    def __len__(self) -> int:
+        return len(self._rows)
+
+    def _load(self):
+        with file_lock(self.lock_path):
+            self._repair()
+        self._refresh()
+
+    def _repair(self):
+        # Keys and vectors are appended separately, so an interrupted append leaves one file longer than the other.
+        # Both are cut back to the rows they have in common. Called with the lock file held.
+        if not self._read_dim() or not path.exists(self.keys_path) or not path.exists(self.vectors_path):
+            return
+        row_bytes = 4 * self.dim
+        rows = min(path.getsize(self.keys_path) // KEY_WIDTH, path.getsize(self.vectors_path) // row_bytes)
+        if path.getsize(self.keys_path) != rows * KEY_WIDTH or path.getsize(self.vectors_path) != rows * row_bytes:
+            logger.log(f"Dropping partial entries at the end of {self.keys_path}", level="warning")
+            truncate(self.keys_path, rows * KEY_WIDTH)
+            truncate(self.vectors_path, rows * row_bytes)
+
+    def _read_dim(self) -> bool:
+        # The dimension is written by the first process to store an embedding.
+        if self.dim is None and path.exists(self.meta_path):
+            with open(self.meta_path, 'r') as meta_file:
+                self.dim = json.load(meta_file)['dim']
+        return self.dim is not None
+
+    def _refresh(self):
+        # Reads the keys appended since the last read, by this process or any other. Only whole slots are read, and
+        # a key is written after its vector, so every key read has its vector on disk.
+        if not self._read_dim() or not path.exists(self.keys_path):
+            return
+        rows = path.getsize(self.keys_path) // KEY_WIDTH
+        if rows <= self._size:
+            return
+        keys = np.fromfile(self.keys_path, dtype=KEY_DTYPE, count=rows - self._size, offset=self._size * KEY_WIDTH)
+        for row, key in enumerate(keys.tolist(), start=self._size):
+            # A text appended twice keeps its first row.
+            self._rows.setdefault(key, row)
+        self._size = rows
+
+    def _map(self) -> np.ndarray:
+        # The memory map is reopened lazily whenever the file has grown since it was last mapped.
+        if self._vectors is None or len(self._vectors) != self._size:
+            self._vectors = np.memmap(self.vectors_path, dtype=np.float32, mode='r', shape=(self._size, self.dim))
+        return self._vectors
+
+    def _remember(self, key: bytes, vector: np.ndarray):
+        self._lru[key] = vector
+        self._lru.move_to_end(key)
+        if len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def _persist(self, keys: list[bytes], vectors: np.ndarray):
+        # Appends the embeddings of `keys` not stored yet. The lock file is held across both appends, and the rows
+        # are taken from the size of the files, so appends of several processes never interleave.
+        with file_lock(self.lock_path):
+            if not path.exists(self.meta_path):
+                with open(self.meta_path, 'w') as meta_file:
+                    json.dump({'model': self.model_name, 'dim': self.dim}, meta_file)
+            self._repair()
+            self._refresh()
+            # Texts computed in the meantime, by another thread or process, are not stored twice.
+            new = [i for i, key in enumerate(keys) if key not in self._rows]
+            if not new:
+                return
+            # Vectors are written before their keys, so a key on disk always has its vector.
+            with open(self.vectors_path, 'ab') as vectors_file:
+                vectors_file.write(vectors[new].tobytes())
+            with open(self.keys_path, 'ab') as keys_file:
+                keys_file.write(b''.join(keys[i] for i in new))
+            for row, i in enumerate(new, start=self._size):
+                self._rows[keys[i]] = row
+            self._size += len(new)
+
+    def encode(self, texts: list[str], encode_fn) -> np.ndarray:
+        """
+        Returns a (len(texts), dim) float32 matrix with the embedding of every text. Texts repeated in `texts` are
+        looked up once, and only the texts found in neither tier are passed to `encode_fn`, in a single call. \n
+        texts: list[str] \n
+        encode_fn: callable (Takes a list of texts, returns a (n, dim) matrix of their embeddings.)
+        """
+        # Repeated texts are reduced to their first occurrence. `inverse` maps every text back to its unique text.
+        unique_keys = {}
+        inverse = np.empty(len(texts), dtype=np.int64)
+        unique_texts = []
+        for i, text in enumerate(texts):
+            key = text_key(text)
+            position = unique_keys.setdefault(key, len(unique_keys))
+            if position == len(unique_texts):
+                unique_texts.append(text)
+            inverse[i] = position
+        keys = list(unique_keys)
+
+        with self._lock:
+            self.requests += len(texts)
+            self.unique += len(keys)
+            # Picks up the embeddings stored by other processes since the last call.
+            self._refresh()
+
+            found = [None] * len(keys)
+            missing = []
+            for position, key in enumerate(keys):
+                vector = self._lru.get(key)
+                if vector is not None:
+                    self._lru.move_to_end(key)
+                    self.memory_hits += 1
+                elif key in self._rows:
+                    vector = np.array(self._map()[self._rows[key]])
+                    self._remember(key, vector)
+                    self.disk_hits += 1
+                else:
+                    missing.append(position)
+                    continue
+                found[position] = vector
+            self.misses += len(missing)
+
+        if missing:
+            computed = np.ascontiguousarray(encode_fn([unique_texts[position] for position in missing]),
+                                            dtype=np.float32)
+            with self._lock:
+                if self.dim is None:
+                    self.dim = computed.shape[1]
+                self._persist([keys[position] for position in missing], computed)
+                for i, position in enumerate(missing):
+                    found[position] = computed[i].copy()
+                    self._remember(keys[position], found[position])
+
+        if not keys:
+            return np.empty((0, self.dim or 0), dtype=np.float32)
+        return np.stack(found)[inverse]
+
+    def stats(self) -> dict:
+        """Returns the number of texts requested, and how many of them were repeats, or hits in either tier."""
+        hits = self.memory_hits + self.disk_hits
+        return {
+            'model': self.model_name,
+            'requested': self.requests,
+            'deduplicated': self.requests - self.unique,
+            'memory hits': self.memory_hits,
+            'disk hits': self.disk_hits,
+            'misses': self.misses,
+            'hit rate': hits / self.unique if self.unique else 0.0,
+            'stored': len(self),
+        }
+
+
+_caches = {}
+_caches_lock = threading.Lock()
+
+
+def get_embedding_cache(model_name: str) -> EmbeddingCache:
+    """Returns the process-wide cache of the model `model_name`, opening it on first use."""
+    with _caches_lock:
+        if model_name not in _caches:
+            _caches[model_name] = EmbeddingCache(model_name)
+        return _caches[model_name]
+
+
+def cache_stats() -> list[dict]:
+    """Returns the statistics of every cache opened in this process."""
+    with _caches_lock:
+        return [cache.stats() for cache in _caches.values()]
@@ -1,6 +1,13 @@
+import copy
+import pickle
+import time
+from os import replace
+
+import numpy as np
 import torch
-import torch_directml
-from torch.utils.data import DataLoader, TensorDataset
+from torch.utils.data import DataLoader, IterableDataset, TensorDataset, get_worker_info, random_split
+
+from allpress.util import logger
 
 device = torch.device('cpu')
 
@@ -31,41 +38,302 @@ class AutoEncoder(torch.nn.Module):
     def encode(self, x):
         return self.encoder(x)
 
+    @property
+    def input_dim(self) -> int:
+        return self.encoder[0].in_features
+
+    @property
+    def latent_dim(self) -> int:
+        return self.encoder[4].out_features
+
+
+# Inference modes of LatentEncoder.
+INFERENCE_MODES = ('eager', 'script', 'compile', 'int8')
+
+
+class LatentEncoder:
+    """
+    LatentEncoder: the encoder half of a trained AutoEncoder, set up for inference. \n
+    Inputs may be NumPy arrays, lists or tensors. The latents are returned as a contiguous float32 NumPy matrix,
+    ready to be added to or searched in a FAISS index. No autograd state is kept, and the same instance can be used
+    from several threads. \n
+    mode: str ('eager', 'script' for TorchScript, 'compile' for torch.compile, or 'int8' for dynamic quantization of
+    the linear layers.)
+    """
+
+    def __init__(self, model: AutoEncoder, mode: str = 'eager'):
+        if mode not in INFERENCE_MODES:
+            raise ValueError(f"Unknown inference mode '{mode}', expected one of {list(INFERENCE_MODES)}")
+        self.input_dim = model.input_dim
+        self.latent_dim = model.latent_dim
+        self.mode = mode
+
+        # The decoder is only needed for training, and is dropped.
+        encoder = copy.deepcopy(model.encoder).cpu().eval()
+        for parameter in encoder.parameters():
+            parameter.requires_grad_(False)
+        self._eager = encoder
+
+        if mode == 'script':
+            self._module = torch.jit.script(encoder)
+        elif mode == 'compile':
+            self._module = torch.compile(encoder)
+        elif mode == 'int8':
+            self._module = torch.ao.quantization.quantize_dynamic(encoder, {torch.nn.Linear}, dtype=torch.qint8)
+        else:
+            self._module = encoder
+
+    def encode(self, x) -> np.ndarray:
+        if isinstance(x, torch.Tensor):
+            inputs = x.detach().to('cpu', torch.float32)
+        else:
+            inputs = torch.from_numpy(np.ascontiguousarray(x, dtype=np.float32))
+        if inputs.shape[0] == 0:
+            return np.empty((0, self.latent_dim), dtype=np.float32)
+
+        with torch.inference_mode():
+            try:
+                latents = self._module(inputs)
+            except Exception as e:
+                # torch.compile only fails on the first call, when it compiles. The encoder then runs eagerly.
+                if self._module is self._eager or self.mode != 'compile':
+                    raise
+                logger.log(f"Compiling the encoder failed, running it eagerly: {e}", level="warning")
+                self._module = self._eager
+                latents = self._module(inputs)
+        return np.ascontiguousarray(latents.numpy(), dtype=np.float32)
+
+    __call__ = encode
+
+
+def save_checkpoint(model: AutoEncoder, file_path: str):
+    """Saves the dimensions and the weights of `model`. Unlike a pickled model, the checkpoint can be loaded with
+    `weights_only=True`, which can't run code hidden in the file."""
+    checkpoint = {
+        'input_dim': model.input_dim,
+        'latent_dim': model.latent_dim,
+        'state_dict': model.state_dict(),
+    }
+    torch.save(checkpoint, file_path + '.tmp')
+    replace(file_path + '.tmp', file_path)
+
+
+def _read_checkpoint(file_path: str):
+    # Returns the checkpoint dict of `file_path`, or None if the file is a whole pickled model in the old format.
+    try:
+        return torch.load(file_path, map_location='cpu', weights_only=True)
+    except pickle.UnpicklingError:
+        return None
+
+
+def load_checkpoint(file_path: str) -> AutoEncoder:
+    """
+    Loads an AutoEncoder saved with `save_checkpoint`. A file in the old format, a whole pickled model, is loaded
+    the unsafe way and converted in memory only. The file is left as it is, see `migrate_checkpoint`.
+    """
+    checkpoint = _read_checkpoint(file_path)
+    if checkpoint is None:
+        logger.log(f"{file_path} is a pickled autoencoder, run `migrate_autoencoders` to convert it", level="warning")
+        legacy_model = torch.load(file_path, map_location='cpu', weights_only=False)
+        checkpoint = {
+            'input_dim': legacy_model.input_dim,
+            'latent_dim': legacy_model.latent_dim,
+            'state_dict': legacy_model.state_dict(),
+        }
+
+    model = AutoEncoder(input_dim=checkpoint['input_dim'], latent_dim=checkpoint['latent_dim'])
+    model.load_state_dict(checkpoint['state_dict'])
+    return model.eval()
+
+
+def migrate_checkpoint(file_path: str) -> bool:
+    """
+    Rewrites a pickled AutoEncoder in the old format as a checkpoint. The old file is kept next to it with a
+    `.legacy` suffix. Returns False if the file already is a checkpoint.
+    """
+    if _read_checkpoint(file_path) is not None:
+        return False
+    model = load_checkpoint(file_path)
+    replace(file_path, file_path + '.legacy')
+    save_checkpoint(model, file_path)
+    logger.log(f"Converted the pickled autoencoder {file_path} to a weights-only checkpoint")
+    return True
+
+
+class ShardStream(IterableDataset):
+    """
+    ShardStream: streams mini-batches out of a TensorStore without loading it into memory. \n
+    Shards are visited in a random order, and rows pass through a shuffle buffer before being batched. Every
+    `round(1 / val_fraction)`-th row of the store is held out for validation, so the train and validation splits
+    never overlap and stay the same across epochs. With several DataLoader workers, each worker streams its own
+    subset of the shards.
+    """
+
+    def __init__(self,
+                 store,
+                 batch_size: int = 2048,
+                 split: str = 'train',
+                 val_fraction: float = 0.0,
+                 shuffle_buffer: int = 65536,
+                 block_rows: int = 4096,
+                 seed: int = 0):
+        super().__init__()
+        self.store = store
+        self.batch_size = batch_size
+        self.split = split
+        self.val_every = round(1 / val_fraction) if val_fraction else 0
+        self.shuffle = split == 'train'
+        self.shuffle_buffer = max(shuffle_buffer, batch_size)
+        self.block_rows = block_rows
+        self.seed = seed
+        self.epoch = 0
+
+    def set_epoch(self, epoch: int):
+        # Changes the shard order and shuffling of the next pass over the store.
+        self.epoch = epoch
+
+    def _split_mask(self, first_row: int, count: int) -> np.ndarray:
+        if not self.val_every:
+            return np.full(count, self.split == 'train')
+        held_out = (np.arange(first_row, first_row + count) % self.val_every) == 0
+        return held_out if self.split == 'val' else ~held_out
+
+    def _blocks(self, rng: np.random.Generator, worker_id: int, num_workers: int):
+        # Yields blocks of rows belonging to this split, read from the shards assigned to this worker.
+        shard_ids = list(range(worker_id, self.store.num_shards, num_workers))
+        if self.shuffle:
+            rng.shuffle(shard_ids)
+
+        shards = list(self.store.shards())
+        for shard_id in shard_ids:
+            shard = shards[shard_id]
+            shard_start = shard_id * self.store.shard_rows
+            for offset in range(0, len(shard), self.block_rows):
+                block = np.asarray(shard[offset:offset + self.block_rows])
+                yield block[self._split_mask(shard_start + offset, len(block))]
+
+    def __iter__(self):
+        worker_info = get_worker_info()
+        worker_id = worker_info.id if worker_info else 0
+        num_workers = worker_info.num_workers if worker_info else 1
+        rng = np.random.default_rng((self.seed, self.epoch, worker_id))
+
+        buffer = np.empty((0, self.store.dim), dtype=np.float32)
+        for block in self._blocks(rng, worker_id, num_workers):
+            buffer = np.concatenate((buffer, block))
+            if len(buffer) < self.shuffle_buffer:
+                continue
+
+            # Once the buffer is full, it is shuffled and all whole batches are emitted. The remaining rows are
+            # mixed with the next blocks.
+            if self.shuffle:
+                buffer = buffer[rng.permutation(len(buffer))]
+            whole = len(buffer) - len(buffer) % self.batch_size
+            for start in range(0, whole, self.batch_size):
+                yield torch.from_numpy(buffer[start:start + self.batch_size])
+            buffer = buffer[whole:]
+
+        if self.shuffle:
+            buffer = buffer[rng.permutation(len(buffer))]
+        for start in range(0, len(buffer), self.batch_size):
+            yield torch.from_numpy(buffer[start:start + self.batch_size])
+
+
+def _run_epoch(model, batches, loss_fn, optimizer=None) -> tuple[float, int, float]:
+    # Runs one full pass over `batches`. The model is trained if an optimizer is given, and only evaluated otherwise.
+    # Returns the mean per-example loss, the number of examples seen, and the time taken in seconds.
+    model.train(optimizer is not None)
+    total_loss = 0.0
+    samples = 0
+    start = time.perf_counter()
+
+    with torch.set_grad_enabled(optimizer is not None):
+        for batch in batches:
+            # TensorDataset returns tuples, while ShardStream returns the batch itself.
+            inputs = (batch[0] if isinstance(batch, (list, tuple)) else batch).float().to(device)
+            outputs = model(inputs)
+            loss = loss_fn(outputs, inputs)
+            if optimizer is not None:
+                optimizer.zero_grad()
+                loss.backward()
+                optimizer.step()
+            total_loss += loss.item() * inputs.size(0)  # accumulate per-example loss
+            samples += inputs.size(0)
+
+    return total_loss / max(1, samples), samples, time.perf_counter() - start
+
 
 def train_autoencoder(
-        training_tensor: torch.Tensor,
+        training_data,
         latent_dim: int=256,
         epochs: int=50,
         learning_rate: float=1e-3,
-        batch_size: int=2048):
-    training_tensor = training_tensor.float()
-    input_dim = training_tensor.shape[1]
+        batch_size: int=2048,
+        val_fraction: float=0.0,
+        patience: int=None,
+        shuffle_buffer: int=65536,
+        num_workers: int=4):
+    """
+    Trains an autoencoder on `training_data`, which is either a tensor held in memory or a TensorStore. A store
+    is streamed shard by shard, so it may be larger than RAM. \n
+    val_fraction: float (Fraction of the examples held out for validation.) \n
+    patience: int (Stop once the validation loss has not improved for this many epochs, and keep the best weights.
+    Requires val_fraction.) \n
+    shuffle_buffer: int (Rows shuffled together when streaming from a store.)
+    """
+    streaming = not isinstance(training_data, torch.Tensor)
+
+    if streaming:
+        input_dim = training_data.dim
+        train_batches = ShardStream(training_data, batch_size, 'train', val_fraction, shuffle_buffer)
+        val_batches = ShardStream(training_data, batch_size, 'val', val_fraction) if val_fraction else None
+        # ShardStream batches its own rows, so the loaders only parallelise the reading.
+        train_loader = DataLoader(train_batches, batch_size=None, num_workers=num_workers)
+        val_loader = DataLoader(val_batches, batch_size=None, num_workers=num_workers) if val_batches else None
+    else:
+        training_data = training_data.float()
+        input_dim = training_data.shape[1]
+        dataset = TensorDataset(training_data)
+        val_size = int(len(dataset) * val_fraction)
+        train_set, val_set = random_split(dataset, [len(dataset) - val_size, val_size])
+        train_loader = DataLoader(train_set, batch_size=batch_size, shuffle=True, num_workers=num_workers,
+                                  pin_memory=False)
+        val_loader = DataLoader(val_set, batch_size=batch_size, num_workers=num_workers) if val_size else None
+
     model = AutoEncoder(input_dim=input_dim, latent_dim=latent_dim).to(device)
     optimizer = torch.optim.Adam(model.parameters(), lr=learning_rate)
     loss_fn = torch.nn.MSELoss()
 
-    # Wrap in DataLoader
-    dataset = TensorDataset(training_tensor)
-    dataloader = DataLoader(dataset, batch_size=batch_size, shuffle=True, num_workers=4, pin_memory=False)
+    best_val_loss = float('inf')
+    best_state = None
+    epochs_without_improvement = 0
 
     for epoch in range(epochs):
-        model.train()
-        total_loss = 0.0
-
-        for i, batch in enumerate(dataloader):
-            if i > 10:
-                break
-            inputs = batch[0].to(device)  # TensorDataset returns tuples
-            optimizer.zero_grad()
-            outputs = model(inputs)
-            loss = loss_fn(outputs, inputs)
-            loss.backward()
-            optimizer.step()
-            total_loss += loss.item() * inputs.size(0)  # accumulate per-example loss
+        if streaming:
+            train_batches.set_epoch(epoch)
 
-        avg_loss = total_loss / len(dataset)
-        print(f"Epoch {epoch+1}/{epochs}, Avg Loss: {avg_loss:.6f}", end='\r')
+        avg_loss, samples, seconds = _run_epoch(model, train_loader, loss_fn, optimizer)
+        report = f"Epoch {epoch+1}/{epochs}, Avg Loss: {avg_loss:.6f}, {samples / max(seconds, 1e-9):.0f} samples/s"
 
-    print("\nTraining complete.")
-    return model
+        if val_loader is not None:
+            val_loss, _, _ = _run_epoch(model, val_loader, loss_fn)
+            report += f", Val Loss: {val_loss:.6f}"
+
+            if val_loss < best_val_loss:
+                best_val_loss = val_loss
+                best_state = copy.deepcopy(model.state_dict())
+                epochs_without_improvement = 0
+            else:
+                epochs_without_improvement += 1
+
+        print(report)
 
+        if patience and val_loader is not None and epochs_without_improvement >= patience:
+            print(f"Validation loss has not improved for {patience} epochs. Stopping early.")
+            break
+
+    if best_state is not None:
+        model.load_state_dict(best_state)
+
+    print("Training complete.")
+    return model
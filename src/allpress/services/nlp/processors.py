@@ -1,71 +1,70 @@
-from bs4 import BeautifulSoup as Soup
-from sentence_transformers import SentenceTransformer as Model
-
-import spacy
-import torch
-import torch_directml
-from os import cpu_count, path
-from hashlib import md5
-
-from allpress.core.models import PageModel
+from allpress.core.models import PageModel, text_uid
 from allpress.types import EmbeddingResult
-from allpress.services.nn import model_manager
-
-
-device = torch_directml.device()
-
-torch.set_num_threads(cpu_count())
-sentence_nlp = spacy.load('xx_sent_ud_sm')
-rhet_embedder = Model('paraphrase-multilingual-MiniLM-L12-v2')
-sem_embedder = Model('LaBSE')
+from allpress.services.nn import model_manager, embedder_variant
+from allpress.services.nlp.cache import get_embedding_cache
+from allpress.settings import NLP_BATCH_SIZE, NLP_N_PROCESS, EMBEDDING_CACHE, EMBEDDING_BATCH_SIZE
 
-class Article:
-
-    def _extract_text(self):
-        paragraphs = self.html.find_all('p')
-        text = ' '.join([p.get_text() for p in paragraphs])
-        return text.strip()
+# The spaCy pipeline and the embedders are loaded through `model_manager` the first time a batch needs them, not
+# when this module is imported.
 
-    def _split_sentences(self, text):
-        """Splits the document text into sentences."""
-        sentences = sentence_nlp(text).sents
-        return [sentence for sentence in sentences]
 
-    def _mask_rhetoric_chunks(self) -> list[str]:
+def encode_texts(texts: list[str], embedder: str):
+    """
+    Embeds `texts` with the 'semantic' or 'rhetoric' embedder. With the embedding cache enabled, only the texts
+    which have never been embedded before are passed to the model, which is not even loaded if there are none.
+    """
+    def encode(batch):
+        with model_manager.get_embedders(embedder=embedder) as model:
+            return model.encode(batch, batch_size=EMBEDDING_BATCH_SIZE, convert_to_tensor=False,
+                                show_progress_bar=False)
 
-        masked_sentences = []
+    if not EMBEDDING_CACHE:
+        return encode(texts)
+    return get_embedding_cache(embedder_variant(embedder)).encode(texts, encode)
 
-        for i in range(len(self.sentences)):
-            masked_sentences.append([])
-            for token in self.sentences[i]:
-                if token.ent_type_:
-                    masked_sentences[i].append("[MASK]")
-                else:
-                    masked_sentences[i].append(token.text)
-            masked_sentences[i] = ' '.join(masked_sentences[i])
-        return masked_sentences
 
+def mask_rhetoric_chunks(sentences) -> list[str]:
+    """
+    Replaces every token of the named entities in `sentences` (spaCy spans) with [MASK], leaving only the rhetoric
+    of each sentence.
+    """
+    masked_sentences = []
 
+    for i in range(len(sentences)):
+        masked_sentences.append([])
+        for token in sentences[i]:
+            if token.ent_type_:
+                masked_sentences[i].append("[MASK]")
+            else:
+                masked_sentences[i].append(token.text)
+        masked_sentences[i] = ' '.join(masked_sentences[i])
+    return masked_sentences
 
 
+class Article:
 
     def __init__(self,
                  url: str,
-                 content: Soup):
+                 text: str,
+                 document=None):
 
+        # `text` is the paragraph text of the page, as extracted by `allpress.services.scrape.parse_page`.
+        # `document` is the spaCy doc of the text. Batches of articles are processed at once by `ArticleBatch.build`,
+        # which passes the docs in. An article created on its own runs the pipeline by itself.
         self.url = url
-        self.html = content
-        self.raw_text = self._extract_text()
-        with model_manager.get_entity_nlp() as entity_nlp:
-            self.document = entity_nlp(self.raw_text)
-            self.doc_text = self.document.text
-            self.entities = [ent.text for ent in self.document.ents]
-        self.sentences = self._split_sentences(self.raw_text)
-        self.masked_rhetoric = self._mask_rhetoric_chunks()
-        hashobj = md5()
-        hashobj.update(bytes(str(self.doc_text).encode('utf-8')))
-        self.id = hashobj.hexdigest()
-        del hashobj
+        self.raw_text = text.strip()
+        if document is None:
+            with model_manager.get_article_nlp() as article_nlp:
+                document = article_nlp(self.raw_text)
+        self.document = document
+        self.doc_text = self.document.text
+        self.entities = [ent.text for ent in self.document.ents]
+
+        # Sentences and entities come from the same doc, so the tokens of each sentence carry their entity types.
+        self.sentences = list(self.document.sents)
+        self.masked_rhetoric = mask_rhetoric_chunks(self.sentences)
+        # The id is the uid of the page the article is saved as.
+        self.id = text_uid(str(self.doc_text))
 
         self.rhetorical_embedding = None
 
@@ -90,6 +89,29 @@ class ArticleBatch(list):
     def __init__(self, articles: list[Article]):
         super().__init__(articles)
 
+    @classmethod
+    def build(cls,
+              pages,
+              batch_size: int = NLP_BATCH_SIZE,
+              n_process: int = NLP_N_PROCESS):
+        """
+        Creates a batch of articles from `(url, text)` pairs. All texts are streamed through the spaCy pipeline in
+        one `nlp.pipe` call, which finds the sentences and entities of each text in a single pass. \n
+        pages: iterable of (url, text) tuples \n
+        batch_size: int (Number of texts spaCy processes at a time.) \n
+        n_process: int (Number of processes running the pipeline.)
+        """
+        pages = [(url, text.strip()) for url, text in pages]
+        if not pages:
+            return cls([])
+        with model_manager.get_article_nlp() as article_nlp:
+            documents = article_nlp.pipe(
+                (text for _, text in pages),
+                batch_size=batch_size,
+                n_process=n_process,
+            )
+            return cls([Article(url, text, document) for (url, text), document in zip(pages, documents)])
+
     def serialize(self):
         """Returns a serializable PageModel object for each article.
         These PageModel objects can be saved directly to the database
@@ -101,19 +123,19 @@ class ArticleBatch(list):
 
         # Flatten all masked rhetoric sentences from all articles
         sentences = []
-        with model_manager.get_embedders(embedder='rhetoric') as rhet_embedder:
-            for article in self:
-                for sentence in article.masked_rhetoric:
-                    # Appends a tuple containing two objects: A string representation of the sentence to be embedded,
-                    # and the UUID of the article it came from.
-                    sentences.append((str(sentence), article.id))
-
-            only_sentences = [sentence[0] for sentence in sentences]
-            article_ids = [sentence[1] for sentence in sentences]
-            embeddings.append(
-                (rhet_embedder.encode(only_sentences, convert_to_tensor=False, show_progress_bar=False), article_ids)
-            )
-            return embeddings
+        for article in self:
+            for sentence in article.masked_rhetoric:
+                # Appends a tuple containing two objects: A string representation of the sentence to be embedded,
+                # and the UUID of the article it came from.
+                sentences.append((str(sentence), article.id))
+
+        only_sentences = [sentence[0] for sentence in sentences]
+        article_ids = [sentence[1] for sentence in sentences]
+        # Boilerplate sentences repeat across articles, so most of them are found in the embedding cache.
+        embeddings.append(
+            (encode_texts(only_sentences, 'rhetoric'), article_ids)
+        )
+        return embeddings
 
 
     # Add option to enable or disable return_embedding. Set to true for testing.
@@ -122,24 +144,21 @@ class ArticleBatch(list):
         # Flatten all entities from all articles
         entities = []
 
-        with model_manager.get_embedders(embedder='semantic') as sem_embedder:
-            for article in self:
-                # Generates a tuple that contains two objects; a string representation of the entity, and the UUID of the
-                # article it came from.
-                entities = entities + [(entity, article.id) for entity in article.entities]
-
-            total = len(entities)
-            i = 0
-
-            # Make a list only containing the entity strings for embedding.
-            only_entity_strings = [entity[0] for entity in entities]
-            article_ids = [entity[1] for entity in entities]
-
-            # entity[0] is the embedding itself, entity[1] is the article id.
-            embeddings.append(
-                (sem_embedder.encode(only_entity_strings, convert_to_tensor=False, show_progress_bar=False), article_ids)
-            )
-            return embeddings
+        for article in self:
+            # Generates a tuple that contains two objects; a string representation of the entity, and the UUID of the
+            # article it came from.
+            entities = entities + [(entity, article.id) for entity in article.entities]
+
+        # Make a list only containing the entity strings for embedding.
+        only_entity_strings = [entity[0] for entity in entities]
+        article_ids = [entity[1] for entity in entities]
+
+        # The same entities (countries, agencies, people in the news) are mentioned in nearly every batch. Each one
+        # is only embedded once, and then read from the embedding cache.
+        embeddings.append(
+            (encode_texts(only_entity_strings, 'semantic'), article_ids)
+        )
+        return embeddings
 
 
     def generate_embeddings(self):
@@ -1,30 +1,128 @@
 import gc
-import torch
+import threading
 from contextlib import contextmanager
 from typing import Optional
+from os import cpu_count
 from os.path import join
 
-from allpress.settings import CLASSIFICATION_MODELS_PATH
+from allpress.settings import (
+    CLASSIFICATION_MODELS_PATH,
+    INFERENCE_DEVICE,
+    EMBEDDING_QUANTIZE,
+    EMBEDDING_BACKEND,
+    AUTOENCODER_INFERENCE_MODE,
+)
+from allpress.util import logger
 
 semantic_autoencoder_path = join(CLASSIFICATION_MODELS_PATH, 'semantic_autoencoder.pth')
 rhetoric_autoencoder_path = join(CLASSIFICATION_MODELS_PATH, 'rhetoric_autoencoder.pth')
 
+# Sentence-transformers models embedding the entities (semantic) and masked sentences (rhetoric) of articles.
+EMBEDDER_MODELS = {
+    'semantic': 'LaBSE',
+    'rhetoric': 'paraphrase-multilingual-MiniLM-L12-v2',
+}
+
+
+EMBEDDING_BACKENDS = ('torch', 'onnx')
+
+
+def resolve_device(requested: str = INFERENCE_DEVICE):
+    """
+    Returns the torch device to run inference on. `requested` is 'auto', 'cpu', 'cuda' or 'directml'. A device which
+    isn't available falls back to the CPU, with a warning.
+    """
+    import torch
+
+    if requested in ('auto', 'cuda') and torch.cuda.is_available():
+        return torch.device('cuda')
+    if requested in ('auto', 'directml'):
+        try:
+            import torch_directml
+            return torch_directml.device()
+        except ImportError:
+            pass
+    if requested not in ('auto', 'cpu'):
+        logger.log(f"Inference device '{requested}' is not available, using the CPU", level="warning")
+    return torch.device('cpu')
+
+
+def embedder_variant(embedder: str, backend: str = EMBEDDING_BACKEND, quantize: bool = EMBEDDING_QUANTIZE) -> str:
+    """Returns the name of the embedder model, tagged with the backend or quantization it runs with. Embeddings of
+    different variants differ slightly, so they are cached separately."""
+    name = EMBEDDER_MODELS[embedder]
+    if backend == 'onnx':
+        return f'{name}@onnx'
+    if quantize:
+        return f'{name}@int8'
+    return name
+
+
+def load_embedder(embedder: str,
+                  device: str = INFERENCE_DEVICE,
+                  backend: str = EMBEDDING_BACKEND,
+                  quantize: bool = EMBEDDING_QUANTIZE):
+    """
+    Loads the 'semantic' or 'rhetoric' embedder. Unlike `ModelManager.get_embedders`, every call loads a new copy. \n
+    device: str (See `resolve_device`.) \n
+    backend: str ('torch', or 'onnx' for ONNX Runtime.) \n
+    quantize: bool (Quantize the linear layers of a torch model to int8. Only applies on the CPU.)
+    """
+    import torch
+    from sentence_transformers import SentenceTransformer
+
+    if backend not in EMBEDDING_BACKENDS:
+        raise ValueError(f"Unknown embedding backend '{backend}', expected one of {list(EMBEDDING_BACKENDS)}")
+    name = EMBEDDER_MODELS[embedder]
+    torch_device = resolve_device(device)
+
+    if backend == 'onnx':
+        # ONNX Runtime picks its own execution provider, so the device only matters for CUDA.
+        return SentenceTransformer(name, backend='onnx', device='cuda' if torch_device.type == 'cuda' else 'cpu')
+
+    model = SentenceTransformer(name, device=torch_device)
+    model.eval()
+    if quantize:
+        if torch_device.type != 'cpu':
+            logger.log(f"Int8 quantization only runs on the CPU, {name} is left unquantized", level="warning")
+        else:
+            # The weights of the linear layers, which hold nearly all of the compute of a transformer, are stored in
+            # int8. Activations are quantized on the fly.
+            model = torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    return model
+
 
 class ModelManager:
+    # ModelManager is the only place models are loaded. Nothing heavy (torch, spaCy, sentence-transformers) is
+    # imported until a model is first asked for, so importing allpress stays cheap. Models are loaded under a lock,
+    # so threads asking for the same model at once (as in the search server) wait for a single load.
+
     def __init__(self):
+        self._lock = threading.RLock()
+        self._torch_configured = False
         self._entity_nlp: Optional = None
         self._sentence_nlp: Optional = None
+        self._article_nlp: Optional = None
         self._semantic_embedder: Optional = None
         self._rhetoric_embedder: Optional = None
         self._semantic_autoencoder: Optional = None
         self._rhetoric_autoencoder: Optional = None
 
+    def _configure_torch(self):
+        # Torch is set up once, before the first torch model is loaded.
+        with self._lock:
+            if not self._torch_configured:
+                import torch
+                torch.set_num_threads(cpu_count())
+                self._torch_configured = True
+
     @contextmanager
     def get_entity_nlp(self):
         """Load model only when needed, cleanup after use"""
-        if self._entity_nlp is None:
-            import spacy
-            self._entity_nlp = spacy.load('xx_ent_wiki_sm')
+        with self._lock:
+            if self._entity_nlp is None:
+                import spacy
+                self._entity_nlp = spacy.load('xx_ent_wiki_sm')
 
         try:
             yield self._entity_nlp
@@ -37,25 +135,47 @@ class ModelManager:
     @contextmanager
     def get_sentence_nlp(self):
         """Load model only when needed, cleanup after use"""
-        if self._sentence_nlp is None:
-            import spacy
-            self._sentence_nlp = spacy.load('xx_sent_ud_sm')
+        with self._lock:
+            if self._sentence_nlp is None:
+                import spacy
+                self._sentence_nlp = spacy.load('xx_sent_ud_sm')
         try:
             yield self._sentence_nlp
         finally:
             gc.collect()
 
+    @contextmanager
+    def get_article_nlp(self):
+        """
+        Loads the pipeline used on article text. It runs the entity recognizer of `xx_ent_wiki_sm` and the sentence
+        segmenter of `xx_sent_ud_sm` in a single pass, so the sentences of a document carry its entities.
+        """
+        with self._lock:
+            if self._article_nlp is None:
+                import spacy
+                article_nlp = spacy.load('xx_ent_wiki_sm')
+                try:
+                    article_nlp.add_pipe('senter', source=spacy.load('xx_sent_ud_sm'), first=True)
+                except (OSError, ValueError):
+                    # Without the sentence model, sentences are split on punctuation.
+                    article_nlp.add_pipe('sentencizer', first=True)
+                self._article_nlp = article_nlp
+        try:
+            yield self._article_nlp
+        finally:
+            gc.collect()
+
     @contextmanager
     def get_embedders(self, embedder: str=''):
 
         """Load both embedders together ince they're often used together"""
-        if self._semantic_embedder is None and (not embedder or embedder == 'semantic'):
-            from sentence_transformers import SentenceTransformer
-            self._semantic_embedder = SentenceTransformer('LaBSE')
+        self._configure_torch()
+        with self._lock:
+            if self._semantic_embedder is None and (not embedder or embedder == 'semantic'):
+                self._semantic_embedder = load_embedder('semantic')
 
-        if self._rhetoric_embedder is None and (not embedder or embedder == 'rhetoric'):
-            from sentence_transformers import SentenceTransformer
-            self._rhetoric_embedder = SentenceTransformer('paraphrase-multilingual-MiniLM-L12-v2')
+            if self._rhetoric_embedder is None and (not embedder or embedder == 'rhetoric'):
+                self._rhetoric_embedder = load_embedder('rhetoric')
 
         try:
             if not embedder:
@@ -70,20 +190,27 @@ class ModelManager:
 
     @contextmanager
     def get_autoencoders(self):
-        """Load autoencoders only for search operations"""
-        if self._semantic_autoencoder is None:
-            self._semantic_autoencoder = torch.load(
-                semantic_autoencoder_path,
-                map_location='cpu',  # Force CPU to save GPU memory
-                weights_only=False
-            )
-
-        if self._rhetoric_autoencoder is None:
-            self._rhetoric_autoencoder = torch.load(
-                rhetoric_autoencoder_path,
-                map_location='cpu',
-                weights_only=False
-            )
+        """
+        Loads the semantic and rhetoric autoencoders as LatentEncoders, which take embeddings and return the latents
+        as float32 NumPy matrices. They are loaded once, from weights-only checkpoints, and shared by search and
+        ingest.
+        """
+        self._configure_torch()
+        with self._lock:
+            if self._semantic_autoencoder is None or self._rhetoric_autoencoder is None:
+                from allpress.services.nlp.encoders import LatentEncoder, load_checkpoint
+
+            if self._semantic_autoencoder is None:
+                self._semantic_autoencoder = LatentEncoder(
+                    load_checkpoint(semantic_autoencoder_path),
+                    mode=AUTOENCODER_INFERENCE_MODE
+                )
+
+            if self._rhetoric_autoencoder is None:
+                self._rhetoric_autoencoder = LatentEncoder(
+                    load_checkpoint(rhetoric_autoencoder_path),
+                    mode=AUTOENCODER_INFERENCE_MODE
+                )
 
         try:
             yield self._semantic_autoencoder, self._rhetoric_autoencoder
@@ -99,12 +226,14 @@ class ModelManager:
 
     def clear_all_models(self):
         """Force cleanup of all models"""
-        self._entity_nlp = None
-        self._sentence_nlp = None
-        self._semantic_embedder = None
-        self._rhetoric_embedder = None
-        self._semantic_autoencoder = None
-        self._rhetoric_autoencoder = None
+        with self._lock:
+            self._entity_nlp = None
+            self._sentence_nlp = None
+            self._article_nlp = None
+            self._semantic_embedder = None
+            self._rhetoric_embedder = None
+            self._semantic_autoencoder = None
+            self._rhetoric_autoencoder = None
         gc.collect()
 
 model_manager = ModelManager()
\ No newline at end of file
@@ -0,0 +1,141 @@
+import queue
+import threading
+import time
+
+from allpress.util import logger
+
+# This module runs a sequence of processing stages concurrently. Every stage has its own worker threads and a bounded
+# input queue. A stage whose queue is full blocks the stage before it, so a slow stage throttles the whole pipeline
+# instead of letting work pile up in memory.
+
+# Marks the end of the input of a stage. Every worker of a stage receives one.
+_END = object()
+
+
+class Stage:
+    """
+    Stage: one step of a Pipeline. \n
+    name: str (Shown in logs and statistics.) \n
+    fn: callable (Takes an item and returns the item passed to the next stage, or None to drop it.) \n
+    workers: int (Number of threads running `fn`. Stages which must see the items one at a time use 1.) \n
+    queue_size: int (Number of items waiting for this stage before the previous stage blocks.)
+    """
+
+    def __init__(self, name: str, fn, workers: int = 1, queue_size: int = 4):
+        self.name = name
+        self.fn = fn
+        self.workers = workers
+        self.queue = queue.Queue(maxsize=queue_size)
+
+        self.processed = 0
+        self.dropped = 0
+        self.failed = 0
+        self.busy_seconds = 0.0
+        self._finished_workers = 0
+        self._lock = threading.Lock()
+
+    def stats(self) -> dict:
+        return {
+            'stage': self.name,
+            'workers': self.workers,
+            'processed': self.processed,
+            'dropped': self.dropped,
+            'failed': self.failed,
+            'busy s': self.busy_seconds,
+        }
+
+
+class Pipeline:
+    """
+    Pipeline: feeds the items of a source through a list of stages, each running in its own threads. \n
+    A first Ctrl-C stops reading from the source, and lets the items already in the pipeline drain through every
+    stage. A second one drops the items still in flight.
+    """
+
+    def __init__(self, stages: list[Stage]):
+        self.stages = stages
+        self._abort = threading.Event()
+
+    def _put(self, stage_queue: queue.Queue, item):
+        # Blocks while the queue is full, but wakes up regularly, so an abort is noticed and Ctrl-C can be received.
+        while True:
+            try:
+                stage_queue.put(item, timeout=0.1)
+                return
+            except queue.Full:
+                if self._abort.is_set() and item is not _END:
+                    return
+
+    def _work(self, position: int):
+        stage = self.stages[position]
+        next_stage = self.stages[position + 1] if position + 1 < len(self.stages) else None
+        while True:
+            item = stage.queue.get()
+            if item is _END:
+                break
+            if self._abort.is_set():
+                continue
+
+            start = time.perf_counter()
+            try:
+                result = stage.fn(item)
+            except Exception as e:
+                logger.log(f"[PIPELINE] Stage '{stage.name}' failed: {e}", level="error")
+                result = None
+                with stage._lock:
+                    stage.failed += 1
+            with stage._lock:
+                stage.busy_seconds += time.perf_counter() - start
+                stage.processed += 1
+                # The last stage has nothing to pass on, so only the earlier stages drop items.
+                if result is None and next_stage is not None:
+                    stage.dropped += 1
+
+            if result is not None and next_stage is not None:
+                self._put(next_stage.queue, result)
+
+        # The last worker of a stage to finish ends the input of the next stage.
+        with stage._lock:
+            stage._finished_workers += 1
+            last = stage._finished_workers == stage.workers
+        if last and next_stage is not None:
+            for _ in range(next_stage.workers):
+                self._put(next_stage.queue, _END)
+
+    def _wait(self, threads: list[threading.Thread]):
+        for thread in threads:
+            while thread.is_alive():
+                thread.join(0.1)
+
+    def run(self, source) -> list[dict]:
+        """
+        Feeds every item of the iterable `source` to the first stage, waits for the pipeline to drain, and returns
+        the statistics of every stage. If `source` is a generator, it is closed when the pipeline is interrupted.
+        """
+        threads = []
+        for position, stage in enumerate(self.stages):
+            for i in range(stage.workers):
+                thread = threading.Thread(target=self._work, args=(position,), name=f'{stage.name}-{i}', daemon=True)
+                thread.start()
+                threads.append(thread)
+
+        first = self.stages[0]
+        try:
+            for item in source:
+                self._put(first.queue, item)
+        except KeyboardInterrupt:
+            print("Interrupted. Finishing the work in flight, press Ctrl-C again to abort.")
+        finally:
+            if hasattr(source, 'close'):
+                source.close()
+
+        for _ in range(first.workers):
+            self._put(first.queue, _END)
+        try:
+            self._wait(threads)
+        except KeyboardInterrupt:
+            print("Aborting. The work still in flight is dropped.")
+            self._abort.set()
+            self._wait(threads)
+
+        return [stage.stats() for stage in self.stages]
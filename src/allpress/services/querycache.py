@@ -0,0 +1,120 @@
+from collections import OrderedDict
+from hashlib import blake2b
+import json
+import threading
+import unicodedata
+
+from allpress.settings import QUERY_CACHE_LRU_SIZE, QUERY_CACHE_REDIS, QUERY_CACHE_REDIS_TTL
+from allpress.types import SearchResult
+from allpress.util import logger
+
+# Results of Searcher.search, keyed by everything that decides them: the query, the search settings, the models, and
+# the generation of the indexes. Entries of an older generation are never looked up again, and age out of the LRU
+# tier, or expire from redis.
+
+# Prefix of the keys of the shared tier in redis.
+REDIS_KEY_PREFIX = 'allpress:query:'
+
+
+def normalize_query(query: str) -> str:
+    """
+    Returns `query` in Unicode NFC form, with runs of whitespace collapsed. Case is kept, since the entity
+    recognizer relies on it, and queries differing only in case can give different results.
+    """
+    return ' '.join(unicodedata.normalize('NFC', query).split())
+
+
+def query_key(query: str, **parts) -> str:
+    """Returns the cache key of the normalized `query` searched with the settings in `parts`."""
+    description = json.dumps([normalize_query(query), sorted(parts.items())], default=str)
+    return blake2b(description.encode('utf-8'), digest_size=16).hexdigest()
+
+
+class QueryCache:
+    """
+    QueryCache: search results by query key. \n
+    Recent results are kept in an in-process LRU tier. With `shared`, they are also stored in redis, where every
+    process searching the same indexes can find them. \n
+    lru_size: int (Number of results kept in memory.) \n
+    shared: bool (Use the redis tier.) \n
+    ttl: int (Seconds a result stays in redis.)
+    """
+
+    def __init__(self, lru_size: int = QUERY_CACHE_LRU_SIZE, shared: bool = QUERY_CACHE_REDIS,
+                 ttl: int = QUERY_CACHE_REDIS_TTL):
+        self.lru_size = lru_size
+        self.shared = shared
+        self.ttl = ttl
+        self._lru = OrderedDict()
+        self._lock = threading.Lock()
+
+        self.memory_hits = 0
+        self.shared_hits = 0
+        self.misses = 0
+
+    def _redis(self):
+        from allpress.services.db import db_service
+        return db_service.db.redis_cursor
+
+    def get(self, key: str):
+        """Returns the cached results of `key`, or None."""
+        with self._lock:
+            results = self._lru.get(key)
+            if results is not None:
+                self._lru.move_to_end(key)
+                self.memory_hits += 1
+                return list(results)
+
+        if self.shared:
+            try:
+                payload = self._redis().get(REDIS_KEY_PREFIX + key)
+            except Exception as e:
+                logger.log(f"Query cache lookup in redis failed: {e}", level="warning")
+                payload = None
+            if payload is not None:
+                results = [SearchResult(*result) for result in json.loads(payload)]
+                with self._lock:
+                    self.shared_hits += 1
+                    self._remember(key, results)
+                return list(results)
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def _remember(self, key: str, results: list):
+        self._lru[key] = results
+        self._lru.move_to_end(key)
+        if len(self._lru) > self.lru_size:
+            self._lru.popitem(last=False)
+
+    def put(self, key: str, results: list[SearchResult]):
+        """Stores the results of `key` in every tier."""
+        results = list(results)
+        with self._lock:
+            self._remember(key, results)
+        if self.shared:
+            try:
+                self._redis().set(REDIS_KEY_PREFIX + key, json.dumps(results), ex=self.ttl)
+            except Exception as e:
+                logger.log(f"Query cache write to redis failed: {e}", level="warning")
+
+    def clear(self):
+        with self._lock:
+            self._lru.clear()
+
+    def stats(self) -> dict:
+        """Returns the hit and miss counts of the cache."""
+        with self._lock:
+            lookups = self.memory_hits + self.shared_hits + self.misses
+            return {
+                'lookups': lookups,
+                'memory hits': self.memory_hits,
+                'shared hits': self.shared_hits,
+                'misses': self.misses,
+                'hit rate': (self.memory_hits + self.shared_hits) / lookups if lookups else 0.0,
+                'stored': len(self._lru),
+            }
+
+
+query_cache = QueryCache()
@@ -1,155 +1,420 @@
 import asyncio
+import atexit
 import aiohttp
-import requests
 import regex
+from concurrent.futures import ProcessPoolExecutor
+import multiprocessing
+import threading
 from urllib.parse import urljoin, urlparse
 from bs4 import BeautifulSoup as Soup
 
 from allpress.util import logger
-from allpress.services.nlp.processors import Article, ArticleBatch
+from allpress.types import ParsedPage, PageFeatures
+from allpress.settings import (
+    CRAWL_MAX_CONNECTIONS,
+    CRAWL_MAX_CONNECTIONS_PER_DOMAIN,
+    CRAWL_DNS_CACHE_TTL,
+    CRAWL_KEEPALIVE_TIMEOUT,
+    CRAWL_REQUEST_TIMEOUT,
+    CRAWL_PARSE_WORKERS,
+    CRAWL_URL_PRESCORE_THRESHOLD,
+)
 
 # This module contains classes and tools for scraping news sources for articles, and runs heuristics
 # on whether to skip saving articles or to keep scraped pages.
 
 
 class ArticleDetector:
-    def __init__(self, confidence_threshold: float = 0.7):
+    """
+    ArticleDetector: scores how likely a page is to be a news article, in two stages. \n
+    `prescore_url` only looks at the url, and `should_fetch` decides from it whether a link is worth fetching at
+    all. `detect_article` adds the DOM heuristics of a fetched page, which are all gathered in a single traversal
+    of the tree.
+    """
+
+    def __init__(self, confidence_threshold: float = 0.7, url_threshold: float = CRAWL_URL_PRESCORE_THRESHOLD):
         self.year_url_regexes = [
-            r'\d{4}/\d{2}/\d{2}',
-            r'\d{4}-\d{2}-\d{2}',
-            r'\d{4}/\d{2}',
-            r'\d{4}-\d{2}',
-            r'\d{4}'
+            regex.compile(r'\d{4}/\d{2}/\d{2}'),
+            regex.compile(r'\d{4}-\d{2}-\d{2}'),
+            regex.compile(r'\d{4}/\d{2}'),
+            regex.compile(r'\d{4}-\d{2}'),
+            regex.compile(r'\d{4}')
         ]
+        self.blacklist_terms = ['category', 'tag', 'search', 'archive', 'feed', 'page']
         self.confidence_threshold = confidence_threshold
+        self.url_threshold = url_threshold
 
-    def detect_article(self, url: str, soup: Soup) -> tuple[bool, float]:
+    def prescore_url(self, url: str) -> float:
+        # Score of the url-only heuristics. Cheap enough to run on every link found.
+        return self._check_year_heuristic(url) + self._check_article_in_url_heuristic(url) \
+            + self._check_blacklist_url(url)
+
+    def should_fetch(self, url: str) -> bool:
+        # Links scoring below the url threshold (category, tag, search pages...) are dropped before being fetched.
+        # Blacklisted terms only count here as whole path segments, so '/tag/' drops a link but 'hostage' doesn't.
+        score = self._check_year_heuristic(url) + self._check_article_in_url_heuristic(url) \
+            + self._check_blacklist_path(url)
+        return score >= self.url_threshold
+
+    def extract_features(self, soup: Soup) -> PageFeatures:
+        # Walks every tag of the page once, and gathers everything the DOM heuristics, the link extraction and the
+        # text extraction need.
+        headline = False
+        article_tags = 0
+        article_sections = 0
+        og_article = 0
+        published_time = 0
+        paragraphs = []
+        links = []
+
+        for tag in soup.find_all(True):
+            name = tag.name
+            if name == 'p':
+                paragraphs.append(tag.get_text())
+            elif name == 'a':
+                href = tag.get('href')
+                if href:
+                    links.append(href)
+            elif name == 'h1' or name == 'h2':
+                headline = True
+            elif name == 'meta':
+                if tag.get('property') == 'og:type' and tag.get('content') == 'article':
+                    og_article += 1
+                if tag.get('name') == 'article:published_time':
+                    published_time += 1
+            elif name == 'article':
+                article_tags += 1
+            elif name == 'main' or name == 'section':
+                if tag.get('role') == 'article' or (tag.get('class') and 'article' in tag.get('class')):
+                    article_sections += 1
+
+        return PageFeatures(
+            headline=headline,
+            article_tags=article_tags,
+            article_sections=article_sections,
+            og_article=og_article,
+            published_time=published_time,
+            paragraphs=paragraphs,
+            links=links,
+        )
+
+    def score_features(self, url: str, features: PageFeatures) -> tuple[bool, float]:
         # Runs several heuristic tests to determine the confidence score of a web page. If the confidence threshold is
         # not reached,  the page is discarded. Increase the confidence threshold for stricter scraping.
-        confidence_score = 0.0
-        confidence_score += self._check_year_heuristic(url)
-        confidence_score += self._check_article_in_url_heuristic(url)
-        confidence_score += self._check_has_article_tags(soup)
-        confidence_score += self._check_text_density(soup)
-        confidence_score += self._check_metadata_tags(soup)
-        confidence_score += self._check_headline_structure(soup)
-        confidence_score += self._check_blacklist_url(url)
+        confidence_score = self.prescore_url(url)
+        confidence_score += self._check_has_article_tags(features)
+        confidence_score += self._check_text_density(features)
+        confidence_score += self._check_metadata_tags(features)
+        confidence_score += self._check_headline_structure(features)
         logger.log(f"Detected {confidence_score:.2f}% of {url}", level="debug")
         return confidence_score >= self.confidence_threshold, confidence_score
 
-    def _check_year_heuristic(self, url): return 0.25 if any(regex.search(p, url) for p in self.year_url_regexes) else 0.0
+    def detect_article(self, url: str, soup: Soup) -> tuple[bool, float]:
+        return self.score_features(url, self.extract_features(soup))
+
+    def _check_year_heuristic(self, url): return 0.25 if any(p.search(url) for p in self.year_url_regexes) else 0.0
     def _check_article_in_url_heuristic(self, url): return 0.1 if 'article' in url or 'post' in url else 0.0
-    def _check_blacklist_url(self, url): return -0.4 if any(term in url.lower() for term in ['category', 'tag', 'search', 'archive', 'feed', 'page']) else 0.0
-    def _check_headline_structure(self, soup): return 0.1 if soup.find('h1') or soup.find('h2') else 0.0
+    def _check_blacklist_url(self, url): return -0.4 if any(term in url.lower() for term in self.blacklist_terms) else 0.0
 
-    def _check_metadata_tags(self, soup):
-        score = 0.0
-        for tag in soup.find_all('meta'):
-            if tag.get('property') == 'og:type' and tag.get('content') == 'article':
-                score += 0.3
-            if tag.get('name') == 'article:published_time':
-                score += 0.2
-        return score
+    def _check_blacklist_path(self, url):
+        # Segments like 'tag', 'page' or 'archives' mark listing pages. Terms inside a slug are not counted.
+        segments = urlparse(url).path.lower().split('/')
+        listing = any(segment in self.blacklist_terms or segment.rstrip('s') in self.blacklist_terms
+                      for segment in segments)
+        return -0.4 if listing else 0.0
+    def _check_headline_structure(self, features): return 0.1 if features.headline else 0.0
+    def _check_metadata_tags(self, features): return 0.3 * features.og_article + 0.2 * features.published_time
 
-    def _check_has_article_tags(self, soup):
+    def _check_has_article_tags(self, features):
         score = 0.0
-        if soup.find_all('article'):
+        if features.article_tags:
             score += 0.2
-        for tag in soup.find_all(['main', 'section']):
-            if tag.get('role') == 'article':
-                score += 0.2
-            elif tag.get('class') and 'article' in tag.get('class'):
-                score += 0.2
+        score += 0.2 * features.article_sections
         return score
 
-    def _check_text_density(self, soup):
-        paragraphs = soup.find_all('p')
-        total_text = ' '.join(p.get_text() for p in paragraphs).strip()
-        if len(paragraphs) >= 5:
+    def _check_text_density(self, features):
+        if len(features.paragraphs) >= 5:
             return 0.2
-        if len(total_text.split()) > 300:
+        if len(' '.join(features.paragraphs).split()) > 300:
             return 0.2
         return 0.0
 
 
+def on_site(starting_url: str, url: str) -> bool:
+    if not starting_url:
+        return False
+    base_domain = urlparse(starting_url).netloc
+    target_domain = urlparse(urljoin(starting_url, url)).netloc
+
+    # Boolean that checks if a scraped link redirects away from the website. If the base domain of the link
+    # does not match the target domain, the function returns false.
+    return base_domain == target_domain
+
+
+# Detector used by `parse_page`. Each parse worker process builds its own on first use.
+_page_detector = None
+
+
+def parse_page(url: str, html: str, starting_url: str) -> ParsedPage:
+    """
+    Parses a fetched page, scores it with the ArticleDetector, and extracts its on-site links and paragraph text.
+    Runs in the parse worker processes, so it only returns plain data which is cheap to send back.
+    """
+    global _page_detector
+    if _page_detector is None:
+        _page_detector = ArticleDetector()
+
+    features = _page_detector.extract_features(Soup(html, 'lxml'))
+    is_article, score = _page_detector.score_features(url, features)
+    links = list({
+        urljoin(url, href)
+        for href in features.links
+        if on_site(starting_url, href)
+    })
+    text = ' '.join(features.paragraphs).strip() if is_article else ''
+    return ParsedPage(url=url, is_article=is_article, score=score, links=links, text=text)
+
+
+_parse_pool = None
+_parse_pool_lock = threading.Lock()
+
+
+def get_parse_pool():
+    # Returns the process pool that parses fetched pages, creating it on first use. With CRAWL_PARSE_WORKERS set to
+    # 0, there is no pool and pages are parsed on the event loop thread. Workers are spawned rather than forked: the
+    # crawling process runs threads holding torch and spaCy, whose locks and models a forked child would inherit.
+    global _parse_pool
+    with _parse_pool_lock:
+        if _parse_pool is None and CRAWL_PARSE_WORKERS != 0:
+            _parse_pool = ProcessPoolExecutor(max_workers=CRAWL_PARSE_WORKERS,
+                                              mp_context=multiprocessing.get_context('spawn'))
+            atexit.register(_parse_pool.shutdown, cancel_futures=True)
+        return _parse_pool
+
+
+def create_session(max_connections: int = CRAWL_MAX_CONNECTIONS,
+                   per_domain: int = CRAWL_MAX_CONNECTIONS_PER_DOMAIN) -> aiohttp.ClientSession:
+    # Creates the long-lived HTTP session used for crawling. Its connector caps the number of open connections
+    # overall and per host, caches DNS results, and keeps idle connections (and their TLS sessions) alive for reuse.
+    # Must be called from inside the event loop the session will be used in.
+    connector = aiohttp.TCPConnector(
+        limit=max_connections,
+        limit_per_host=per_domain,
+        ttl_dns_cache=CRAWL_DNS_CACHE_TTL,
+        keepalive_timeout=CRAWL_KEEPALIVE_TIMEOUT,
+        enable_cleanup_closed=True,
+    )
+    return aiohttp.ClientSession(
+        connector=connector,
+        headers={'Accept-Encoding': 'gzip'},
+        timeout=aiohttp.ClientTimeout(total=CRAWL_REQUEST_TIMEOUT),
+    )
+
+
 class Scraper:
-    def __init__(self):
+    def __init__(self, session: aiohttp.ClientSession = None, incremental: bool = False):
         self.starting_url = None
         self.cached_urls = set()
         self.found_urls = set()
         self.scraped_urls = set()
         self.detector = ArticleDetector()
 
+        # With `incremental`, the crawl state of the source is loaded from the database when the crawl starts (see
+        # `allpress.services.frontier`). Pages are then requested conditionally, unchanged pages are not parsed, and
+        # the crawl resumes from the urls left pending by the previous one.
+        self.incremental = incremental
+        self.state = None
+
+        # HTTP session used for every request. A session passed in is shared with other scrapers and closed by its
+        # owner. Otherwise the scraper creates its own on first use, keeps it across iterations and calls to
+        # `scrape`, and closes it in `close`.
+        self.session = session
+        self._owns_session = session is None
+        self._loop = None
+
     def on_site(self, url: str) -> bool:
-        if not self.starting_url:
-            return False
-        base_domain = urlparse(self.starting_url).netloc
-        target_domain = urlparse(urljoin(self.starting_url, url)).netloc
+        return on_site(self.starting_url, url)
 
-        # Boolean that checks if a scraped link redirects away from the website. If the base domain of the link
-        # does not match the target domain, the function returns false.
-        return base_domain == target_domain
+    def _get_session(self) -> aiohttp.ClientSession:
+        if self.session is None or self.session.closed:
+            self.session = create_session()
+        return self.session
 
-    async def _fetch(self, session, url):
+    async def _fetch(self, session, url, conditional: bool = False):
+        # Returns {'url', 'html'} for an html page, or None. With `conditional`, the validators of the last response
+        # are sent along, and a page the server reports as not modified is recorded as seen and returns None. The
+        # state of a redirected url is kept under the url it was redirected to, and the requested url leaves the
+        # frontier.
+        headers = self.state.request_headers(url) if conditional and self.state else None
         try:
-            async with session.get(url, timeout=5) as resp:
+            async with session.get(url, headers=headers) as resp:
+                final_url = str(resp.url)
+                if self.state and final_url != url:
+                    self.state.fetched(url)
+                if self.state and resp.status == 304:
+                    self.state.fetched(final_url)
+                    logger.log(f"[UNCHANGED] {url}", level="debug")
+                    return None
+                if self.state:
+                    self.state.fetched(final_url, resp.headers.get('ETag'), resp.headers.get('Last-Modified'))
                 if resp.status != 200 or 'text/html' not in resp.headers.get('Content-Type', ''):
                     return None
                 text = await resp.text()
-                return {'url': str(resp.url), 'html': text}
+                return {'url': final_url, 'html': text}
         except Exception as e:
             logger.log(f"[FAIL] {url}: {e}",)
             return None
 
-    async def _fetch_all(self, urls: list[str]) -> list[dict]:
-        headers = {'Accept-Encoding': 'gzip'}
-        async with aiohttp.ClientSession(headers=headers) as session:
-            tasks = [self._fetch(session, url) for url in urls]
-            return await asyncio.gather(*tasks)
+    def _select_links(self, urls: set[str]) -> list[str]:
+        # Keeps the links whose url alone makes them worth fetching.
+        selected = [url for url in urls if self.detector.should_fetch(url)]
+        if len(selected) < len(urls):
+            logger.log(f"[PRESCORE] Dropped {len(urls) - len(selected)} links from {self.starting_url}", level="debug")
+        return selected
 
-    def scrape(self, domain: str, iterations: int = 2):
+    async def _fetch_and_parse(self, session, url: str):
+        # Fetches a page, and parses it in the process pool as soon as it arrives, while the other fetches of the
+        # iteration are still in flight.
+        res = await self._fetch(session, url, conditional=True)
+        if not res or res['url'] in self.scraped_urls:
+            return None
+        self.scraped_urls.add(res['url'])
+
+        # Servers which don't send validators return the full page every time. The page is only parsed if its content
+        # differs from the last fetch. The hash is looked up and recorded under the url the page was served from.
+        if self.state:
+            content_hash = self.state.content_hash(res['html'])
+            if self.state.is_unchanged(res['url'], content_hash):
+                logger.log(f"[UNCHANGED] {res['url']}", level="debug")
+                return None
+            self.state.fetched(res['url'], content_hash=content_hash)
+
+        pool = get_parse_pool()
+        if pool is None:
+            return parse_page(res['url'], res['html'], self.starting_url)
+        loop = asyncio.get_running_loop()
+        return await loop.run_in_executor(pool, parse_page, res['url'], res['html'], self.starting_url)
+
+    async def _fetch_all(self, urls: list[str], deadline: float = None) -> list[ParsedPage]:
+        # Fetches and parses every url concurrently over the shared session. If a deadline (in event loop time) is
+        # given, pages still being fetched or parsed when it passes are dropped, and only the pages parsed so far are
+        # returned.
+        session = self._get_session()
+        tasks = [asyncio.ensure_future(self._fetch_and_parse(session, url)) for url in urls]
+        if not tasks:
+            return []
+        timeout = None if deadline is None else max(0.0, deadline - asyncio.get_running_loop().time())
+        done, pending = await asyncio.wait(tasks, timeout=timeout)
+        for task in pending:
+            task.cancel()
+        if pending:
+            logger.log(f"[BUDGET] Cancelled {len(pending)} requests to {self.starting_url}", level="debug")
+
+        parsed = []
+        for task in done:
+            try:
+                parsed.append(task.result())
+            except Exception as e:
+                logger.log(f"[FAIL] Parsing a page from {self.starting_url}: {e}", level="error")
+        return parsed
+
+    async def _save_state(self):
+        # Writes the changes to the crawl state in a worker thread. A failed write only costs the next crawl some
+        # refetching, so it doesn't stop this one.
+        changes = self.state.pop_changes()
+        try:
+            await asyncio.get_running_loop().run_in_executor(None, self.state.save, changes)
+        except Exception as e:
+            logger.log(f"[FAIL] Saving the crawl state of {self.starting_url}: {e}", level="error")
+
+    async def crawl(self, domain: str, iterations: int = 2, deadline: float = None):
+        """
+        Crawls `domain` for `iterations` rounds, following the links found on each round. Yields a list of
+        ParsedPage tuples for the pages detected as articles on each round. Crawling stops early once `deadline`
+        (in event loop time) has passed.
+        """
         self.starting_url = domain
-        loop = asyncio.get_event_loop()
+        loop = asyncio.get_running_loop()
+
+        # The crawl state is read from the database in a worker thread, so the other crawls on the event loop go on.
+        if self.incremental and self.state is None:
+            from allpress.services.frontier import CrawlState
+            self.state = CrawlState(domain)
+            await loop.run_in_executor(None, self.state.load)
 
-        # Get initial links
-        initial_html = requests.get(domain).text
-        soup = Soup(initial_html, 'lxml')
-        to_scrape = list({
+        # Get initial links. The start page is always fetched in full, since its links are needed.
+        initial = await self._fetch(self._get_session(), domain)
+        if not initial:
+            logger.log(f"[FAIL] Could not fetch start page {domain}", level="error")
+            return
+        soup = Soup(initial['html'], 'lxml')
+        to_scrape = self._select_links({
             urljoin(domain, a['href'])
             for a in soup.find_all('a', href=True)
             if self.on_site(a['href'])
         })
+        if self.state:
+            # Urls found by the previous crawl but never fetched are crawled along with the start page's links.
+            to_scrape = list(set(to_scrape) | set(self.state.frontier()))
+            self.state.add_pending(to_scrape)
 
         for iteration in range(iterations):
+            if deadline is not None and loop.time() >= deadline:
+                logger.log(f"[BUDGET] Time budget for {domain} used up after {iteration} iterations", level="debug")
+                if self.state:
+                    await self._save_state()
+                break
+
             logger.log(f"[ITER {iteration+1}] Scraping {len(to_scrape)} URLs", level="debug")
-            raw_responses = loop.run_until_complete(self._fetch_all(to_scrape))
+            parsed_pages = await self._fetch_all(to_scrape, deadline)
             articles = []
             new_found_urls = set()
 
-            for res in raw_responses:
-                if not res or res['url'] in self.scraped_urls:
+            for page in parsed_pages:
+                if not page:
                     continue
 
-                soup = Soup(res['html'], 'lxml')
-                url = res['url']
-                self.scraped_urls.add(url)
-
-                is_article, score = self.detector.detect_article(url, soup)
-                if is_article:
-                    logger.log(f"[ARTICLE] {url} ({score})", level="debug")
-                    self.cached_urls.add(url)
-                    articles.append(Article(url, soup))
+                if page.is_article:
+                    logger.log(f"[ARTICLE] {page.url} ({page.score})", level="debug")
+                    self.cached_urls.add(page.url)
+                    articles.append(page)
                 else:
-                    logger.log(f"[SKIP] {url} ({score})", level="debug")
+                    logger.log(f"[SKIP] {page.url} ({page.score})", level="debug")
 
-                links = {
-                    urljoin(url, a['href'])
-                    for a in soup.find_all('a', href=True)
-                    if self.on_site(a['href'])
-                }
-                new_found_urls.update(links)
+                new_found_urls.update(page.links)
 
-            to_scrape = list(new_found_urls - self.scraped_urls)
+            to_scrape = self._select_links(new_found_urls - self.scraped_urls)
             logger.log(f"[DONE] Found {len(to_scrape)} new URLs.", level="debug")
+
+            # The urls of the next iteration stay pending until they are fetched, so the next crawl picks them up if
+            # this one stops first. The changes of the iteration are saved in a worker thread.
+            if self.state:
+                self.state.add_pending(to_scrape)
+                await self._save_state()
             if len(articles) > 0:
-                yield ArticleBatch(articles)
+                yield articles
+
+    def scrape(self, domain: str, iterations: int = 2):
+        # Synchronous version of `crawl`, which yields an ArticleBatch for each round.
+        # The NLP processors are imported here rather than at the top of the module, so the parse worker processes,
+        # which import this module, don't load them.
+        from allpress.services.nlp.processors import ArticleBatch
+
+        if self._loop is None:
+            self._loop = asyncio.new_event_loop()
+
+        pages = self.crawl(domain, iterations)
+        while True:
+            try:
+                articles = self._loop.run_until_complete(pages.__anext__())
+            except StopAsyncIteration:
+                break
+            yield ArticleBatch.build((page.url, page.text) for page in articles)
+
+    def close(self):
+        # Closes the session of a scraper used through `scrape`.
+        if self._owns_session and self.session is not None and not self.session.closed:
+            self._loop.run_until_complete(self.session.close())
+        if self._loop is not None:
+            self._loop.close()
+            self._loop = None
@@ -1,80 +1,217 @@
-from allpress.services.db import db_service
-
-from allpress.services.nn import model_manager
-from allpress.core.nn import vector_db
-from allpress.settings import CLASSIFICATION_MODELS_PATH
+from allpress.services.nn import model_manager, embedder_variant
+from allpress.services.querycache import query_cache, query_key
+from allpress.core.nn import get_vector_db
+from allpress.core.articleindex import pool_vectors
+from allpress.settings import (
+    CLASSIFICATION_MODELS_PATH,
+    QUERY_CACHE,
+    AUTOENCODER_INFERENCE_MODE,
+    SEARCH_RERANK_CANDIDATES,
+    SEARCH_RERANK_AGGREGATION,
+    ARTICLE_INDEX_POOLING,
+)
+from allpress.types import SearchResult
 
 from os.path import join
 
-import torch
-
-from allpress.util import mask_sentences
-
-class Searcher:
+import numpy as np
 
-    def __init__(self, top_1_k: int, top_2_k: int):
-        self.top_1_k = top_1_k
-        self.top_2_k = top_2_k
+from allpress.services.nlp.processors import mask_rhetoric_chunks, encode_texts
 
-    def search(self, query: str):
 
-        with model_manager.get_entity_nlp() as entity_nlp:
-            query_entity_doc = entity_nlp(query)
+def _sum_distances_by_article(space, queries: np.ndarray, k: int, **search_params) -> tuple[np.ndarray, np.ndarray]:
+    # Searches the space with every query vector at once, and sums the distances of all hits belonging to the same
+    # article. Returns the article uids, and the total distance for each of them.
+    if len(queries) == 0 or space.ntotal == 0:
+        return np.array([], dtype=str), np.array([], dtype=np.float64)
 
-        with model_manager.get_sentence_nlp() as sentence_nlp:
-            query_sentence_doc = sentence_nlp(query)
+    distances, article_ids = space.search(queries, k, **search_params)
+    distances = distances.ravel()
+    article_ids = article_ids.ravel()
 
-        query_entities = [ent.text for ent in query_entity_doc.ents]
-        query_sentences = mask_sentences([sent.text for sent in query_sentence_doc.sents], query_entities)
+    # Padding hits (FAISS returns -1 when the index holds fewer than k vectors) and unmapped vectors are dropped.
+    mapped = np.not_equal(article_ids, None)
+    article_ids = article_ids[mapped].astype(str)
+    distances = distances[mapped]
 
-        with model_manager.get_embedders() as embedders:
-            sem_embedder, rhet_embedder = embedders
-            with model_manager.get_autoencoders() as autoencoders:
-                sem_autoencoder, rhet_autoencoder = autoencoders
-                sem_autoencoded = sem_autoencoder.encode(
-                    torch.tensor(sem_embedder.encode(query_entities))
-                )
+    article_uids, article_inverse = np.unique(article_ids, return_inverse=True)
+    totals = np.bincount(article_inverse, weights=distances, minlength=len(article_uids))
+    return article_uids, totals
 
-                rhet_autoencoded = rhet_autoencoder.encode(
-                    torch.tensor(rhet_embedder.encode(query_sentences))
-                )
 
-        total_distance_scores_sem = {}
-        total_distance_scores_rhet = {}
+def _rescore_candidates(space, queries: np.ndarray, candidates: np.ndarray, aggregation: str) -> np.ndarray:
+    # Exact distance of every candidate article to the query, computed on the stored vectors of the candidates only.
+    # Each query vector is matched with the nearest vector of the article, and those distances are aggregated over
+    # the query vectors. Candidates with no vectors in the space get an infinite distance.
+    scores = np.full(len(candidates), np.inf)
+    rows, owners = space.rows_for(candidates.tolist())
+    if len(rows) == 0 or len(queries) == 0:
+        return scores
 
-        for vec in sem_autoencoded:
-            distances, indices = vector_db.sem_index.search(
-                vec.reshape(1, -1).detach().numpy(),
-                self.top_1_k,
-            )
-            for distance, index in zip(distances[0], indices[0]):
-                article_id = db_service.db.redis_cursor.hget('rhetoric', str(index))
-                if article_id not in total_distance_scores_sem.keys():
-                    total_distance_scores_sem[article_id] = distance
-                else:
-                    total_distance_scores_sem[article_id] += distance
-
-        for vec in rhet_autoencoded:
-            distances, indices = vector_db.rhet_index.search(
-                vec.reshape(1, -1).detach().numpy(),
-                self.top_1_k,
-            )
-            for distance, index in zip(distances[0], indices[0]):
-                article_id = db_service.db.redis_cursor.hget('rhetoric', str(index))
-                if article_id not in total_distance_scores_rhet.keys():
-                    total_distance_scores_rhet[article_id] = distance
-                else:
-                    total_distance_scores_rhet[article_id] += distance
+    vectors = space.reconstruct(rows)
+    queries = np.ascontiguousarray(queries, dtype=np.float32)
+    # Squared L2 distances, like the ones returned by the index, of every query vector to every candidate vector.
+    distances = (np.einsum('ij,ij->i', queries, queries)[:, None]
+                 + np.einsum('ij,ij->i', vectors, vectors)[None, :]
+                 - 2 * queries @ vectors.T)
+    np.maximum(distances, 0, out=distances)
 
-        intersection = set(total_distance_scores_sem.keys()) & set(total_distance_scores_rhet.keys())
-        final_results = []
-        for article_id in intersection:
-            combined = total_distance_scores_sem[article_id] + total_distance_scores_rhet[article_id]
-            final_results.append((article_id, combined))
-        final_results.sort(key=lambda x: x[1])
-        print('hi')
+    # The rows of an article are contiguous, so the nearest vector of each article is a reduction over its run.
+    starts = np.flatnonzero(np.r_[True, owners[1:] != owners[:-1]])
+    nearest = np.minimum.reduceat(distances, starts, axis=1)
+    scores[owners[starts]] = nearest.min(axis=0) if aggregation == 'min' else nearest.mean(axis=0)
+    return scores
 
 
+def _search_article_index(space, queries: np.ndarray, k: int) -> tuple[np.ndarray, np.ndarray]:
+    # Pools the query vectors like the vectors of an article, and looks up the closest articles in the article
+    # index of the space. Returns the article uids and their distances.
+    if len(queries) == 0 or space.article_count == 0:
+        return np.array([], dtype=str), np.array([], dtype=np.float64)
 
+    distances, article_ids = space.search_articles(pool_vectors(queries, ARTICLE_INDEX_POOLING)[None, :], k)
+    found = np.not_equal(article_ids[0], None)
+    return article_ids[0][found].astype(str), distances[0][found].astype(np.float64)
 
 
+class Searcher:
+    """
+    Searcher: two-stage search of the vector spaces. \n
+    top_1_k: int (Neighbours retrieved from the index per query vector. Their articles are the candidates.) \n
+    top_2_k: int (Number of results returned after the candidates are re-scored.) \n
+    nprobe, ef_search: int (Search-time settings of approximate indexes.) \n
+    rerank_candidates: int (Number of best candidates of the first stage which are re-scored.) \n
+    aggregation: str ('mean' or 'min' over the query vectors, see `_rescore_candidates`.) \n
+    fast: bool (Look up the pooled query in the article indexes instead, once per space. The `top_1_k` closest
+    articles of each space are combined, without re-scoring.) \n
+    use_cache: bool (Answer repeated queries from the query cache.)
+    """
+
+    def __init__(self, top_1_k: int, top_2_k: int, nprobe: int = None, ef_search: int = None,
+                 rerank_candidates: int = SEARCH_RERANK_CANDIDATES,
+                 aggregation: str = SEARCH_RERANK_AGGREGATION,
+                 fast: bool = False,
+                 use_cache: bool = QUERY_CACHE):
+        if aggregation not in ('mean', 'min'):
+            raise ValueError(f"Unknown aggregation '{aggregation}', expected 'mean' or 'min'")
+        self.top_1_k = top_1_k
+        self.top_2_k = top_2_k
+        self.rerank_candidates = rerank_candidates
+        self.aggregation = aggregation
+        self.fast = fast
+        self.use_cache = use_cache
+
+        # Search-time settings of approximate indexes. Unset values fall back to the defaults in settings.
+        self.search_params = {}
+        if nprobe:
+            self.search_params['nprobe'] = nprobe
+        if ef_search:
+            self.search_params['ef_search'] = ef_search
+
+    def _cache_key(self, query: str) -> str:
+        # Results depend on the query, the search settings, the models, and the contents of the indexes.
+        return query_key(
+            query,
+            top_1_k=self.top_1_k,
+            top_2_k=self.top_2_k,
+            rerank_candidates=self.rerank_candidates,
+            aggregation=self.aggregation,
+            fast=self.fast,
+            generation=get_vector_db().generation,
+            embedders=(embedder_variant('semantic'), embedder_variant('rhetoric')),
+            autoencoders=AUTOENCODER_INFERENCE_MODE,
+            **self.search_params,
+        )
+
+    def search(self, query: str) -> list[SearchResult]:
+        # Repeated queries are answered from the query cache until the indexes change.
+        if not self.use_cache:
+            return self._search(query)
+        key = self._cache_key(query)
+        results = query_cache.get(key)
+        if results is None:
+            results = self._search(query)
+            query_cache.put(key, results)
+        return results
+
+    def _search(self, query: str) -> list[SearchResult]:
+
+        # The query is processed like an article: one pass of the article pipeline gives its entities, and its
+        # sentences with the entities masked.
+        with model_manager.get_article_nlp() as article_nlp:
+            query_doc = article_nlp(query)
+
+        query_entities = [ent.text for ent in query_doc.ents]
+        query_sentences = mask_rhetoric_chunks(list(query_doc.sents))
+
+        # Query entities and sentences go through the embedding cache like those of articles.
+        sem_embeddings = encode_texts(query_entities, 'semantic')
+        rhet_embeddings = encode_texts(query_sentences, 'rhetoric')
+
+        # The autoencoders return float32 matrices, which go to FAISS as they are.
+        with model_manager.get_autoencoders() as autoencoders:
+            sem_autoencoder, rhet_autoencoder = autoencoders
+            sem_autoencoded = sem_autoencoder.encode(sem_embeddings)
+            rhet_autoencoded = rhet_autoencoder.encode(rhet_embeddings)
+
+        vector_db = get_vector_db()
+        if self.fast:
+            return self._search_articles(vector_db, sem_autoencoded, rhet_autoencoded)
+
+        # Every query vector of a space is sent to FAISS in one call, and the distances are summed per article.
+        sem_uids, sem_totals = _sum_distances_by_article(
+            vector_db.semantic,
+            sem_autoencoded,
+            self.top_1_k,
+            **self.search_params,
+        )
+        rhet_uids, rhet_totals = _sum_distances_by_article(
+            vector_db.rhetoric,
+            rhet_autoencoded,
+            self.top_1_k,
+            **self.search_params,
+        )
+
+        # First stage: only articles found in both spaces are kept, ranked by their combined coarse distances. The
+        # best of them are the candidates of the second stage.
+        intersection, sem_positions, rhet_positions = np.intersect1d(
+            sem_uids,
+            rhet_uids,
+            assume_unique=True,
+            return_indices=True,
+        )
+        coarse = sem_totals[sem_positions] + rhet_totals[rhet_positions]
+        candidates = intersection[np.argsort(coarse, kind='stable')[:self.rerank_candidates]]
+
+        # Second stage: the candidates are re-scored exactly in both spaces, and the top_2_k closest are returned.
+        sem_scores = _rescore_candidates(vector_db.semantic, sem_autoencoded, candidates, self.aggregation)
+        rhet_scores = _rescore_candidates(vector_db.rhetoric, rhet_autoencoded, candidates, self.aggregation)
+        return self._top_results(candidates, sem_scores, rhet_scores)
+
+    def _search_articles(self, vector_db, sem_autoencoded: np.ndarray, rhet_autoencoded: np.ndarray):
+        # Fast mode: a single lookup per space, in the article indexes. Articles found in both spaces are ranked by
+        # the sum of their pooled distances.
+        sem_uids, sem_distances = _search_article_index(vector_db.semantic, sem_autoencoded, self.top_1_k)
+        rhet_uids, rhet_distances = _search_article_index(vector_db.rhetoric, rhet_autoencoded, self.top_1_k)
+        intersection, sem_positions, rhet_positions = np.intersect1d(
+            sem_uids,
+            rhet_uids,
+            assume_unique=True,
+            return_indices=True,
+        )
+        return self._top_results(intersection, sem_distances[sem_positions], rhet_distances[rhet_positions])
+
+    def _top_results(self, article_ids: np.ndarray, sem_scores: np.ndarray, rhet_scores: np.ndarray):
+        # Returns the top_2_k articles with the lowest combined distance. Articles missing from a space are dropped.
+        combined = sem_scores + rhet_scores
+        order = np.argsort(combined, kind='stable')[:self.top_2_k]
+        order = order[np.isfinite(combined[order])]
+        return [
+            SearchResult(article_id, distance, semantic, rhetoric)
+            for article_id, distance, semantic, rhetoric in zip(
+                article_ids[order].tolist(),
+                combined[order].tolist(),
+                sem_scores[order].tolist(),
+                rhet_scores[order].tolist(),
+            )
+        ]
@@ -0,0 +1,274 @@
+from http.server import ThreadingHTTPServer, BaseHTTPRequestHandler
+from urllib import request as urlrequest
+from urllib.error import URLError
+import json
+import threading
+import time
+
+from allpress.settings import (
+    SEARCH_SERVER_HOST,
+    SEARCH_SERVER_PORT,
+    SEARCH_SERVER_TIMEOUT,
+    SEARCH_SERVER_AUTO_RELOAD,
+    SEARCH_SERVER_RELOAD_SECONDS,
+)
+from allpress.types import SearchResult
+from allpress.util import logger
+
+# This module keeps the models and indexes of a search in a resident process. The server loads everything once, and
+# answers every search sent to it over HTTP, each request on its own thread. The client is what the `search` command
+# uses to send its query to a running server.
+#
+# The indexes may be written by another process, like a crawl, while the server runs. The server reads them again
+# when asked to with POST /reload. With SEARCH_SERVER_AUTO_RELOAD, it also checks before searching whether their files
+# have changed on disk since it loaded them, and reads them again if so, once the writer is done. Searches running
+# during a reload finish on the indexes they started with.
+#
+# Endpoints:
+#   POST /search   {"query": str, "top_k1": int, "top_k2": int, "nprobe": int, "ef_search": int, "fast": bool}
+#                  -> {"results": [[article uid, distance, semantic distance, rhetoric distance], ...],
+#                      "seconds": float}
+#   POST /reload   -> {"reloaded": bool, "seconds": float, "vectors": {space: count}}
+#   GET  /health   -> {"status": "ok", "vectors": {space: count}}
+#   GET  /stats    -> {"requests": int, "errors": int, "reloads": int, "uptime": float, "mean seconds": float,
+#                      "query cache": {"lookups": int, "memory hits": int, "shared hits": int, "misses": int, ...}}
+
+
+class _SearchHandler(BaseHTTPRequestHandler):
+
+    # Set to the SearchServer answering the requests.
+    server_state = None
+
+    def log_message(self, format, *args):
+        # Requests are logged through the allpress logger instead of stderr.
+        logger.log(f"[SERVER] {self.address_string()} {format % args}", level="debug")
+
+    def _reply(self, status: int, body: dict):
+        payload = json.dumps(body).encode('utf-8')
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(payload)))
+        self.end_headers()
+        self.wfile.write(payload)
+
+    def do_GET(self):
+        if self.path == '/health':
+            self._reply(200, self.server_state.health())
+        elif self.path == '/stats':
+            self._reply(200, self.server_state.stats())
+        else:
+            self._reply(404, {'error': f'unknown path {self.path}'})
+
+    def do_POST(self):
+        if self.path == '/reload':
+            try:
+                self._reply(200, self.server_state.reload(force=True))
+            except Exception as e:
+                logger.log(f"[SERVER] Reloading the indexes failed: {e}", level="error")
+                self._reply(500, {'error': str(e)})
+            return
+        if self.path != '/search':
+            self._reply(404, {'error': f'unknown path {self.path}'})
+            return
+        try:
+            length = int(self.headers.get('Content-Length', 0))
+            body = json.loads(self.rfile.read(length) or b'{}')
+            query = body['query']
+        except (ValueError, KeyError) as e:
+            self._reply(400, {'error': f'bad request: {e}'})
+            return
+
+        try:
+            results, seconds = self.server_state.search(
+                query,
+                body.get('top_k1', 10000),
+                body.get('top_k2', 100),
+                nprobe=body.get('nprobe'),
+                ef_search=body.get('ef_search'),
+                fast=bool(body.get('fast', False)),
+            )
+        except Exception as e:
+            logger.log(f"[SERVER] Search for {query!r} failed: {e}", level="error")
+            self._reply(500, {'error': str(e)})
+            return
+        self._reply(200, {'results': results, 'seconds': seconds})
+
+
+class SearchServer:
+    """
+    SearchServer: resident search process. The models and indexes are loaded when the server starts, and shared by
+    every request. The indexes are read again on request, or with `auto_reload` when they change on disk and no
+    other process is writing them. \n
+    host: str \n
+    port: int \n
+    auto_reload: bool (Check the indexes on disk before searching.) \n
+    reload_seconds: float (Minimum time between two checks of the indexes on disk.)
+    """
+
+    def __init__(self, host: str = SEARCH_SERVER_HOST, port: int = SEARCH_SERVER_PORT,
+                 auto_reload: bool = SEARCH_SERVER_AUTO_RELOAD, reload_seconds: float = SEARCH_SERVER_RELOAD_SECONDS):
+        self.host = host
+        self.port = port
+        self.auto_reload = auto_reload
+        self.reload_seconds = reload_seconds
+        self.started = None
+        self.requests = 0
+        self.errors = 0
+        self.reloads = 0
+        self.busy_seconds = 0.0
+        self.last_check = time.monotonic()
+        self._lock = threading.Lock()
+        self._reload_lock = threading.Lock()
+        self._http = None
+
+    def warm_up(self):
+        """Loads every model and index used by a search, so the first request doesn't pay for it."""
+        from allpress.core.nn import get_vector_db
+        from allpress.services.nn import model_manager
+
+        start = time.perf_counter()
+        with model_manager.get_article_nlp():
+            pass
+        with model_manager.get_embedders():
+            pass
+        with model_manager.get_autoencoders():
+            pass
+        get_vector_db()
+        logger.log(f"[SERVER] Models and indexes loaded in {time.perf_counter() - start:.1f}s")
+
+    def reload(self, force: bool = False) -> dict:
+        """
+        Reads the indexes from disk again if another process has changed them since they were loaded and is done
+        writing them, or always with `force`. While one thread reloads, the other requests go on with the indexes
+        already loaded.
+        """
+        from allpress.core.nn import get_vector_db, reload_vector_db
+
+        start = time.perf_counter()
+        reloaded = False
+        if self._reload_lock.acquire(blocking=force):
+            try:
+                self.last_check = time.monotonic()
+                vector_db = get_vector_db()
+                # While a writer holds the indexes, they change with every insert. The server waits for it to finish
+                # instead of reading them again on every check.
+                if force or (vector_db.stale and not vector_db.writer_active):
+                    reload_vector_db()
+                    reloaded = True
+                    with self._lock:
+                        self.reloads += 1
+            finally:
+                self._reload_lock.release()
+        seconds = time.perf_counter() - start
+        if reloaded:
+            logger.log(f"[SERVER] Indexes reloaded in {seconds:.1f}s")
+        return {'reloaded': reloaded, 'seconds': seconds, 'vectors': self.health()['vectors']}
+
+    def search(self, query: str, top_k1: int, top_k2: int, nprobe: int = None, ef_search: int = None,
+               fast: bool = False):
+        from allpress.services.search import Searcher
+
+        if self.auto_reload and time.monotonic() - self.last_check >= self.reload_seconds:
+            self.reload()
+
+        start = time.perf_counter()
+        try:
+            results = Searcher(top_k1, top_k2, nprobe=nprobe, ef_search=ef_search, fast=fast).search(query)
+        except Exception:
+            with self._lock:
+                self.errors += 1
+            raise
+        seconds = time.perf_counter() - start
+        with self._lock:
+            self.requests += 1
+            self.busy_seconds += seconds
+        return results, seconds
+
+    def health(self) -> dict:
+        from allpress.core.nn import get_vector_db
+
+        vector_db = get_vector_db()
+        return {
+            'status': 'ok',
+            'vectors': {name: space.ntotal for name, space in vector_db.spaces.items()},
+        }
+
+    def stats(self) -> dict:
+        from allpress.services.querycache import query_cache
+
+        with self._lock:
+            return {
+                'requests': self.requests,
+                'errors': self.errors,
+                'reloads': self.reloads,
+                'uptime': time.time() - self.started if self.started else 0.0,
+                'mean seconds': self.busy_seconds / self.requests if self.requests else 0.0,
+                'query cache': query_cache.stats(),
+            }
+
+    def serve_forever(self):
+        """Loads the models, then answers requests until interrupted."""
+        self.warm_up()
+        handler = type('SearchHandler', (_SearchHandler,), {'server_state': self})
+        self._http = ThreadingHTTPServer((self.host, self.port), handler)
+        self._http.daemon_threads = True
+        self.started = time.time()
+        print(f"Search server listening on http://{self.host}:{self.port}")
+        try:
+            self._http.serve_forever()
+        except KeyboardInterrupt:
+            print("Shutting down the search server.")
+        finally:
+            self._http.server_close()
+
+
+class SearchClient:
+    """
+    SearchClient: sends searches to a running SearchServer. \n
+    host: str \n
+    port: int \n
+    timeout: float (Seconds to wait for a search to be answered.)
+    """
+
+    def __init__(self, host: str = SEARCH_SERVER_HOST, port: int = SEARCH_SERVER_PORT,
+                 timeout: float = SEARCH_SERVER_TIMEOUT):
+        self.url = f'http://{host}:{port}'
+        self.timeout = timeout
+
+    def _request(self, endpoint: str, body: dict = None, timeout: float = None) -> dict:
+        data = json.dumps(body).encode('utf-8') if body is not None else None
+        http_request = urlrequest.Request(
+            self.url + endpoint,
+            data=data,
+            headers={'Content-Type': 'application/json'},
+            method='POST' if data is not None else 'GET',
+        )
+        with urlrequest.urlopen(http_request, timeout=timeout or self.timeout) as response:
+            return json.loads(response.read())
+
+    def is_running(self) -> bool:
+        """Returns True if a server answers on the address of the client. Waits at most half a second."""
+        try:
+            return self._request('/health', timeout=0.5).get('status') == 'ok'
+        except (URLError, OSError, ValueError):
+            return False
+
+    def search(self, query: str, top_k1: int, top_k2: int, nprobe: int = None,
+               ef_search: int = None, fast: bool = False) -> list[SearchResult]:
+        """Same as `Searcher.search`, run by the server."""
+        response = self._request('/search', {
+            'query': query,
+            'top_k1': top_k1,
+            'top_k2': top_k2,
+            'nprobe': nprobe,
+            'ef_search': ef_search,
+            'fast': fast,
+        })
+        return [SearchResult(*result) for result in response['results']]
+
+    def stats(self) -> dict:
+        return self._request('/stats')
+
+    def reload(self) -> dict:
+        """Makes the server read its indexes from disk again."""
+        return self._request('/reload', {})
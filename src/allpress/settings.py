@@ -2,12 +2,135 @@
 CLASSIFICATION_MODELS_PATH = "C:\\Users\\Dorian\\PycharmProjects\\Allpress\\src\\allpress\\models\\autoencoders"
 FAISS_INDEX_PATH = "C:\\Users\\Dorian\\PycharmProjects\\Allpress\\src\\allpress\\models\\faiss"
 
+# Type of newly created FAISS indexes: 'flat' (exact), 'ivf_flat', 'ivf_pq' or 'hnsw'. The IVF types are trained
+# on the temporary training tensors with the `build_index` command. FAISS_NPROBE and FAISS_EF_SEARCH are the default
+# search-time settings of the IVF and HNSW indexes, and can be overridden per query.
+FAISS_INDEX_TYPE = "flat"
+FAISS_IVF_NLIST = 4096
+FAISS_PQ_M = 16
+FAISS_HNSW_M = 32
+FAISS_NPROBE = 16
+FAISS_EF_SEARCH = 64
+# Max number of vectors the IVF indexes are trained on by `build_index`.
+FAISS_TRAIN_MAX_SAMPLES = 500000
+
+# Where the map from FAISS rows to article uids is kept. Either 'memmap' (a file next to each index) or 'redis'.
+ID_MAP_BACKEND = "memmap"
+
+# With the write-ahead log enabled, inserted vectors are appended to a log file, and a full snapshot of each index is
+# only written every VECTORDB_CHECKPOINT_VECTORS vectors, every VECTORDB_CHECKPOINT_SECONDS seconds, or on shutdown.
+VECTORDB_WAL = True
+VECTORDB_WAL_FSYNC = False
+VECTORDB_CHECKPOINT_VECTORS = 250000
+VECTORDB_CHECKPOINT_SECONDS = 600
+# Each vector space is split into shards. Once the shard written to holds VECTORDB_SHARD_SIZE vectors, it is sealed
+# (read-only) and a new shard is started. Searches run on every shard in parallel, on VECTORDB_SEARCH_THREADS threads
+# (None uses one per CPU).
+VECTORDB_SHARD_SIZE = 5000000
+VECTORDB_SEARCH_THREADS = None
+# Next to each index, an article index holds one vector per article: the mean or max (ARTICLE_INDEX_POOLING) of the
+# vectors of the article. It is updated on every insert, and answers the `--fast` searches with one lookup per space.
+VECTORDB_ARTICLE_INDEX = True
+ARTICLE_INDEX_POOLING = "mean"
+
 TEMP_TRAINING_VECTOR_PATH = "C:\\Users\\Dorian\\PycharmProjects\\Allpress\\src\\allpress\\models\\temp"
+# Rows per preallocated shard file of the training tensor stores.
+TEMP_TENSOR_SHARD_ROWS = 16384
 
 DATABASE_USERNAME = "test"
 DATABASE_PASSWORD = "default"
 DATABASE_HOST = "localhost"
 DATABASE_NAME = "test"
 
+# Connection pools. Each database operation borrows a connection for its own duration, and waits up to
+# DATABASE_POOL_TIMEOUT seconds for one to become free.
+DATABASE_POOL_NAME = "allpress"
+DATABASE_POOL_SIZE = 8
+DATABASE_POOL_TIMEOUT = 10
+
+REDIS_HOST = "localhost"
+REDIS_PORT = 6379
+REDIS_POOL_SIZE = 32
+REDIS_HEALTH_CHECK_INTERVAL = 30
+
+# Crawl scheduling for the `scrape` command. Every source is crawled CRAWL_ITERATIONS links deep. Up to
+# CRAWL_MAX_SOURCES_IN_FLIGHT sources are crawled at once, with at most CRAWL_MAX_CONNECTIONS requests in flight
+# overall and CRAWL_MAX_CONNECTIONS_PER_DOMAIN per domain. The crawl of a source is cut short after
+# CRAWL_SOURCE_TIME_BUDGET seconds.
+CRAWL_ITERATIONS = 2
+CRAWL_MAX_SOURCES_IN_FLIGHT = 16
+CRAWL_MAX_CONNECTIONS = 128
+CRAWL_MAX_CONNECTIONS_PER_DOMAIN = 8
+CRAWL_SOURCE_TIME_BUDGET = 300
+CRAWL_RESULT_QUEUE_SIZE = 32
+# Crawl HTTP sessions keep DNS results for CRAWL_DNS_CACHE_TTL seconds, and idle connections open for
+# CRAWL_KEEPALIVE_TIMEOUT seconds. Single requests time out after CRAWL_REQUEST_TIMEOUT seconds.
+CRAWL_DNS_CACHE_TTL = 600
+CRAWL_KEEPALIVE_TIMEOUT = 30
+CRAWL_REQUEST_TIMEOUT = 10
+# Number of worker processes parsing fetched pages. None uses one per CPU, 0 parses on the event loop thread.
+CRAWL_PARSE_WORKERS = None
+# Links whose url-only article score is below this threshold are not fetched. Urls with a blacklisted path segment
+# (/category/, /tag/, /search, /page/2...) score below 0.
+CRAWL_URL_PRESCORE_THRESHOLD = 0.0
+# With incremental crawling, the state of every crawled url (validators, content hash, frontier) is kept in the
+# `crawlstate` table. Pages are requested conditionally, and pages which haven't changed are not parsed again.
+CRAWL_INCREMENTAL = True
+
+# Stages of the `scrape` ingest pipeline. Each stage buffers up to PIPELINE_QUEUE_SIZE batches, and the embedding and
+# SQL stages run on PIPELINE_EMBED_WORKERS and PIPELINE_SAVE_WORKERS threads. The NLP stage uses NLP_N_PROCESS
+# processes, and the index stage always has a single writer.
+PIPELINE_QUEUE_SIZE = 4
+PIPELINE_EMBED_WORKERS = 1
+PIPELINE_SAVE_WORKERS = 2
+
+# spaCy processing of article batches. Texts are streamed through the pipeline NLP_BATCH_SIZE at a time, by
+# NLP_N_PROCESS processes (-1 uses one per CPU).
+NLP_BATCH_SIZE = 64
+NLP_N_PROCESS = 1
+
+# Embeddings of entities and sentences are cached by model and text. The most recently used EMBEDDING_CACHE_LRU_SIZE
+# embeddings of each model are kept in memory, and all of them in files under EMBEDDING_CACHE_PATH.
+EMBEDDING_CACHE = True
+EMBEDDING_CACHE_PATH = "C:\\Users\\Dorian\\PycharmProjects\\Allpress\\src\\allpress\\models\\embedding_cache"
+EMBEDDING_CACHE_LRU_SIZE = 100000
+
+# Inference settings of the embedders. INFERENCE_DEVICE is 'auto' (CUDA, then DirectML, then the CPU), 'cpu', 'cuda' or
+# 'directml', and falls back to the CPU when the device isn't available. Texts are encoded EMBEDDING_BATCH_SIZE at a
+# time. On the CPU, EMBEDDING_QUANTIZE runs the linear layers of the torch models with dynamic int8 quantization.
+# EMBEDDING_BACKEND 'onnx' runs the embedders with ONNX Runtime instead of torch (needs `optimum[onnxruntime]`).
+INFERENCE_DEVICE = "auto"
+EMBEDDING_BATCH_SIZE = 64
+EMBEDDING_QUANTIZE = False
+EMBEDDING_BACKEND = "torch"
+# How the autoencoders run at inference: 'eager', 'script' (TorchScript), 'compile' (torch.compile) or 'int8'.
+AUTOENCODER_INFERENCE_MODE = "eager"
+
+# Searches run in two stages. The index search gives candidate articles, of which the best SEARCH_RERANK_CANDIDATES
+# are re-scored exactly on their stored vectors. An article scores the distance from each query vector to its nearest
+# vector of the article, aggregated over the query vectors with SEARCH_RERANK_AGGREGATION ('mean' or 'min').
+SEARCH_RERANK_CANDIDATES = 1000
+SEARCH_RERANK_AGGREGATION = "mean"
+
+# The `serve` command keeps the models and indexes loaded, and answers searches over HTTP on this address. The
+# `search` command sends its query there when a server is running. Requests to the server time out after
+# SEARCH_SERVER_TIMEOUT seconds.
+SEARCH_SERVER_HOST = "127.0.0.1"
+SEARCH_SERVER_PORT = 8765
+SEARCH_SERVER_TIMEOUT = 60
+
+# With SEARCH_SERVER_AUTO_RELOAD, the server checks at most once every SEARCH_SERVER_RELOAD_SECONDS seconds whether
+# another process has changed the indexes on disk, and reads them again once no process is writing them. Otherwise,
+# the indexes are only read again when asked to, through the /reload endpoint.
+SEARCH_SERVER_AUTO_RELOAD = False
+SEARCH_SERVER_RELOAD_SECONDS = 60
+
+# Search results are cached by query, search settings and index generation. The last QUERY_CACHE_LRU_SIZE results
+# are kept in memory. With QUERY_CACHE_REDIS, results are also shared through redis for QUERY_CACHE_REDIS_TTL seconds.
+QUERY_CACHE = True
+QUERY_CACHE_LRU_SIZE = 1024
+QUERY_CACHE_REDIS = False
+QUERY_CACHE_REDIS_TTL = 3600
+
 NEWS_SOURCE_CATALOG_FILE = "C:\\Users\\Dorian\\PycharmProjects\\Allpress\\src\\allpress\\sources.csv"
 CONFIG_FILE_PATH = "C:\\Users\\Dorian\\PycharmProjects\\Allpress\\src\\allpress\\config.json"
\ No newline at end of file
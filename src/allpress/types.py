@@ -1,7 +1,35 @@
-from typing import NamedTuple, Tuple, List
-from numpy import ndarray
-from torch import Tensor
+from typing import NamedTuple, Tuple, List, TYPE_CHECKING
+
+if TYPE_CHECKING:
+    from numpy import ndarray
+    from torch import Tensor
 
 class EmbeddingResult(NamedTuple):
-    semantic: List[Tuple[ndarray, str]]
-    rhetoric: List[Tuple[Tensor, str]]
\ No newline at end of file
+    semantic: List[Tuple['ndarray', str]]
+    rhetoric: List[Tuple['Tensor', str]]
+
+
+class ParsedPage(NamedTuple):
+    url: str
+    is_article: bool
+    score: float
+    links: List[str]
+    text: str
+
+
+class PageFeatures(NamedTuple):
+    headline: bool
+    article_tags: int
+    article_sections: int
+    og_article: int
+    published_time: int
+    paragraphs: List[str]
+    links: List[str]
+
+
+class SearchResult(NamedTuple):
+    article_id: str
+    # Re-ranked distance of the article to the query: the sum of its semantic and rhetoric distances.
+    distance: float
+    semantic: float
+    rhetoric: float
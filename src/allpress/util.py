@@ -1,4 +1,6 @@
 import logging
+import os
+from contextlib import contextmanager
 from allpress import exceptions
 
 URL_PARSE_REGEX = '((http|https):\/\/)?(((www|ww\d|www\d)\.)?(?=.{5,255})([\w-]{2,63}\.)+\w{2,63})(\/[\w\-._~:?#@!$&\'\(\)*+,;%=]+)*\/?'
@@ -21,6 +23,66 @@ def check_redis_connection(db_service):
             raise exceptions.RedisUnreachable
 
 
+def _lock(lock_file, blocking: bool = True):
+    # Takes an exclusive lock on the open file `lock_file`. Without `blocking`, raises OSError if it is held already.
+    if os.name == 'nt':
+        import msvcrt
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_LOCK if blocking else msvcrt.LK_NBLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_EX if blocking else fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+
+def _unlock(lock_file):
+    if os.name == 'nt':
+        import msvcrt
+        lock_file.seek(0)
+        msvcrt.locking(lock_file.fileno(), msvcrt.LK_UNLCK, 1)
+    else:
+        import fcntl
+        fcntl.flock(lock_file.fileno(), fcntl.LOCK_UN)
+
+
+@contextmanager
+def file_lock(lock_path: str):
+    # Exclusive lock shared between processes, held on the file `lock_path` for the duration of the block.
+    with open(lock_path, 'a+b') as lock_file:
+        _lock(lock_file)
+        try:
+            yield
+        finally:
+            _unlock(lock_file)
+
+
+def try_file_lock(lock_path: str):
+    # Takes the exclusive lock on the file `lock_path` without waiting. Returns the open lock file, which holds the
+    # lock until `release_file_lock`, or None if another process holds it.
+    lock_file = open(lock_path, 'a+b')
+    try:
+        _lock(lock_file, blocking=False)
+    except OSError:
+        lock_file.close()
+        return None
+    return lock_file
+
+
+def release_file_lock(lock_file):
+    _unlock(lock_file)
+    lock_file.close()
+
+
+def is_file_locked(lock_path: str) -> bool:
+    # Whether another process holds the lock on `lock_path`. The lock is taken for an instant to find out.
+    if not os.path.exists(lock_path):
+        return False
+    lock_file = try_file_lock(lock_path)
+    if lock_file is None:
+        return True
+    release_file_lock(lock_file)
+    return False
+
+
 def mask_sentences(sentences, entities) -> list[str]:
 
     for i in range(len(sentences)):